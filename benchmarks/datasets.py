@@ -0,0 +1,141 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Synthetic datasets for benchmarking tiny-ldap-manager """
+
+import os
+
+SUFFIX = 'dc=example,dc=org'
+PEOPLE_DN = 'ou=people,' + SUFFIX
+# Every how many entries the sync dataset differs from the live ones
+SYNC_MODIFY_EVERY = 10
+# Share of the sync dataset that doesn't exist yet in LDAP
+SYNC_ADD_RATIO = 0.05
+
+
+def person_dn(num):
+    """ DN of a synthetic person """
+    return 'uid=user{},{}'.format(num, PEOPLE_DN)
+
+
+def person_attrs(num, mail_domain='example.org'):
+    """ Attributes of a synthetic person, as python-ldap would hand them """
+    uid = 'user{}'.format(num)
+    return {
+        'objectClass': [b'top', b'inetOrgPerson'],
+        'uid': [uid.encode('utf-8')],
+        'cn': ['User {}'.format(num).encode('utf-8')],
+        'sn': [str(num).encode('utf-8')],
+        'mail': ['{}@{}'.format(uid, mail_domain).encode('utf-8')],
+    }
+
+
+def sync_mail_domain(num):
+    """ Mail domain of a person in the sync dataset """
+    return 'example.com' if num % SYNC_MODIFY_EVERY == 0 else 'example.org'
+
+
+def write_people_csv(path, size, mail_domain=lambda num: 'example.org'):
+    """ Write people to be added, as a CSV file (see bulk --add-entries) """
+    with open(path, 'w') as f:
+        f.write('dn;objectClass[];uid;cn;sn;mail\n')
+        for num in range(size):
+            f.write('{};top|inetOrgPerson;user{};User {};{};user{}@{}\n' \
+                    .format(person_dn(num), num, num, num, num, \
+                    mail_domain(num)))
+
+
+def write_modify_csv(path, size):
+    """ Write a new attribute of each person (see bulk --modify-attributes) """
+    with open(path, 'w') as f:
+        f.write('dn;telephoneNumber\n')
+        for num in range(size):
+            f.write('{};+1 555 {:07d}\n'.format(person_dn(num), num))
+
+
+def write_modify_wide_csv(path, size):
+    """ Write 5 new attributes of each person, as a single CSV row each """
+    with open(path, 'w') as f:
+        f.write('dn;telephoneNumber;mobile;title;description;roomNumber\n')
+        for num in range(size):
+            f.write('{};+1 555 {:07d};+1 556 {:07d};Title {};Person {};{}\n' \
+                    .format(person_dn(num), num, num, num, num, num % 1000))
+
+
+def write_dn_list(path, size):
+    """ Write the DN of each person (see bulk --delete-entries) """
+    with open(path, 'w') as f:
+        for num in range(size):
+            f.write(person_dn(num) + '\n')
+
+
+def write_dn_list_of(path, dns):
+    """ Write the given DNs, one per line """
+    with open(path, 'w') as f:
+        for dn in dns:
+            f.write(dn + '\n')
+
+
+def write_people_ldif(path, size):
+    """ Write people to be added, as LDIF change records (see bulk --ldif) """
+    with open(path, 'w') as f:
+        for num in range(size):
+            f.write('dn: {}\nchangetype: add\n'.format(person_dn(num)))
+            for attr, values in person_attrs(num).items():
+                for value in values:
+                    f.write('{}: {}\n'.format(attr, value.decode('utf-8')))
+            f.write('\n')
+
+
+# Name of each dataset file, along with the function that writes it
+DATASETS = {
+    'people.csv': write_people_csv,
+    'modify.csv': write_modify_csv,
+    'modify-wide.csv': write_modify_wide_csv,
+    'dns.txt': write_dn_list,
+    'people.ldif': write_people_ldif,
+    'sync.csv': lambda path, size: write_people_csv(path, size, \
+            sync_mail_domain),
+    'subtrees.txt': lambda path, size: write_dn_list_of(path, \
+            [PEOPLE_DN]),
+}
+
+
+def generate_datasets(data_dir, size):
+    """ Write every dataset of the given size, unless they already exist
+
+    Returns the directory where they are found.
+    """
+    size_dir = os.path.join(data_dir, str(size))
+    os.makedirs(size_dir, exist_ok=True)
+    for name, write in DATASETS.items():
+        path = os.path.join(size_dir, name)
+        if not os.path.exists(path):
+            write(path + '.tmp', size)
+            os.rename(path + '.tmp', path)
+    return size_dir
+
+
+def populate(directory, size, skip_last=0):
+    """ Load the synthetic people into a FakeDirectory
+
+    The last 'skip_last' of them are left out (ie: for sync to add them).
+    """
+    directory.load(PEOPLE_DN, {'objectClass': [b'organizationalUnit'], \
+            'ou': [b'people']})
+    for num in range(size - skip_last):
+        directory.load(person_dn(num), person_attrs(num))
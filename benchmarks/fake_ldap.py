@@ -0,0 +1,378 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" In-memory stand-in for an LDAP server, with injected latency
+
+It mimics the parts of python-ldap's LDAPObject that tiny-ldap-manager uses,
+so that its bulk jobs can be benchmarked without a real server. Every
+operation is applied as soon as it's sent, but its result is only handed
+over once 'latency' seconds have gone by, just like a round trip would.
+"""
+
+import re
+import time
+import heapq
+import threading
+import ldap
+import ldap.dn
+from ldap.controls import SimplePagedResultsControl
+
+
+def normalize(dn):
+    """ Get the key of a DN in the directory """
+    return ldap.dn.dn2str(ldap.dn.str2dn(dn.lower()))
+
+
+def parent_of(key):
+    """ Get the key of the parent of an (already normalized) DN """
+    return ldap.dn.dn2str(ldap.dn.str2dn(key)[1:])
+
+
+class FakeDirectory:
+    """ Directory Information Tree shared by every fake LDAP session
+
+    Entries are kept in a dict, indexed by normalized DN, along with an index
+    of the children of each entry (so one-level and subtree searches don't
+    have to go through the whole tree).
+    """
+
+    def __init__(self, suffix):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.children = {}
+        self.suffix = normalize(suffix)
+        self.entries[self.suffix] = (suffix, {})
+        self.children[self.suffix] = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, dn, attrs):
+        """ Store an entry, without any checks (ie: to populate the tree) """
+        key = normalize(dn)
+        self.entries[key] = (dn, {attr.lower(): (attr, list(values)) \
+                for attr, values in attrs.items()})
+        self.children.setdefault(key, {})
+        self.children.setdefault(parent_of(key), {})[key] = None
+
+    def add(self, dn, modlist):
+        """ Add an entry below an existing one """
+        key = normalize(dn)
+        with self.lock:
+            if key in self.entries:
+                raise ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+            if parent_of(key) not in self.entries:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+            self.load(dn, dict(modlist))
+
+    def delete(self, dn):
+        """ Delete a leaf entry """
+        key = normalize(dn)
+        with self.lock:
+            if key not in self.entries:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+            if self.children.get(key):
+                raise ldap.NOT_ALLOWED_ON_NONLEAF({'desc': \
+                        'Operation not allowed on non-leaf'})
+            del self.entries[key]
+            self.children.pop(key, None)
+            self.children[parent_of(key)].pop(key, None)
+
+    def modify(self, dn, modlist):
+        """ Apply a modlist to an entry """
+        key = normalize(dn)
+        with self.lock:
+            if key not in self.entries:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+            attrs = self.entries[key][1]
+            for op, attr, values in modlist:
+                if isinstance(values, bytes):
+                    values = [values]
+                name = attr.lower()
+                if op == ldap.MOD_REPLACE:
+                    attrs.pop(name, None)
+                    if values:
+                        attrs[name] = (attr, list(values))
+                elif op == ldap.MOD_ADD:
+                    attrs.setdefault(name, (attr, []))[1].extend(values)
+                elif name not in attrs:
+                    raise ldap.NO_SUCH_ATTRIBUTE({'desc': 'No such attribute'})
+                elif values is None:
+                    del attrs[name]
+                else:
+                    remaining = [v for v in attrs[name][1] if v not in values]
+                    if remaining:
+                        attrs[name] = (attrs[name][0], remaining)
+                    else:
+                        del attrs[name]
+
+    def rename(self, dn, newrdn, newsuperior=None, delold=1):
+        """ Rename (or move) a leaf entry """
+        key = normalize(dn)
+        with self.lock:
+            if key not in self.entries:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+            if self.children.get(key):
+                raise ldap.NOT_ALLOWED_ON_NONLEAF({'desc': \
+                        'Operation not allowed on non-leaf'})
+            old_dn, attrs = self.entries[key]
+            if newsuperior is None:
+                newsuperior = ldap.dn.dn2str(ldap.dn.str2dn(old_dn)[1:])
+            new_dn = '{},{}'.format(newrdn, newsuperior)
+            if normalize(new_dn) in self.entries:
+                raise ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+            del self.entries[key]
+            self.children.pop(key, None)
+            self.children[parent_of(key)].pop(key, None)
+            self.load(new_dn, {attr: values \
+                    for attr, values in attrs.values()})
+
+    def search(self, base, scope, filterstr, attrlist):
+        """ Get the (dn, attrs) of the entries matching a filter """
+        match = compile_filter(filterstr)
+        key = normalize(base)
+        with self.lock:
+            if key not in self.entries:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+            if scope == ldap.SCOPE_BASE:
+                keys = [key]
+            elif scope == ldap.SCOPE_ONELEVEL:
+                keys = self.children.get(key, {})
+                # Children matched by RDN are looked up, as an index would
+                rdns = rdn_candidates(filterstr, base, keys)
+                keys = list(keys) if rdns is None else \
+                        [k for k in rdns if k in keys]
+            else:
+                keys = [key]
+                for parent in keys:
+                    keys.extend(self.children.get(parent, ()))
+            wanted = None
+            if attrlist is not None and '*' not in attrlist:
+                wanted = {attr.lower() for attr in attrlist}
+            results = []
+            for key in keys:
+                dn, attrs = self.entries[key]
+                if not match(attrs):
+                    continue
+                results.append((dn, {attr: list(values) \
+                        for name, (attr, values) in attrs.items() \
+                        if wanted is None or name in wanted}))
+            return results
+
+
+def unescape_filter_value(value):
+    """ Turn the escaped chars (ie: '\\2a') of a filter value back """
+    return re.sub(r'\\([0-9a-fA-F]{2})', \
+            lambda m: chr(int(m.group(1), 16)), value)
+
+
+def rdn_candidates(filterstr, base, children):
+    """ Get the keys of the children of 'base' a filter could only match
+
+    That's the case of an equality filter, or an OR of them (as used to
+    retrieve many entries at once), on the RDN attribute of the children.
+    Returns None for any other filter.
+    """
+    terms = re.findall(r'\(([^()&|!=]+)=([^()*]*)\)', filterstr)
+    inner = ''.join('({}={})'.format(attr, value) for attr, value in terms)
+    if not terms or not children \
+            or filterstr not in (inner, '(|{})'.format(inner)):
+        return None
+    rdn_attr = next(iter(children)).split('=', 1)[0]
+    if any(attr.lower() != rdn_attr for attr, value in terms):
+        return None
+    return [normalize('{}={},{}'.format(attr, ldap.dn.escape_dn_chars( \
+            unescape_filter_value(value)), base)) for attr, value in terms]
+
+
+def compile_filter(filterstr):
+    """ Turn a (simple) LDAP search filter into a matching function
+
+    Equality, presence, and nested AND/OR/NOT filters are supported.
+    """
+    if not filterstr.startswith('('):
+        filterstr = '(' + filterstr + ')'
+    match, end = parse_filter(filterstr, 0)
+    return match
+
+
+def parse_filter(filterstr, pos):
+    """ Parse the filter found at 'pos', returning (match, end position) """
+    if filterstr[pos] != '(':
+        raise ldap.FILTER_ERROR({'desc': 'Bad search filter'})
+    operator = filterstr[pos + 1]
+    if operator in '&|!':
+        matches = []
+        pos += 2
+        while filterstr[pos] == '(':
+            match, pos = parse_filter(filterstr, pos)
+            matches.append(match)
+        if operator == '&':
+            return (lambda attrs: all(m(attrs) for m in matches)), pos + 1
+        if operator == '|':
+            return (lambda attrs: any(m(attrs) for m in matches)), pos + 1
+        return (lambda attrs: not matches[0](attrs)), pos + 1
+    end = filterstr.index(')', pos)
+    attr, value = filterstr[pos + 1:end].split('=', 1)
+    attr = attr.lower()
+    if value == '*':
+        return (lambda attrs: attr in attrs), end + 1
+    value = unescape_filter_value(value).lower().encode('utf-8')
+    return (lambda attrs: attr in attrs and \
+            any(v.lower() == value for v in attrs[attr][1])), end + 1
+
+
+class FakeLDAPObject:
+    """ Fake LDAP session, answering each operation after 'latency' seconds
+
+    Results are queued by the time they're due, so that asynchronous
+    operations overlap the same way they would against a real server.
+    """
+
+    def __init__(self, directory, latency=0.0):
+        self.directory = directory
+        self.latency = latency
+        self.last_msgid = 0
+        self.due = []
+        self.paged = {}
+
+    def _queue(self, operation, *args):
+        """ Apply an operation and schedule its result """
+        self.last_msgid += 1
+        msgid = self.last_msgid
+        try:
+            rtype, rdata, ctrls = operation(*args)
+            error = None
+        except ldap.LDAPError as err:
+            rtype = rdata = ctrls = None
+            err.args[0]['msgid'] = msgid
+            error = err
+        heapq.heappush(self.due, (time.monotonic() + self.latency, msgid, \
+                rtype, rdata, ctrls, error))
+        return msgid
+
+    def result4(self, msgid=ldap.RES_ANY, all=1, timeout=None, \
+            add_ctrls=0, add_intermediates=0, add_extop=0, \
+            resp_ctrl_classes=None):
+        if msgid == ldap.RES_ANY:
+            if not self.due:
+                raise ldap.TIMEOUT({'desc': 'Nothing in flight'})
+            due = heapq.heappop(self.due)
+        else:
+            due = next(d for d in self.due if d[1] == msgid)
+            self.due.remove(due)
+            heapq.heapify(self.due)
+        ready_at, msgid, rtype, rdata, ctrls, error = due
+        delay = ready_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if error is not None:
+            raise error
+        return rtype, rdata, msgid, ctrls or [], None, None
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None, \
+            resp_ctrl_classes=None):
+        return self.result4(msgid, all, timeout)[:4]
+
+    def result(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        return self.result4(msgid, all, timeout)[:2]
+
+    def add_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        def add():
+            self.directory.add(dn, modlist)
+            return ldap.RES_ADD, [], None
+        return self._queue(add)
+
+    def delete_ext(self, dn, serverctrls=None, clientctrls=None):
+        def delete():
+            self.directory.delete(dn)
+            return ldap.RES_DELETE, [], None
+        return self._queue(delete)
+
+    def modify_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        def modify():
+            self.directory.modify(dn, modlist)
+            return ldap.RES_MODIFY, [], None
+        return self._queue(modify)
+
+    def rename(self, dn, newrdn, newsuperior=None, delold=1, \
+            serverctrls=None, clientctrls=None):
+        def rename():
+            self.directory.rename(dn, newrdn, newsuperior, delold)
+            return ldap.RES_MODRDN, [], None
+        return self._queue(rename)
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', \
+            attrlist=None, attrsonly=0, serverctrls=None, clientctrls=None, \
+            timeout=-1, sizelimit=0):
+        page_controls = [c for c in serverctrls or () \
+                if c.controlType == SimplePagedResultsControl.controlType]
+        def search():
+            if not page_controls:
+                return ldap.RES_SEARCH_RESULT, self.directory.search(base, \
+                        scope, filterstr, attrlist), None
+            # Results are computed once, and then handed over page by page
+            page_control = page_controls[0]
+            if page_control.cookie:
+                results = self.paged.pop(page_control.cookie)
+            else:
+                results = self.directory.search(base, scope, filterstr, \
+                        attrlist)
+            page, results = results[:page_control.size], \
+                    results[page_control.size:]
+            cookie = ''
+            if results:
+                cookie = str(self.last_msgid).encode('ascii')
+                self.paged[cookie] = results
+            return ldap.RES_SEARCH_RESULT, page, [SimplePagedResultsControl( \
+                    False, size=page_control.size, cookie=cookie)]
+        return self._queue(search)
+
+    def add_ext_s(self, *args, **kwargs):
+        return self.result3(self.add_ext(*args, **kwargs))
+
+    def delete_ext_s(self, *args, **kwargs):
+        return self.result3(self.delete_ext(*args, **kwargs))
+
+    def modify_ext_s(self, *args, **kwargs):
+        return self.result3(self.modify_ext(*args, **kwargs))
+
+    def rename_s(self, *args, **kwargs):
+        return self.result3(self.rename(*args, **kwargs))
+
+    def search_ext_s(self, *args, **kwargs):
+        return self.result(self.search_ext(*args, **kwargs))[1]
+
+    add_s = add_ext_s
+    delete_s = delete_ext_s
+    modify_s = modify_ext_s
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)', \
+            attrlist=None, attrsonly=0):
+        return self.search_ext_s(base, scope, filterstr, attrlist, attrsonly)
+
+    def simple_bind_s(self, who=None, cred=None, serverctrls=None, \
+            clientctrls=None):
+        return None
+
+    def set_option(self, option, invalue):
+        pass
+
+    def unbind(self):
+        pass
+
+    unbind_s = unbind
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Benchmark the bulk jobs of tiny-ldap-manager against a fake LDAP server
+
+Every benchmark runs in its own process, against an in-memory directory
+(see fake_ldap) which answers each operation after the given latency. Its
+throughput (entries/sec), CPU time and peak RSS are reported, and compared
+with a baseline of a previous run, if any.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import builtins
+import resource
+import tempfile
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+# Same as when tiny-ldap-manager runs from the repo (see _version)
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, 'tiny_ldap_manager')]
+
+from datasets import generate_datasets
+from datasets import populate
+from datasets import SUFFIX
+from datasets import PEOPLE_DN
+from datasets import SYNC_ADD_RATIO
+from fake_ldap import FakeDirectory
+from fake_ldap import FakeLDAPObject
+from tiny_ldap_manager.tiny_ldap_manager import ldap_action_add_entry
+from tiny_ldap_manager.tiny_ldap_manager import ldap_action_ls
+from tiny_ldap_manager.tlmgr_modify import ldap_modify_bulk
+from tiny_ldap_manager.delete_bulk import ldap_delete_bulk
+from tiny_ldap_manager.tlmgr_ldif import ldap_ldif_bulk
+from tiny_ldap_manager.tlmgr_sync import ldap_sync
+from tiny_ldap_manager.tlmgr_journal import BulkJournal
+
+DEFAULT_SIZES = [10000]
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+# Slowdown (in percent) over the baseline, that is reported as a regression
+DEFAULT_THRESHOLD = 10.0
+# Metrics compared with the baseline, and whether higher values are better
+COMPARED_METRICS = {
+    'entries_per_sec': True,
+    'cpu_seconds': False,
+    'peak_rss_mb': False,
+}
+
+
+def bench_add(pool, data, journal, args):
+    """ Add people from CSV (bulk --add-entries) """
+    ldap_action_add_entry(pool, os.path.join(data, 'people.csv'), journal, \
+            args.window)
+
+
+def bench_modify(pool, data, journal, args):
+    """ Add an attribute to each person (bulk --modify-attributes) """
+    ldap_modify_bulk(pool, os.path.join(data, 'modify.csv'), journal)
+
+
+def bench_modify_wide(pool, data, journal, args):
+    """ Add 5 attributes to each person, at once (bulk --modify-attributes) """
+    ldap_modify_bulk(pool, os.path.join(data, 'modify-wide.csv'), journal)
+
+
+def bench_delete(pool, data, journal, args):
+    """ Delete each person (bulk --delete-entries) """
+    ldap_delete_bulk(pool, os.path.join(data, 'dns.txt'), journal)
+
+
+def bench_delete_recursive(pool, data, journal, args):
+    """ Delete the subtree of people (bulk --delete-entries --recursive) """
+    ldap_delete_bulk(pool, os.path.join(data, 'subtrees.txt'), journal, \
+            True, args.window)
+
+
+def bench_ldif(pool, data, journal, args):
+    """ Add people from LDIF (bulk --ldif) """
+    ldap_ldif_bulk(pool, os.path.join(data, 'people.ldif'), journal, \
+            args.window)
+
+
+def bench_sync(pool, data, journal, args):
+    """ Sync people with a CSV file, which adds and modifies some of them """
+    ldap_sync(pool[0], os.path.join(data, 'sync.csv'), PEOPLE_DN, \
+            window=args.window)
+
+
+def bench_ls(pool, data, journal, args):
+    """ List every person, as CSV (ls --scope sub) """
+    ldap_action_ls(pool[0], PEOPLE_DN, 'sub', output_format='csv', \
+            output_file=os.devnull)
+
+
+# Each benchmark, along with the input file its journal belongs to and how
+# many of the synthetic people are in LDAP beforehand (as a share of them)
+BENCHMARKS = {
+    'add': (bench_add, 'people.csv', 0),
+    'modify': (bench_modify, 'modify.csv', 1),
+    'modify-wide': (bench_modify_wide, 'modify-wide.csv', 1),
+    'delete': (bench_delete, 'dns.txt', 1),
+    'delete-recursive': (bench_delete_recursive, 'subtrees.txt', 1),
+    'ldif': (bench_ldif, 'people.ldif', 0),
+    'sync': (bench_sync, 'sync.csv', 1 - SYNC_ADD_RATIO),
+    'ls': (bench_ls, None, 1),
+}
+
+
+def peak_rss_mb():
+    """ Get the peak RSS of this process so far, in MiB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # It's given in bytes on macOS, and in KiB everywhere else
+    return peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def cpu_seconds():
+    """ Get the CPU time (user + system) used by this process so far """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_benchmark(name, size, data, args):
+    """ Run a single benchmark in this process, returning its results """
+    bench, input_file, populated = BENCHMARKS[name]
+    # Log records are still built and written, just not shown
+    logging.basicConfig(format='%(message)s', level=logging.INFO, \
+            stream=open(os.devnull, 'w'))
+    builtins.input = lambda prompt='': 'YES'
+
+    directory = FakeDirectory(SUFFIX)
+    if populated:
+        populate(directory, size, size - int(size * populated))
+    else:
+        populate(directory, 0)
+    pool = [FakeLDAPObject(directory, args.latency / 1000.0) \
+            for _ in range(args.workers)]
+    journal_dir = tempfile.mkdtemp(prefix='tlmgr-bench-')
+    journal = BulkJournal(os.path.join(journal_dir, 'journal'), \
+            '{} {}'.format(name, input_file))
+
+    cpu_before = cpu_seconds()
+    started = time.monotonic()
+    try:
+        bench(pool, data, journal, args)
+    finally:
+        elapsed = time.monotonic() - started
+        journal.close()
+        shutil.rmtree(journal_dir)
+    return {
+        'entries': size,
+        'seconds': round(elapsed, 3),
+        'entries_per_sec': round(size / max(elapsed, 1e-9), 1),
+        'cpu_seconds': round(cpu_seconds() - cpu_before, 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def spawn_benchmark(name, size, data, args):
+    """ Run a benchmark in a process of its own, so RSS isn't shared """
+    command = [sys.executable, os.path.abspath(__file__), '--child', name, \
+            '--sizes', str(size), '--data-dir', data, \
+            '--latency', str(args.latency), '--workers', str(args.workers), \
+            '--window', str(args.window)]
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True, \
+            universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def compare_with_baseline(results, baseline, threshold):
+    """ Find the metrics that got worse than the baseline by 'threshold' % """
+    regressions = []
+    for key, result in sorted(results.items()):
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = previous.get(metric), result[metric]
+            if not old:
+                continue
+            change = (new - old) * 100.0 / old
+            if (change < -threshold) if higher_is_better else (change > threshold):
+                regressions.append((key, metric, old, new, change))
+    return regressions
+
+
+def load_baseline(baseline_file, settings):
+    """ Load the results of a previous run, if taken with the same settings """
+    try:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+    except IOError:
+        return {}
+    if baseline.get('settings') != settings:
+        logging.warning("WARNING: Baseline %s was taken with different " \
+        "settings (%s): not comparing with it!", baseline_file, \
+        baseline.get('settings'))
+        return {}
+    return baseline.get('results', {})
+
+
+def print_results(results):
+    """ Show the results as a table """
+    print('{:<24} {:>10} {:>14} {:>10} {:>12}'.format('BENCHMARK', \
+            'ENTRIES', 'ENTRIES/SEC', 'CPU (s)', 'PEAK RSS (MB)'))
+    for key, result in results.items():
+        print('{:<24} {:>10} {:>14} {:>10} {:>12}'.format(key, \
+                result['entries'], result['entries_per_sec'], \
+                result['cpu_seconds'], result['peak_rss_mb']))
+
+
+def size_list(value):
+    """ Parse a comma-separated list of dataset sizes """
+    try:
+        sizes = [int(size) for size in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} isn't a list of sizes" \
+                .format(value))
+    if min(sizes) < 1:
+        raise argparse.ArgumentTypeError("sizes must be greater than zero")
+    return sizes
+
+
+def menu_handler():
+    """ Process user's arguments """
+    parser = argparse.ArgumentParser(description='Benchmark the bulk jobs ' \
+            'of tiny-ldap-manager against a fake LDAP server.')
+    parser.add_argument('-b', '--bench', action='append', \
+            choices=list(BENCHMARKS), help='Benchmark to run (may be given ' \
+            'more than once). Every one of them, by default')
+    parser.add_argument('--sizes', type=size_list, default=DEFAULT_SIZES, \
+            help='Comma-separated amounts of entries of the datasets ' \
+            '(default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0, \
+            help='Round-trip time (in milliseconds) of each operation ' \
+            '(default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1, \
+            help='Amount of LDAP sessions (default: %(default)s)')
+    parser.add_argument('--window', type=int, default=32, \
+            help='Operations in flight per session (default: %(default)s)')
+    parser.add_argument('--data-dir', help='Where datasets are written (and ' \
+            'reused from). A temporary directory, by default')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, \
+            help='Results to compare with (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true', \
+            help='Store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, \
+            help='Change (in percent) reported as a regression ' \
+            '(default: %(default)s)')
+    parser.add_argument('--child', choices=list(BENCHMARKS), \
+            help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    """ Run the benchmarks and compare them with the baseline """
+    args = menu_handler()
+    if args.child:
+        result = run_benchmark(args.child, args.sizes[0], args.data_dir, args)
+        print(json.dumps(result))
+        return 0
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+    settings = {'latency': args.latency, 'workers': args.workers, \
+            'window': args.window}
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='tlmgr-datasets-')
+    results = {}
+    try:
+        for size in args.sizes:
+            logging.info("Generating datasets of %s entries...", size)
+            data = generate_datasets(data_dir, size)
+            for name in args.bench or BENCHMARKS:
+                logging.info("Running %s benchmark with %s entries...", \
+                name, size)
+                results['{}/{}'.format(name, size)] = \
+                        spawn_benchmark(name, size, data, args)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir)
+
+    print_results(results)
+    baseline = load_baseline(args.baseline, settings)
+    regressions = compare_with_baseline(results, baseline, args.threshold)
+    for key, metric, old, new, change in regressions:
+        logging.warning("REGRESSION: %s %s went from %s to %s (%+.1f%%)", \
+        key, metric, old, new, change)
+    if args.save_baseline:
+        # Results of benchmarks that weren't run this time are kept
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump({'settings': settings, 'results': baseline}, f, \
+                    indent=2, sort_keys=True)
+        logging.info("Baseline saved to %s", args.baseline)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,34 +17,208 @@
 
 """ LDAP delete in bulk functions for tiny-ldap-manager """
 import logging
+import time
 import ldap
+import ldap.dn
+from ldap.controls import LDAPControl
+from functools import partial
+from tiny_ldap_manager.tlmgr_core import entry_log
 from tiny_ldap_manager.tlmgr_core import ask_user_confirmation
+from tiny_ldap_manager.tlmgr_core import describe_ldap_error
+from tiny_ldap_manager.tlmgr_core import paged_search
+from tiny_ldap_manager.tlmgr_core import server_supports_control
+from tiny_ldap_manager.tlmgr_core import TREE_DELETE_OID
+from tiny_ldap_manager.tlmgr_pipeline import pipeline_operations
+from tiny_ldap_manager.tlmgr_pipeline import delete_operation
+from tiny_ldap_manager.tlmgr_pipeline import DEFAULT_WINDOW
+from tiny_ldap_manager.tlmgr_workers import run_in_workers
+from tiny_ldap_manager.tlmgr_workers import chunked
+from tiny_ldap_manager.tlmgr_journal import journal_outcome
 
-def delete_entries_from_file(ldap_session, txtfile):
-    """ Delete LDAP DNs retrieved from a text file """
+# Outcome of the subtrees which were just partly deleted. It isn't among the
+# failed for good outcomes of the journal, so they're deleted again on resume.
+SUBTREE_INCOMPLETE = 'SUBTREE_INCOMPLETE'
+
+def read_dn_file(txtfile):
+    """ Read DNs from a text file, one at a time """
     with open(txtfile, 'r') as f:
-        target_entries = f.readlines()
-        for each_entry in target_entries:
-            each_entry = each_entry.strip('\n')
-            # Check that DN is both valid and exists
-            if ldap.dn.is_dn(each_entry):
-                try:
-                    ldap_session.delete_s(each_entry)
-                    logging.info("Successfully removed LDAP entry: %s", each_entry)
-                except ldap.NO_SUCH_OBJECT:
-                    logging.warning("ERROR: %s does not exist!", \
-                    each_entry)
+        for each_entry in f:
+            yield each_entry.strip('\n')
+
+
+def delete_entries(ldap_session, target_entries, journal):
+    """ Delete a list of (numbered) LDAP DNs """
+    for record_num, each_entry in target_entries:
+        # Check that DN is both valid and exists
+        if ldap.dn.is_dn(each_entry):
+            try:
+                ldap_session.delete_s(each_entry)
+                entry_log.info("Successfully removed LDAP entry: %s", each_entry)
+                journal.record(record_num)
+            except ldap.NO_SUCH_OBJECT as err:
+                logging.warning("ERROR: %s does not exist!", \
+                each_entry)
+                journal.record(record_num, journal_outcome(err))
+            except ldap.SERVER_DOWN:
+                raise
+            except ldap.LDAPError as err:
+                # ie: NOT_ALLOWED_ON_NONLEAF, for entries with children
+                logging.warning("ERROR: Failed to remove LDAP entry: %s. %s", \
+                each_entry, describe_ldap_error(err))
+                journal.record(record_num, journal_outcome(err))
+        else:
+            logging.warning("ERROR: %s is not a valid DN !.", \
+            each_entry)
+            journal.record(record_num, 'INVALID_DN')
+
+
+def collect_subtree_levels(ldap_session, basedn):
+    """ Retrieve every DN of a subtree, grouped by depth, deepest first """
+    levels = {}
+    # No attributes are needed, just the DNs! They're read from the primary
+    # server, since a replica might miss entries which were just added.
+    for dn, attrs in paged_search(ldap_session, basedn, ldap.SCOPE_SUBTREE, \
+            attrlist=['1.1'], primary=True):
+        levels.setdefault(len(ldap.dn.str2dn(dn)), []).append(dn)
+    return [levels[depth] for depth in sorted(levels, reverse=True)]
+
+
+def delete_subtree(ldap_session, basedn, window=DEFAULT_WINDOW):
+    """ Delete an LDAP entry, along with every entry below it
+
+    If the server supports the Tree Delete control, the whole subtree is
+    deleted by the server itself, with a single request. Otherwise, it's
+    done entry by entry.
+
+    Returns the first error found if some entry couldn't be deleted (so the
+    subtree is still there, at least partly), or None.
+    """
+    started = time.monotonic()
+    strategy = "client-side"
+    if server_supports_control(ldap_session, TREE_DELETE_OID):
+        strategy = "server-side (Tree Delete control)"
+        try:
+            delete_subtree_server_side(ldap_session, basedn)
+        except (ldap.UNAVAILABLE_CRITICAL_EXTENSION, ldap.UNWILLING_TO_PERFORM, \
+                ldap.INSUFFICIENT_ACCESS) as err:
+            logging.warning("Server-side deletion of %s failed: %s. Falling " \
+            "back to client-side deletion!", basedn, describe_ldap_error(err))
+            strategy = "client-side"
+    error = None
+    if strategy == "client-side":
+        error = delete_subtree_client_side(ldap_session, basedn, window)
+    if error is not None:
+        logging.critical("ERROR: Subtree of %s wasn't completely deleted " \
+        "(%s strategy): %s", basedn, strategy, describe_ldap_error(error))
+        return error
+    logging.info("Subtree of %s deleted using the %s strategy, in %.2f " \
+    "seconds", basedn, strategy, time.monotonic() - started)
+    return None
+
+
+def delete_subtree_server_side(ldap_session, basedn):
+    """ Delete a whole subtree with a single request, using Tree Delete """
+    tree_delete = LDAPControl(TREE_DELETE_OID, True, None)
+    ldap_session.delete_ext_s(basedn, serverctrls=[tree_delete])
+    entry_log.info("Successfully removed LDAP entry, along with every entry " \
+    "below it: %s", basedn)
+
+
+def delete_subtree_client_side(ldap_session, basedn, window=DEFAULT_WINDOW):
+    """ Delete a whole subtree, entry by entry
+
+    Entries are deleted level by level, starting with the deepest one, since
+    an entry can't be removed while it still has children. Deletes within
+    each level are sent asynchronously.
+
+    Returns the first error found if some entry couldn't be deleted, or None.
+    """
+    levels = collect_subtree_levels(ldap_session, basedn)
+    removed = 0
+    failed = 0
+    first_error = None
+    for level in levels:
+        operations = (delete_operation(dn) for dn in level)
+        for dn, error in pipeline_operations(ldap_session, operations, window):
+            if error is None:
+                removed += 1
+                entry_log.info("Successfully removed LDAP entry: %s", dn)
             else:
-                logging.warning("ERROR: %s is not a valid DN !.", \
+                failed += 1
+                first_error = first_error or error
+                logging.warning("ERROR: Failed to remove LDAP entry: %s. %s", \
+                dn, describe_ldap_error(error))
+    logging.info("Removed %s LDAP entries from the subtree of %s (%s failed)", \
+    removed, basedn, failed)
+    return first_error
+
+
+def delete_subtrees(ldap_session, target_entries, journal, \
+        window=DEFAULT_WINDOW):
+    """ Delete a list of (numbered) LDAP DNs, and every entry below them """
+    for record_num, each_entry in target_entries:
+        if ldap.dn.is_dn(each_entry):
+            try:
+                error = delete_subtree(ldap_session, each_entry, window)
+            except ldap.NO_SUCH_OBJECT as err:
+                logging.warning("ERROR: %s does not exist!", \
                 each_entry)
+                journal.record(record_num, journal_outcome(err))
+                continue
+            except ldap.SERVER_DOWN:
+                raise
+            except ldap.LDAPError as err:
+                logging.warning("ERROR: Failed to remove LDAP entry: %s. %s", \
+                each_entry, describe_ldap_error(err))
+                journal.record(record_num, journal_outcome(err))
+                continue
+            if error is None:
+                journal.record(record_num)
+            else:
+                # Some entries of the subtree were left behind, so it's
+                # deleted again when the job is resumed
+                journal.record(record_num, SUBTREE_INCOMPLETE)
+        else:
+            logging.warning("ERROR: %s is not a valid DN !.", \
+            each_entry)
+            journal.record(record_num, 'INVALID_DN')
 
 
-def ldap_delete_bulk(ldap_session, txtfile):
+def delete_entries_from_file(ldap_pool, txtfile, journal, recursive=False, \
+        window=DEFAULT_WINDOW):
+    """ Delete LDAP DNs retrieved from a text file """
+    delete_func = partial(delete_entries, journal=journal)
+    if recursive:
+        delete_func = partial(delete_subtrees, journal=journal, window=window)
+    # DNs are split in chunks, which are shared among the sessions of the pool
+    for _ in run_in_workers(ldap_pool, delete_func, \
+            chunked(journal.pending(read_dn_file(txtfile)))):
+        pass
+
+
+def ldap_delete_bulk(ldap_pool, txtfile, journal, recursive=False, \
+        window=DEFAULT_WINDOW):
     """ Ask user confirmation and invoke function to delete entries in bulk """
     logging.info("WARNING: You are about to delete LDAP entries specified in " \
     "the following file:\n\n %s\n", txtfile)
+    if recursive:
+        logging.info("Every entry below each of them will be deleted, too!\n")
     if ask_user_confirmation():
         try:
-            delete_entries_from_file(ldap_session, txtfile)
+            delete_entries_from_file(ldap_pool, txtfile, journal, recursive, \
+                    window)
         except IOError:
             logging.critical("\nERROR: file %s not found!", txtfile)
+
+
+def ldap_delete_recursive(ldap_session, delete_dn, window=DEFAULT_WINDOW):
+    """ Delete an LDAP entry, along with every entry below it
+
+    Returns 1 if the subtree couldn't be completely deleted, or 0.
+    """
+    logging.info("\nWARNING: you are about to delete the " \
+    "following LDAP entry, AND every entry below it:\n\n %s\n", delete_dn)
+    if ask_user_confirmation():
+        if delete_subtree(ldap_session, delete_dn, window) is not None:
+            return 1
+    return 0
@@ -16,22 +16,70 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from sys import exit
+from functools import partial
+import os
 import argparse
 import logging
 import ldap
-import ldap.modlist as modlist
 from _version import __version__
+from tiny_ldap_manager.tlmgr_core import entry_log
 from tiny_ldap_manager.tlmgr_core import start_ldap_session
+from tiny_ldap_manager.tlmgr_core import start_ldap_pool
 from tiny_ldap_manager.tlmgr_core import retrieve_attrs_from_dn
+from tiny_ldap_manager.tlmgr_core import search_entry
+from tiny_ldap_manager.tlmgr_core import build_entry_cache
+from tiny_ldap_manager.tlmgr_core import grow_ldap_pool
+from tiny_ldap_manager.tlmgr_core import load_ldap_credentials
+from tiny_ldap_manager.tlmgr_core import ask_ldap_credentials
+from tiny_ldap_manager.tlmgr_core import start_replicas
+from tiny_ldap_manager.tlmgr_core import set_confirmation_answer
+from tiny_ldap_manager.tlmgr_core import DEFAULT_CACHE_SIZE
+from tiny_ldap_manager.tlmgr_core import paged_search
+from tiny_ldap_manager.tlmgr_core import LDAP_SCOPES
+from tiny_ldap_manager.tlmgr_core import DEFAULT_PAGE_SIZE
+from tiny_ldap_manager.tlmgr_output import write_entries
+from tiny_ldap_manager.tlmgr_output import OUTPUT_WRITERS
 from tiny_ldap_manager.tlmgr_core import ask_user_confirmation
 from tiny_ldap_manager.tlmgr_core import ldap_delete_single_dn
+from tiny_ldap_manager.tlmgr_core import describe_ldap_error
 from tiny_ldap_manager.delete_bulk import ldap_delete_bulk
+from tiny_ldap_manager.delete_bulk import ldap_delete_recursive
+from tiny_ldap_manager.tlmgr_ldif import ldap_ldif_bulk
+from tiny_ldap_manager.tlmgr_sync import ldap_sync
 from tiny_ldap_manager.tlmgr_modify import ldap_replace_attr
 from tiny_ldap_manager.tlmgr_modify import ldap_add_attr
 from tiny_ldap_manager.tlmgr_modify import ldap_delete_attr
 from tiny_ldap_manager.tlmgr_modify import ldap_modify_bulk
-from tiny_ldap_manager.tlmgr_csv import read_csv
-from tiny_ldap_manager.tlmgr_csv import process_each_csv_entry
+from tiny_ldap_manager.tlmgr_csv import process_csv_entries
+from tiny_ldap_manager.tlmgr_csv import read_csv_dns
+from tiny_ldap_manager.tlmgr_csv import DEFAULT_MULTI_VALUE_SEPARATOR
+from tiny_ldap_manager.tlmgr_pipeline import pipeline_operations
+from tiny_ldap_manager.tlmgr_pipeline import add_operation
+from tiny_ldap_manager.tlmgr_pipeline import DEFAULT_WINDOW
+from tiny_ldap_manager.tlmgr_workers import run_in_workers
+from tiny_ldap_manager.tlmgr_workers import DEFAULT_CHUNK_SIZE
+from tiny_ldap_manager.tlmgr_journal import open_bulk_journal
+from tiny_ldap_manager.tlmgr_journal import journal_outcome
+from tiny_ldap_manager.tlmgr_order import AddOrder
+from tiny_ldap_manager.tlmgr_order import build_parent_index
+from tiny_ldap_manager.tlmgr_session import log_retry_counts
+from tiny_ldap_manager.tlmgr_throttle import build_write_throttle
+from tiny_ldap_manager.tlmgr_metrics import start_metrics
+from tiny_ldap_manager.tlmgr_metrics import print_metrics_summary
+from tiny_ldap_manager.tlmgr_throttle import DEFAULT_TARGET_LATENCY
+from tiny_ldap_manager.tlmgr_validate import validate_bulk_file
+from tiny_ldap_manager.tlmgr_batch import run_batch
+from tiny_ldap_manager.tlmgr_batch import STDIN_SCRIPT
+from tiny_ldap_manager.tlmgr_mirror import mirror_ldap_entries
+from tiny_ldap_manager.tlmgr_mirror import search_mirror
+from tiny_ldap_manager.tlmgr_mirror import compile_filter
+from tiny_ldap_manager.tlmgr_mirror import default_mirror_file
+from tiny_ldap_manager.tlmgr_mirror import MIRROR_MODES
+from tiny_ldap_manager.tlmgr_mirror import DEFAULT_POLL_INTERVAL
+from tiny_ldap_manager.tlmgr_passwords import hash_passwords
+from tiny_ldap_manager.tlmgr_passwords import PASSWORD_SCHEMES
+from tiny_ldap_manager.tlmgr_replicas import log_replica_reads
+from tiny_ldap_manager.tlmgr_replicas import DEFAULT_REPLICA_WAIT
 
 
 def main():
@@ -39,42 +87,92 @@ def main():
     # Setup logging
     logging.basicConfig(format='%(message)s', level=logging.INFO)
 
-    menu = menu_handler()
-    args = menu[0]
-    # Invoke sub-commands in argparse
-    ldap_ls = menu[1].choices['ls']
-    ldap_modify = menu[1].choices['modify']
-    ldap_delete = menu[1].choices['delete']
-    ldap_bulk = menu[1].choices['bulk']
+    args = menu_handler()
+    if args.action is None:
+        logging.critical("You need to provide at least one action to perform!")
+        exit(0)
+    try:
+        creds = load_ldap_credentials(args.password_file, args.password_env)
+    except ValueError as err:
+        logging.critical("\nERROR: Can't load LDAP credentials: %s", err)
+        exit(1)
+    if args.yes:
+        set_confirmation_answer(True)
+    local = args.action == "ls" and args.local
 
+    entry_cache = build_entry_cache(args.cache_size, args.cache_ttl)
     try:
-        if args.action == "ls":
-            ldap_session = start_ldap_session(args.SERVER, args.BINDDN)
-            ldap_ls.set_defaults(func=ldap_action_ls(ldap_session, args.basedn))
-        elif args.action == "modify":
-            ldap_session = start_ldap_session(args.SERVER, args.BINDDN)
-            ldap_modify.set_defaults(func=ldap_action_modify(ldap_session, \
-                args.modify_dn, args.target_attr, args.new_value, \
-                args.modifymode))
-        elif args.action == "delete":
-            ldap_session = start_ldap_session(args.SERVER, args.BINDDN)
-            ldap_delete.set_defaults(func=ldap_action_delete(ldap_session, \
-                args.delete_dn))
+        if creds is None and not local:
+            # Asked just once, for every server (and session) of the run
+            creds = ask_ldap_credentials(args.BINDDN)
+        if local:
+            # Answered from the mirror, without connecting to the server
+            ldap_pool = []
         elif args.action == "bulk":
-            ldap_session = start_ldap_session(args.SERVER, args.BINDDN)
-            ldap_bulk.set_defaults(func=ldap_action_bulk(ldap_session, \
-                args))
+            ldap_pool = start_ldap_pool(args.SERVER, args.BINDDN, args.workers, \
+                entry_cache, creds)
         else:
-            logging.critical("You need to provide at least one action to perform!")
-            exit(0)
+            ldap_pool = [start_ldap_session(args.SERVER, args.BINDDN, \
+                entry_cache, creds)]
+        try:
+            if args.replica and ldap_pool:
+                for ldap_session in ldap_pool:
+                    start_replicas(ldap_session, args.replica, args.BINDDN, \
+                        creds, args.read_your_writes, args.replica_wait)
+            if args.action == "batch":
+                status = ldap_action_batch(ldap_pool, args, creds)
+            else:
+                status = run_ldap_action(ldap_pool, args)
+        finally:
+            if ldap_pool:
+                logging.info("\n\nClosing connection!\n")
+            for ldap_session in ldap_pool:
+                if ldap_session.replicas is not None:
+                    ldap_session.replicas.unbind()
+                ldap_session.unbind()
     except (KeyboardInterrupt, ldap.SERVER_DOWN, ldap.UNWILLING_TO_PERFORM, \
             ldap.INVALID_CREDENTIALS, ldap.INVALID_DN_SYNTAX, \
         ldap.NO_SUCH_OBJECT) as e:
         exit(e)
+    if status:
+        exit(status)
+
+
+def run_ldap_action(ldap_pool, args):
+    """ Perform the action given by the (already parsed) arguments
+
+    The sessions of the pool are kept open afterwards. Returns the exit
+    status of the action (0 or None if it succeeded).
+    """
+    if args.action == "ls" and args.local:
+        return ldap_action_ls_local(args.SERVER, args.basedn, args.scope, \
+            args.filter, args.attrs, args.output, args.output_file, \
+            args.mirror_file)
+    elif args.action == "ls":
+        return ldap_action_ls(ldap_pool[0], args.basedn, args.scope, \
+            args.filter, args.attrs, args.page_size, args.output, \
+            args.output_file)
+    elif args.action == "modify":
+        return ldap_action_modify(ldap_pool[0], args.modify_dn, \
+            args.target_attr, args.new_value, args.modifymode)
+    elif args.action == "delete":
+        return ldap_action_delete(ldap_pool[0], args.delete_dn, \
+            args.recursive, args.window)
+    elif args.action == "bulk":
+        return ldap_action_bulk(ldap_pool, args)
+    elif args.action == "sync":
+        return ldap_action_sync(ldap_pool[0], args)
+    elif args.action == "mirror":
+        return ldap_action_mirror(ldap_pool[0], args)
 
 
 def menu_handler():
     """ Menu arguments handling """
+    return build_menu_parser().parse_args()
+
+
+def build_menu_parser():
+    """ Build the parser of the arguments, for every action """
     parser = argparse.ArgumentParser(
         description="Easily perform several LDAP operations")
     parser.add_argument('SERVER', help='URI formatted address of the LDAP server')
@@ -82,12 +180,55 @@ def menu_handler():
     parser.add_argument('-v', '--version', action='version', \
     version="%(prog)s {version}".format(version=__version__), \
     help='Show current version')
+    parser.add_argument('--cache-size', type=non_negative_int, \
+            default=DEFAULT_CACHE_SIZE, help="Max. amount of LDAP entries " \
+            "kept in the entry cache, 0 to disable it (default: %(default)s)")
+    parser.add_argument('--cache-ttl', type=positive_int, \
+            help="Seconds an LDAP entry is kept in the entry cache (default: " \
+            "until it's changed or evicted)")
+    creds = parser.add_mutually_exclusive_group()
+    creds.add_argument('--password-file', \
+            help="Read the LDAP credentials from (the first line of) this " \
+            "file, instead of asking for them")
+    creds.add_argument('--password-env', metavar='VARIABLE', \
+            help="Read the LDAP credentials from this environment variable, " \
+            "instead of asking for them")
+    parser.add_argument('--replica', metavar='URI', action='append', \
+            help="URI formatted address of a read replica of SERVER, which " \
+            "takes reads while writes go to SERVER (can be given many times)")
+    parser.add_argument('--read-your-writes', action='store_true', \
+            help="Read from a replica only once it has the writes already " \
+            "made, as told by its contextCSN")
+    parser.add_argument('--replica-wait', type=non_negative_int, \
+            default=DEFAULT_REPLICA_WAIT, \
+            help="Seconds a replica is given to catch up with the writes " \
+            "made, before reading from SERVER instead (default: %(default)s)")
+    parser.add_argument('-y', '--yes', action='store_true', \
+            help="Don't ask for confirmation before changing LDAP entries")
     # LDAP subparser for operations available to perform
     subparser = parser.add_subparsers(dest='action')
     # List LDAP attributes from DN!
     ldap_ls = subparser.add_parser('ls', \
             help='List LDAP attributes for specified DN')
     ldap_ls.add_argument('basedn')
+    ldap_ls.add_argument('-s', '--scope', choices=list(LDAP_SCOPES), \
+            default='base', help="Search scope (default: %(default)s)")
+    ldap_ls.add_argument('-f', '--filter', default='(objectClass=*)', \
+            help="LDAP search filter (default: %(default)s)")
+    ldap_ls.add_argument('-a', '--attrs', type=attr_list, \
+            help="Comma separated list of attributes to show")
+    ldap_ls.add_argument('--page-size', type=positive_int, \
+            default=DEFAULT_PAGE_SIZE, \
+            help="Amount of entries retrieved per page (default: %(default)s)")
+    ldap_ls.add_argument('-o', '--output', choices=list(OUTPUT_WRITERS), \
+            default='text', help="Output format (default: %(default)s)")
+    ldap_ls.add_argument('--output-file', \
+            help="Write entries to this file, instead of the standard output")
+    ldap_ls.add_argument('--local', action='store_true', \
+            help="Search the local mirror (see mirror), instead of the server")
+    ldap_ls.add_argument('--mirror-file', \
+            help="File of the local mirror (default: one for each server, " \
+            "in ~/.tiny-ldap-manager)")
     # Modify existing LDAP attributes
     ldap_modify = subparser.add_parser('modify', \
             help="Modify an LDAP attribute")
@@ -100,6 +241,11 @@ def menu_handler():
     # Delete an LDAP entry!
     ldap_delete = subparser.add_parser('delete', help="Delete an LDAP entry")
     ldap_delete.add_argument("delete_dn", help="DN of the entry to be removed")
+    ldap_delete.add_argument('-r', '--recursive', action='store_true', \
+            help="Delete every entry below the DN, too")
+    ldap_delete.add_argument('--window', type=positive_int, \
+            default=DEFAULT_WINDOW, \
+            help="Max. amount of LDAP operations in flight (default: %(default)s)")
     # Usage of argparse's mutually exclusive group for LDAP operations in bulk!
     bulk = subparser.add_parser('bulk', help='Perform an LDAP operation in bulk')
     gbulk = bulk.add_mutually_exclusive_group(required=True)
@@ -109,24 +255,171 @@ def menu_handler():
     gbulk.add_argument('--add-entries')
     # Delete LDAP entries in bulk
     gbulk.add_argument('--delete-entries')
+    # Apply the change records of an LDIF file
+    gbulk.add_argument('--ldif')
+    # Delete every entry below each DN, too
+    bulk.add_argument('-r', '--recursive', action='store_true', \
+            help="With --delete-entries, delete every entry below each DN, too")
+    # Amount of asynchronous LDAP operations to keep in flight
+    bulk.add_argument('--window', type=positive_int, default=DEFAULT_WINDOW, \
+            help="Max. amount of LDAP operations in flight (default: %(default)s)")
+    # Syntax of multi-valued attributes in CSV files
+    bulk.add_argument('--multi-value-separator', \
+            default=DEFAULT_MULTI_VALUE_SEPARATOR, \
+            help="Separator of the values of multi-valued CSV columns " \
+            "(default: %(default)s)")
+    bulk.add_argument('--csv-literals', action='store_true', \
+            help="Recognize multiple values written as Python lists in CSV")
+    # Amount of LDAP sessions used in parallel
+    bulk.add_argument('--workers', type=positive_int, default=1, \
+            help="Amount of parallel LDAP sessions to use (default: %(default)s)")
+    # Limits on how fast LDAP writes are sent
+    bulk.add_argument('--max-ops-per-sec', type=positive_int, \
+            help="Max. amount of LDAP writes per second")
+    bulk.add_argument('--adaptive', action='store_true', \
+            help="Adapt the amount of LDAP writes in flight (up to --window) " \
+            "to the latency of the server")
+    bulk.add_argument('--target-latency', type=positive_int, \
+            default=DEFAULT_TARGET_LATENCY, \
+            help="Latency (in ms) not to go over, in adaptive mode " \
+            "(default: %(default)s)")
+    bulk.add_argument('--quiet-entries', action='store_true', \
+            help="Don't show a message for each LDAP entry, but for failures")
+    # Hash cleartext passwords of the entries to be added, on every CPU core
+    bulk.add_argument('--hash-passwords', metavar='SCHEME', \
+            choices=list(PASSWORD_SCHEMES), \
+            help="Hash cleartext userPassword values before adding entries, " \
+            "with one of: %(choices)s")
+    bulk.add_argument('--hash-cost', type=positive_int, \
+            help="Rounds (CRYPT-SHA512) or iterations (PBKDF2-SHA512) of " \
+            "password hashes (default: {} and {}, respectively)".format( \
+            PASSWORD_SCHEMES['CRYPT-SHA512'], PASSWORD_SCHEMES['PBKDF2-SHA512']))
+    bulk.add_argument('--hash-processes', type=positive_int, \
+            help="Processes hashing passwords (default: one per CPU core)")
+    # Check the whole input file beforehand, without changing anything
+    bulk.add_argument('--validate-only', action='store_true', \
+            help="Just check every record of the file (against the server " \
+            "schema, too) and report the problems found")
+    # Journal of the records already processed, to resume interrupted jobs
+    gjournal = bulk.add_mutually_exclusive_group()
+    gjournal.add_argument('--journal', \
+            help="Journal of the bulk job (default: FILE.journal)")
+    gjournal.add_argument('--resume', metavar='JOURNAL', \
+            help="Resume an interrupted bulk job, skipping the records " \
+            "already processed, as told by its journal")
+    # Make LDAP entries match a desired state
+    sync = subparser.add_parser('sync', \
+            help="Sync LDAP entries with the ones of a CSV or LDIF file")
+    sync.add_argument('sync_file', \
+            help="CSV or LDIF (*.ldif) file with the desired LDAP entries")
+    sync.add_argument('-b', '--basedn', \
+            help="Base DN of the entries to sync (default: the one shared by " \
+            "every entry of the file)")
+    sync.add_argument('-f', '--filter', default='(objectClass=*)', \
+            help="LDAP search filter for the entries to sync (default: " \
+            "%(default)s)")
+    sync.add_argument('--delete-extra', action='store_true', \
+            help="Delete LDAP entries which aren't found in the file")
+    sync.add_argument('--window', type=positive_int, default=DEFAULT_WINDOW, \
+            help="Max. amount of LDAP operations in flight (default: %(default)s)")
+    # Limits on how fast LDAP writes are sent
+    sync.add_argument('--max-ops-per-sec', type=positive_int, \
+            help="Max. amount of LDAP writes per second")
+    sync.add_argument('--adaptive', action='store_true', \
+            help="Adapt the amount of LDAP writes in flight (up to --window) " \
+            "to the latency of the server")
+    sync.add_argument('--target-latency', type=positive_int, \
+            default=DEFAULT_TARGET_LATENCY, \
+            help="Latency (in ms) not to go over, in adaptive mode " \
+            "(default: %(default)s)")
+    sync.add_argument('--quiet-entries', action='store_true', \
+            help="Don't show a message for each LDAP entry, but for failures")
+    sync.add_argument('--page-size', type=positive_int, \
+            default=DEFAULT_PAGE_SIZE, \
+            help="Amount of entries retrieved per page (default: %(default)s)")
+    sync.add_argument('--multi-value-separator', \
+            default=DEFAULT_MULTI_VALUE_SEPARATOR, \
+            help="Separator of the values of multi-valued CSV columns " \
+            "(default: %(default)s)")
+    sync.add_argument('--csv-literals', action='store_true', \
+            help="Recognize multiple values written as Python lists in CSV")
+    # Keep a local copy of LDAP entries
+    mirror = subparser.add_parser('mirror', \
+            help="Keep a local copy of the entries below a DN, for 'ls --local'")
+    mirror.add_argument('basedn', help="DN of the entries to mirror")
+    mirror.add_argument('-f', '--filter', default='(objectClass=*)', \
+            help="Mirror just the entries matching this LDAP filter " \
+            "(default: %(default)s)")
+    mirror.add_argument('--mirror-file', \
+            help="File of the local mirror (default: one for each server, " \
+            "in ~/.tiny-ldap-manager)")
+    mirror.add_argument('--mode', choices=MIRROR_MODES, default='auto', \
+            help="Get changes with syncrepl (RFC 4533), by polling " \
+            "modifyTimestamp, or with syncrepl when the server supports it " \
+            "(default: %(default)s)")
+    mirror.add_argument('--follow', action='store_true', \
+            help="Keep the mirror up to date until interrupted")
+    mirror.add_argument('--interval', type=positive_int, \
+            default=DEFAULT_POLL_INTERVAL, \
+            help="Seconds between polls, when following changes in poll " \
+            "mode (default: %(default)s)")
+    mirror.add_argument('--page-size', type=positive_int, \
+            default=DEFAULT_PAGE_SIZE, \
+            help="Amount of entries retrieved per page (default: %(default)s)")
+    # Run many actions on a single LDAP session
+    batch = subparser.add_parser('batch', \
+            help="Run many actions, read from a file, on a single LDAP session")
+    batch.add_argument('script', nargs='?', default=STDIN_SCRIPT, \
+            help="File with an action per line, written as on the command " \
+            "line or as a JSON array (default: the standard input)")
+    batch.add_argument('--stop-on-error', action='store_true', \
+            help="Don't run any more actions once one of them fails")
+    return parser
 
-    args = parser.parse_args()
-    return args, subparser
 
+def positive_int(value):
+    """ Argparse type for options which require a positive integer """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive integer!".format(value))
+    return number
+
+
+def non_negative_int(value):
+    """ Argparse type for options which require zero or a positive integer """
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise argparse.ArgumentTypeError("{} is not a non-negative integer!" \
+                .format(value))
+    return number
 
-def ldap_action_ls(ldap_session, basedn):
-    """ Show attributes for specified DN """
-    logging.info("\nShowing  attributes for %s:\n\n", basedn)
-    attrs = retrieve_attrs_from_dn(ldap_session, basedn)
-    logging.info("ATTRIBUTE\t\t\t\t\tVALUE\n")
-    for key, value in attrs[0].items():
-        # Deal with attributes with multiple values!
-        if len(value) > 1:
-            for v in value:
-                print("{:<40} :\t{}".format(key, v.decode()))
-        else:
-            print("{:<40} :\t{}".format(key, value[0].decode()))
-    ldap_session.unbind()
+
+def attr_list(value):
+    """ Argparse type for a comma separated list of LDAP attributes """
+    return [attr.strip() for attr in value.split(',') if attr.strip()]
+
+
+def ldap_action_ls(ldap_session, basedn, scope='base', \
+        filterstr='(objectClass=*)', attrlist=None, page_size=DEFAULT_PAGE_SIZE, \
+        output_format='text', output_file=None):
+    """ Show attributes for specified DN, or for the entries below it """
+    if output_format == 'text':
+        logging.info("\nShowing  attributes for %s:\n\n", basedn)
+        logging.info("ATTRIBUTE\t\t\t\t\tVALUE\n")
+    if scope == 'base' and filterstr == '(objectClass=*)':
+        # A single entry, which might be in the entry cache already
+        entries = search_entry(ldap_session, basedn, attrlist)
+    else:
+        # Entries are written as they arrive, page by page
+        entries = paged_search(ldap_session, basedn, LDAP_SCOPES[scope], \
+                filterstr, attrlist, page_size)
+    write_entries(entries, output_format, output_file, attrlist)
 
 
 def ldap_action_modify(ldap_session, dn, attr, new_value, add_mode):
@@ -146,6 +439,7 @@ def ldap_action_modify(ldap_session, dn, attr, new_value, add_mode):
         if current_attr_value == new_attr_value:
             logging.critical("\nERROR: Existing value for attribute %s and the " \
             "new one, can't be the same!\n", attr)
+            return 1
         else:
             # Modify the existing attribute
             ldap_replace_attr(ldap_session, attrs, attr, dn, new_value)
@@ -158,50 +452,264 @@ def ldap_action_modify(ldap_session, dn, attr, new_value, add_mode):
         logging.critical("\nERROR: Invalid modify mode or conflict exists " \
         "in DN %s with attribute %s!.\n Please, verify and try again!\n", \
         dn, attr)
-    logging.info("\n\nClosing connection!\n")
-    ldap_session.unbind()
+        return 1
 
 
-def ldap_action_delete(ldap_session, delete_dn):
+def ldap_action_delete(ldap_session, delete_dn, recursive=False, \
+        window=DEFAULT_WINDOW):
     """ Delete an LDAP entry """
     logging.info("\n##### Please, remember to have a working BACKUP of your " \
     "LDAP database, prior to ANY modification!! #####\n")
+    if recursive:
+        return ldap_delete_recursive(ldap_session, delete_dn, window)
     ldap_delete_single_dn(ldap_session, delete_dn)
-    logging.info("\n\nClosing connection!\n")
-    ldap_session.unbind()
 
 
-def ldap_action_add_entry(ldap_session, csv_file):
-    """ Add LDAP entries from CSV """
-    csv_entries = read_csv(csv_file)
+def add_csv_entries(ldap_session, csv_entries, journal, window=DEFAULT_WINDOW, \
+        add_order=None):
+    """ Add already processed (and numbered) CSV entries to LDAP
 
-    ldapdata = [process_each_csv_entry(i) for i in csv_entries]
-    for content in ldapdata:
-        dn = content[0][0]
-        attributes = content[0][1]
-        ldif = modlist.addModlist(attributes)
+    Argument: add_order (an AddOrder, told about the outcome of each entry,
+    if entries are added in dependency order)
+    """
+    # Entries are sent asynchronously, keeping up to 'window' of them in
+    # flight, so the import isn't bound by the round-trip time of each add.
+    operations = (add_operation(dn, attributes, tag=(record_num, dn)) \
+            for record_num, (dn, attributes) in csv_entries)
+    done = 0
+    try:
+        for tag, error in pipeline_operations(ldap_session, operations, window):
+            record_num, dn = tag
+            if error is None:
+                entry_log.info("Adding LDAP entry: %s", dn)
+            elif isinstance(error, ldap.ALREADY_EXISTS):
+                logging.warning("Failed to add LDAP entry: %s. Already exists!", dn)
+            else:
+                logging.critical("Failed to add LDAP entry: %s. %s", dn, \
+                describe_ldap_error(error))
+            if add_order is None:
+                journal.record(record_num, journal_outcome(error))
+            else:
+                add_order.completed(record_num, error)
+            done += 1
+    finally:
+        if add_order is not None and done < len(csv_entries):
+            add_order.abandoned(len(csv_entries) - done)
+
+
+def ldap_action_add_entry(ldap_pool, csv_file, journal, window=DEFAULT_WINDOW, \
+        separator=DEFAULT_MULTI_VALUE_SEPARATOR, literals=False, \
+        hash_scheme=None, hash_cost=None, hash_processes=None):
+    """ Add LDAP entries from CSV
+
+    Argument: hash_scheme (the scheme userPassword values are hashed with,
+    before being sent, if any)
+    """
+    # DNs are parsed once, beforehand, to find out which entries are below
+    # other ones of the same file. Those are held back until their parent is
+    # added, so the file can be in any order.
+    add_order = AddOrder(build_parent_index(read_csv_dns(csv_file, \
+            separator, literals)), journal)
+    # CSV entries are read lazily and split in chunks, which are shared among
+    # the sessions of the pool. Those already added (as told by the journal
+    # of a previous run) are skipped.
+    add_entries = partial(add_csv_entries, journal=journal, window=window, \
+            add_order=add_order)
+    chunk_size = max(window, DEFAULT_CHUNK_SIZE)
+    csv_entries = journal.pending(process_csv_entries(csv_file, separator, \
+            literals))
+    if hash_scheme is not None:
+        csv_entries = hash_passwords(csv_entries, hash_scheme, hash_cost, \
+                hash_processes)
+    for _ in run_in_workers(ldap_pool, add_entries, \
+            add_order.chunks(csv_entries, chunk_size)):
+        pass
+
+
+def set_write_throttle(ldap_pool, args):
+    """ Share the limits on LDAP writes (if any) among the sessions of a pool """
+    throttle = build_write_throttle(args.window, args.max_ops_per_sec, \
+            args.adaptive, args.target_latency)
+    for ldap_session in ldap_pool:
+        ldap_session.throttle = throttle
 
-        try:
-            ldap_session.add_s(dn, ldif)
-            logging.info("Adding LDAP entry: %s", dn)
-        except ldap.ALREADY_EXISTS:
-            logging.warning("Failed to add LDAP entry: %s. Already exists!", dn)
 
+def start_job_metrics(ldap_pool, args):
+    """ Start measuring the LDAP operations of a bulk (or sync) job """
+    if args.quiet_entries:
+        # Messages for each entry aren't even formatted
+        entry_log.setLevel(logging.WARNING)
+    start_metrics(ldap_pool)
 
-def ldap_action_bulk(ldap_session, bulk_action):
+
+def ldap_action_bulk(ldap_pool, bulk_action):
     """ Perform an LDAP operation in bulk """
     args = bulk_action
-    if args.modify_attributes:
-        csv_file = args.modify_attributes
-        ldap_modify_bulk(ldap_session, csv_file)
-    elif args.add_entries:
-        csv_file = args.add_entries
-        ldap_action_add_entry(ldap_session, csv_file)
-    elif args.delete_entries:
-        txt_file=args.delete_entries
-        ldap_delete_bulk(ldap_session, txt_file)
-    logging.info("\n\nClosing connection!\n")
-    ldap_session.unbind()
+    for action in ('modify_attributes', 'add_entries', 'delete_entries', 'ldif'):
+        input_file = getattr(args, action)
+        if input_file:
+            break
+    if args.validate_only:
+        problems = validate_bulk_file(ldap_pool[0], action.replace('_', '-'), \
+                input_file, args.multi_value_separator, args.csv_literals)
+        return 1 if problems else 0
+    if args.hash_passwords and not args.add_entries:
+        logging.warning("\nWARNING: Passwords are only hashed when adding " \
+        "entries (--add-entries)!")
+    set_write_throttle(ldap_pool, args)
+    start_job_metrics(ldap_pool, args)
+    # Every bulk job keeps a journal of the records already processed
+    job = "{} {}".format(action.replace('_', '-'), os.path.abspath(input_file))
+    try:
+        journal = open_bulk_journal(input_file, job, args.journal, args.resume)
+    except (IOError, ValueError) as err:
+        logging.critical("\nERROR: Can't use the journal of the bulk job: %s", \
+        err)
+        return 1
+    try:
+        if args.modify_attributes:
+            csv_file = args.modify_attributes
+            ldap_modify_bulk(ldap_pool, csv_file, journal, \
+                args.multi_value_separator)
+        elif args.add_entries:
+            csv_file = args.add_entries
+            ldap_action_add_entry(ldap_pool, csv_file, journal, args.window, \
+                args.multi_value_separator, args.csv_literals, \
+                args.hash_passwords, args.hash_cost, args.hash_processes)
+        elif args.delete_entries:
+            txt_file=args.delete_entries
+            ldap_delete_bulk(ldap_pool, txt_file, journal, args.recursive, \
+                args.window)
+        elif args.ldif:
+            ldap_ldif_bulk(ldap_pool, args.ldif, journal, args.window)
+    finally:
+        # Even if the job is interrupted, so it can be resumed afterwards
+        journal.close()
+        logging.info("\nJournal of the bulk job: %s", journal.journal_file)
+    log_retry_counts(ldap_pool)
+    log_replica_reads(ldap_pool)
+    if ldap_pool[0].throttle is not None:
+        ldap_pool[0].throttle.log_summary()
+    if ldap_pool[0].entry_cache is not None:
+        ldap_pool[0].entry_cache.log_summary()
+    print_metrics_summary(ldap_pool)
+
+
+def ldap_action_sync(ldap_session, sync_action):
+    """ Make LDAP entries match the ones of a CSV or LDIF file
+
+    Returns 1 if the sync couldn't be done, or some change failed, or 0.
+    """
+    args = sync_action
+    set_write_throttle([ldap_session], args)
+    start_job_metrics([ldap_session], args)
+    status = ldap_sync(ldap_session, args.sync_file, args.basedn, \
+        args.filter, args.delete_extra, args.window, args.page_size, \
+        args.multi_value_separator, args.csv_literals)
+    log_retry_counts([ldap_session])
+    log_replica_reads([ldap_session])
+    if ldap_session.throttle is not None:
+        ldap_session.throttle.log_summary()
+    if ldap_session.entry_cache is not None:
+        ldap_session.entry_cache.log_summary()
+    print_metrics_summary([ldap_session])
+    return status
+
+
+def ldap_action_mirror(ldap_session, mirror_action):
+    """ Keep a local copy of the entries below a DN, for 'ls --local' """
+    args = mirror_action
+    mirror_file = args.mirror_file or default_mirror_file(args.SERVER)
+    mirror_ldap_entries(ldap_session, mirror_file, args.basedn, args.filter, \
+        args.mode, args.follow, args.interval, args.page_size)
+
+
+def ldap_action_ls_local(server, basedn, scope='base', \
+        filterstr='(objectClass=*)', attrlist=None, output_format='text', \
+        output_file=None, mirror_file=None):
+    """ Show entries the way 'ls' does, but taken from the local mirror """
+    mirror_file = mirror_file or default_mirror_file(server)
+    if not os.path.isfile(mirror_file):
+        logging.critical("\nERROR: There's no mirror at %s! Take one with " \
+        "the mirror action first.", mirror_file)
+        return 1
+    try:
+        compile_filter(filterstr)
+    except ValueError as err:
+        logging.critical("\nERROR: Can't search the mirror: %s", err)
+        return 1
+    if output_format == 'text':
+        logging.info("\nShowing  attributes for %s (from %s):\n\n", basedn, \
+        mirror_file)
+        logging.info("ATTRIBUTE\t\t\t\t\tVALUE\n")
+    entries = search_mirror(mirror_file, basedn, LDAP_SCOPES[scope], \
+            filterstr, attrlist)
+    write_entries(entries, output_format, output_file, attrlist)
+
+
+def reset_job_state(ldap_pool):
+    """ Forget the limits and metrics of a job, once it's done
+
+    So that they don't apply to the actions run afterwards, on the same
+    sessions (see batch).
+    """
+    for ldap_session in ldap_pool:
+        ldap_session.throttle = None
+        ldap_session.metrics = None
+    entry_log.setLevel(logging.NOTSET)
+
+
+def ldap_action_batch(ldap_pool, batch_action, creds):
+    """ Run many actions, read from a batch script, on the same LDAP session
+
+    Sessions needed by bulk jobs with many workers are added to the pool as
+    they're needed, and kept for the upcoming jobs.
+    """
+    args = batch_action
+    if args.script == STDIN_SCRIPT and not args.yes:
+        # Answers would be read from the script itself!
+        logging.warning("\nWARNING: Actions which ask for confirmation will " \
+        "be canceled, since the batch is read from the standard input. Use " \
+        "--yes to confirm them beforehand.")
+        set_confirmation_answer(False)
+    parser = build_menu_parser()
+
+    def run_action(argv):
+        """ Run a single action of the batch, telling whether it succeeded """
+        try:
+            command = parser.parse_args([args.SERVER, args.BINDDN] + argv)
+        except SystemExit as err:
+            # Wrong arguments (already reported by argparse), or --help
+            return not err.code
+        if command.action in (None, 'batch'):
+            logging.critical("ERROR: Expected one of the actions: ls, " \
+            "modify, delete, bulk, sync or mirror!")
+            return False
+        pool = ldap_pool[:1]
+        if command.action == 'bulk':
+            grow_ldap_pool(ldap_pool, args.SERVER, args.BINDDN, creds, \
+                    command.workers)
+            pool = ldap_pool[:command.workers]
+        try:
+            status = run_ldap_action(pool, command)
+        except SystemExit as err:
+            status = err.code
+        except ldap.LDAPError as err:
+            logging.critical("\nERROR: %s", describe_ldap_error(err))
+            status = 1
+        finally:
+            reset_job_state(pool)
+        return not status
+
+    try:
+        failed = run_batch(args.script, run_action, args.stop_on_error)
+    except IOError as err:
+        logging.critical("\nERROR: Can't read the batch script: %s", err)
+        return 1
+    if ldap_pool[0].entry_cache is not None:
+        ldap_pool[0].entry_cache.log_summary()
+    log_replica_reads(ldap_pool)
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
@@ -0,0 +1,94 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Batch mode: many actions run on a single LDAP session """
+
+import sys
+import json
+import shlex
+import logging
+
+# Name of the batch script which stands for the standard input
+STDIN_SCRIPT = '-'
+
+
+def parse_batch_line(line):
+    """ Split a line of a batch script into the arguments of an action
+
+    A line is either written as on the command line (ie: ls "uid=joe,...")
+    or as a JSON array of strings (ie: ["ls", "uid=joe,..."]), so that JSONL
+    files can be used as batch scripts, too.
+
+    Returns None for blank lines and comments. Raises ValueError if the line
+    can't be split.
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if line.startswith('['):
+        argv = json.loads(line)
+        if not all(isinstance(arg, str) for arg in argv):
+            raise ValueError("expected a JSON array of strings")
+        return argv
+    return shlex.split(line)
+
+
+def read_batch_script(script):
+    """ Read the lines of a batch script, one at a time
+
+    Yields a (line_num, line) tuple for each line, as soon as it's read, so
+    that actions can be piped in by another program.
+    """
+    if script == STDIN_SCRIPT:
+        for line_num, line in enumerate(sys.stdin, 1):
+            yield line_num, line
+        return
+    with open(script, 'r') as f:
+        for line_num, line in enumerate(f, 1):
+            yield line_num, line
+
+
+def run_batch(script, run_action, stop_on_error=False):
+    """ Run every action of a batch script
+
+    Argument: run_action (called with the arguments of each action, it tells
+    whether the action succeeded)
+
+    Returns the amount of actions which failed.
+    """
+    total = failed = 0
+    for line_num, line in read_batch_script(script):
+        try:
+            argv = parse_batch_line(line)
+        except ValueError as err:
+            logging.critical("\nERROR: Line %s: %s", line_num, err)
+            total += 1
+            failed += 1
+        else:
+            if argv is None:
+                continue
+            logging.info("\n>>> Line %s: %s", line_num, \
+            ' '.join(shlex.quote(arg) for arg in argv))
+            total += 1
+            if not run_action(argv):
+                failed += 1
+        if failed and stop_on_error:
+            logging.critical("\nStopping the batch at line %s!", line_num)
+            break
+    logging.info("\nBatch finished: %s actions run, %s of them failed.", \
+    total, failed)
+    return failed
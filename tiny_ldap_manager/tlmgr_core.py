@@ -17,26 +17,286 @@
 
 """ Core helper functions for tiny-ldap-manager """
 
+import os
+import time
 import logging
+import threading
+from collections import OrderedDict
 import ldap
+import ldap.dn
+from ldap.cidict import cidict
+from ldap.filter import escape_filter_chars
+from ldap.controls import SimplePagedResultsControl
 import getpass
+from tiny_ldap_manager.tlmgr_session import ResilientLDAPObject
+from tiny_ldap_manager.tlmgr_session import DEFAULT_MAX_RETRIES
+from tiny_ldap_manager.tlmgr_replicas import ReplicaSet
+from tiny_ldap_manager.tlmgr_replicas import read_with_failover
+from tiny_ldap_manager.tlmgr_replicas import DEFAULT_REPLICA_WAIT
 
-def start_ldap_session(server, binddn):
+# Search scopes, as given by the user
+LDAP_SCOPES = {
+    'base': ldap.SCOPE_BASE,
+    'one': ldap.SCOPE_ONELEVEL,
+    'sub': ldap.SCOPE_SUBTREE,
+}
+
+# Default amount of entries retrieved on each page of a paged search
+DEFAULT_PAGE_SIZE = 500
+
+# Logger of the messages shown for each LDAP entry (see --quiet-entries)
+entry_log = logging.getLogger('tiny_ldap_manager.entries')
+
+# OID of the Tree Delete control, to delete a whole subtree at once
+TREE_DELETE_OID = '1.2.840.113556.1.4.805'
+
+# Answer to every confirmation, when it's not asked for (see --yes)
+confirmation_answer = None
+
+# Default amount of LDAP entries kept in the entry cache
+DEFAULT_CACHE_SIZE = 10000
+# Returned by the entry cache for entries it doesn't have
+CACHE_MISS = object()
+
+
+class EntryCache:
+    """ Bounded LRU cache of LDAP entries, with an optional TTL
+
+    Entries are kept by normalized DN and set of requested attributes, so the
+    same entry is read from LDAP just once, however many times it's needed.
+    The attributes of each entry are kept as a dict, and entries known not to
+    exist are kept as well (as None). Once the cache is
+    full, the least recently used entries are dropped.
+
+    It's shared by every session of a pool, and writes sent through any of
+    them drop the entry written from the cache (see tlmgr_session).
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # {(DN key, attributes key): (retrieved_at, value)}
+        self.entries = OrderedDict()
+        # Attribute keys cached for each DN key, to drop them all at once
+        self.by_dn = {}
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, \
+                'invalidations': 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(dn, attrlist):
+        """ Build the key of a DN and requested attributes (None: all) """
+        try:
+            dn = normalize_dn(dn)
+        except ldap.DECODING_ERROR:
+            # Not worth caching: the server refuses it anyway
+            return None
+        if attrlist is None:
+            return dn, None
+        return dn, frozenset(attr.lower() for attr in attrlist)
+
+    def get(self, dn, attrlist=None):
+        """ Get a cached entry, or CACHE_MISS if it's not (still) cached """
+        key = self.key(dn, attrlist)
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None and self.ttl is not None \
+                    and time.monotonic() - cached[0] > self.ttl:
+                self.drop(key)
+                cached = None
+            if cached is None:
+                self.stats['misses'] += 1
+                return CACHE_MISS
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return cached[1]
+
+    def put(self, dn, attrlist, value):
+        """ Cache an entry, as retrieved from LDAP (None if it's missing) """
+        key = self.key(dn, attrlist)
+        if key is None or not self.max_entries:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            self.by_dn.setdefault(key[0], set()).add(key[1])
+            while len(self.entries) > self.max_entries:
+                self.drop(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    def invalidate(self, dn, subtree=False):
+        """ Drop every cached copy of an entry, since it's being written
+
+        With 'subtree', entries below it are dropped as well (ie: when it's
+        renamed), which takes a look at every cached DN.
+        """
+        key = self.key(dn, None)
+        if key is None:
+            return
+        with self.lock:
+            cached_dns = [key[0]]
+            if subtree:
+                cached_dns.extend(cached_dn for cached_dn in self.by_dn \
+                        if cached_dn.endswith(',' + key[0]))
+            for cached_dn in cached_dns:
+                for attrs_key in self.by_dn.pop(cached_dn, ()):
+                    del self.entries[cached_dn, attrs_key]
+                    self.stats['invalidations'] += 1
+
+    def drop(self, key):
+        """ Drop a single cached entry (the lock must be held) """
+        del self.entries[key]
+        attrs_keys = self.by_dn[key[0]]
+        attrs_keys.discard(key[1])
+        if not attrs_keys:
+            del self.by_dn[key[0]]
+
+    def log_summary(self):
+        """ Show how many entries were read from the cache """
+        logging.info("\nEntry cache: %s hits, %s misses (%s evicted, %s " \
+        "invalidated)", self.stats['hits'], self.stats['misses'], \
+        self.stats['evictions'], self.stats['invalidations'])
+
+
+def start_ldap_session(server, binddn, entry_cache=None, creds=None):
     """ Initiate the LDAP session  """
+    if creds is None:
+        creds = ask_ldap_credentials(binddn)
+    l = bind_ldap_session(server, binddn, creds)
+    logging.info("\nSuccessful LDAP authentication!\n")
+    l.supported_controls = fetch_supported_controls(l)
+    l.entry_cache = entry_cache
+    l.replicas = None
+    return l
+
+
+def start_ldap_pool(server, binddn, size, entry_cache=None, creds=None):
+    """ Initiate a pool of LDAP sessions, asking for credentials only once """
+    if creds is None:
+        creds = ask_ldap_credentials(binddn)
+    ldap_pool = [start_ldap_session(server, binddn, entry_cache, creds)]
+    grow_ldap_pool(ldap_pool, server, binddn, creds, size)
+    return ldap_pool
+
+
+def grow_ldap_pool(ldap_pool, server, binddn, creds, size):
+    """ Add sessions to a pool (of at least one session), up to 'size' """
+    while len(ldap_pool) < size:
+        ldap_session = bind_ldap_session(server, binddn, creds)
+        # They're all connected to the same server, so it's asked just once
+        ldap_session.supported_controls = ldap_pool[0].supported_controls
+        ldap_session.entry_cache = ldap_pool[0].entry_cache
+        ldap_session.replicas = None
+        replicas = ldap_pool[0].replicas
+        if replicas is not None:
+            # Every session reads from replicas through its own connections
+            start_replicas(ldap_session, replicas.uris, binddn, creds, \
+                    replicas.read_your_writes, replicas.max_wait)
+        ldap_pool.append(ldap_session)
+
+
+def start_replicas(ldap_session, uris, binddn, creds, read_your_writes=False, \
+        max_wait=DEFAULT_REPLICA_WAIT):
+    """ Connect an LDAP session to read replicas of its server
+
+    Reads of the session are spread across the replicas from then on, while
+    writes still go to its own server. Replicas that can't be bound are left
+    out.
+    """
+    replicas = []
+    for uri in uris:
+        try:
+            # Failing over is quicker than insisting on a replica
+            replicas.append(bind_ldap_session(uri, binddn, creds, \
+                    max_retries=1))
+        except ldap.LDAPError as err:
+            logging.warning("WARNING: Replica %s left out: %s", uri, \
+            describe_ldap_error(err))
+    ldap_session.replicas = ReplicaSet(ldap_session, uris, replicas, \
+            read_your_writes, max_wait)
+
+
+def build_entry_cache(max_entries, ttl=None):
+    """ Build the entry cache of a run, unless it's disabled (size 0) """
+    if not max_entries:
+        return None
+    return EntryCache(max_entries, ttl)
+
+
+def ask_ldap_credentials(binddn):
+    """ Ask for the credentials of the user to bind the LDAP server """
+    return getpass.getpass('\nPlease, enter LDAP credentials for {}: '.format(binddn))
+
+
+def load_ldap_credentials(password_file=None, password_env=None):
+    """ Load the credentials from a file or environment variable, if given
+
+    Returns None when neither of them is given, so they're asked for instead.
+    Raises ValueError if they can't be loaded.
+    """
+    if password_env:
+        if password_env not in os.environ:
+            raise ValueError("environment variable {} isn't set" \
+                    .format(password_env))
+        return os.environ[password_env]
+    if password_file:
+        try:
+            with open(password_file, 'r') as f:
+                # Just the first line, without its line break
+                return f.readline().rstrip('\r\n')
+        except IOError as err:
+            raise ValueError("can't read {}: {}".format(password_file, \
+                    err.strerror))
+    return None
+
+
+def bind_ldap_session(server, binddn, creds, max_retries=DEFAULT_MAX_RETRIES):
+    """ Open an LDAP connection and bind it with the given credentials """
     ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
     ldap.set_option(ldap.OPT_PROTOCOL_VERSION, ldap.VERSION3)
-    l = ldap.initialize(server, bytes_mode=False)
+    # The session reconnects by itself, whenever the connection is lost
+    l = ResilientLDAPObject(server, max_retries=max_retries, bytes_mode=False)
     l.set_option(ldap.OPT_REFERRALS, 0)
-
-    creds = getpass.getpass('\nPlease, enter LDAP credentials for {}: '.format(binddn))
-    lsession = l.simple_bind_s(binddn, creds)
-    if lsession:
-        logging.info("\nSuccessful LDAP authentication!\n")
+    l.simple_bind_s(binddn, creds)
     return l
 
 
+def fetch_supported_controls(ldap_session):
+    """ Retrieve the OIDs of the controls supported by the server
+
+    They're read from the 'supportedControl' attribute of the root DSE.
+    """
+    try:
+        ldap_data = ldap_session.search_s('', ldap.SCOPE_BASE, \
+                '(objectClass=*)', ['supportedControl'])
+    except ldap.LDAPError:
+        # The root DSE might not be readable at all!
+        return frozenset()
+    supported_controls = set()
+    for dn, attrs in ldap_data:
+        for value in cidict(attrs).get('supportedControl', []):
+            supported_controls.add(value.decode('utf-8'))
+    return frozenset(supported_controls)
+
+
+def server_supports_control(ldap_session, control_oid):
+    """ Check whether the server of an LDAP session supports a control """
+    return control_oid in getattr(ldap_session, 'supported_controls', ())
+
+
+def set_confirmation_answer(answer):
+    """ Answer every confirmation beforehand: True, False or None (ask) """
+    global confirmation_answer
+    confirmation_answer = answer
+
+
 def ask_user_confirmation():
     """ Ask for user confirmation """
+    if confirmation_answer is not None:
+        if not confirmation_answer:
+            logging.info("\nOperation has been canceled, since it can't be " \
+            "confirmed!!\n")
+        return confirmation_answer
     user_confirm = str(input("Are you sure you wanna proceed? (YES/n)"))
     while user_confirm not in("YES", "n"):
         user_confirm = str(input("Not a valid answer!. Proceed? (YES/n)"))
@@ -50,16 +310,174 @@ def ask_user_confirmation():
 
 def retrieve_attrs_from_dn(ldap_session, basedn):
     """ Retrieve attributes from a given DN """
-    ldap_data = ldap_session.search_s(basedn, ldap.SCOPE_BASE, 'objectClass=*')
-    attrs = [i[1] for i in ldap_data]
+    attrs = [i[1] for i in search_entry(ldap_session, basedn)]
     return attrs
 
 
+def search_entry(ldap_session, dn, attrlist=None):
+    """ Retrieve a single LDAP entry, from the entry cache if it's there
+
+    Returns a list with its (dn, attrs) tuple, just like search_s() does
+    (raising NO_SUCH_OBJECT if it doesn't exist).
+    """
+    entry_cache = getattr(ldap_session, 'entry_cache', None)
+    if entry_cache is not None:
+        # The attributes of the entry are cached, as prefetch_attrs() does
+        cached = entry_cache.get(dn, attrlist)
+        if cached is not CACHE_MISS and cached is not None:
+            return [(dn, cached)]
+    ldap_data = read_with_failover(ldap_session, lambda session: \
+            session.search_s(dn, ldap.SCOPE_BASE, '(objectClass=*)', attrlist))
+    # Skip search references!
+    ldap_data = [(entry_dn, attrs) for entry_dn, attrs in ldap_data \
+            if entry_dn is not None]
+    if entry_cache is not None:
+        entry_cache.put(dn, attrlist, ldap_data[0][1] if ldap_data else None)
+    return ldap_data
+
+
+def paged_search(ldap_session, basedn, scope, filterstr='(objectClass=*)', \
+        attrlist=None, page_size=DEFAULT_PAGE_SIZE, primary=False):
+    """ Search LDAP entries, one page at a time
+
+    Uses the Simple Paged Results control (RFC 2696), so that the server sends
+    back the entries in pages of 'page_size' entries. Yields a (dn, attrs)
+    tuple for each entry, as soon as its page arrives.
+
+    Argument: primary (whether to search the server of the session itself,
+    even if it has replicas. Needed when writes are based on what's found,
+    since replicas might be behind)
+    """
+    # Not marked as critical, so that servers that don't support paging
+    # just send every entry at once.
+    page_control = SimplePagedResultsControl(False, size=page_size, cookie='')
+
+    def search_page(session):
+        msgid = session.search_ext(basedn, scope, filterstr, attrlist, \
+                serverctrls=[page_control])
+        return session, session.result3(msgid)
+
+    # Pages can only be retrieved from the server that sent the first one
+    if primary:
+        result = search_page(ldap_session)[1]
+    else:
+        ldap_session, result = read_with_failover(ldap_session, search_page)
+    while True:
+        rtype, rdata, rmsgid, serverctrls = result
+        for dn, attrs in rdata:
+            # Skip search references!
+            if dn is not None:
+                yield dn, attrs
+        # An empty cookie means there are no more pages left
+        cookies = [c.cookie for c in serverctrls \
+                if c.controlType == SimplePagedResultsControl.controlType]
+        if not cookies or not cookies[0]:
+            break
+        page_control.cookie = cookies[0]
+        result = search_page(ldap_session)[1]
+
+
+def normalize_dn(dn):
+    """ Get a normalized form of a DN, suitable for comparing DNs """
+    return ldap.dn.dn2str(ldap.dn.str2dn(dn)).lower()
+
+
+def dn_key(rdns):
+    """ Build a key of an (already parsed) DN, suitable for comparing DNs
+
+    It's much cheaper than normalizing the DN back into a string, while
+    being just as unique.
+    """
+    return '\x00'.join('\x01'.join(attr.lower() + '=' + value.lower() \
+            for attr, value, flags in rdn) for rdn in rdns)
+
+
+def prefetch_attrs(ldap_session, dns, attrlist):
+    """ Retrieve the given attributes from many DNs at once
+
+    Returns a dict, indexed by normalized DN, with the attributes of each of
+    the given DNs that exists. DNs found in the entry cache aren't retrieved
+    again.
+    """
+    entry_cache = getattr(ldap_session, 'entry_cache', None)
+    prefetched = {}
+    # DNs are grouped by their parent entry, so that each group is retrieved
+    # with a single one-level search, whose filter matches the RDN of every
+    # DN in the group.
+    groups = {}
+    for dn in dns:
+        if entry_cache is not None:
+            cached = entry_cache.get(dn, attrlist)
+            if cached is not CACHE_MISS:
+                if cached is not None:
+                    prefetched[normalize_dn(dn)] = cidict(cached)
+                continue
+        rdns = ldap.dn.str2dn(dn)
+        parent = ldap.dn.dn2str(rdns[1:])
+        group = groups.setdefault(parent.lower(), (parent, []))
+        group[1].append((rdns[0], dn))
+
+    for parent, rdns in groups.values():
+        rdn_filters = [rdn_to_filter(rdn) for rdn, dn in rdns]
+        filterstr = '(|{})'.format(''.join(rdn_filters))
+        try:
+            ldap_data = read_with_failover(ldap_session, lambda session: \
+                    session.search_s(parent, ldap.SCOPE_ONELEVEL, filterstr, \
+                    attrlist))
+        except ldap.NO_SUCH_OBJECT:
+            ldap_data = []
+        for dn, attrs in ldap_data:
+            # Skip search references!
+            if dn is not None:
+                prefetched[normalize_dn(dn)] = cidict(attrs)
+        if entry_cache is not None:
+            # DNs that weren't found are cached too, as missing entries
+            for rdn, dn in rdns:
+                attrs = prefetched.get(normalize_dn(dn))
+                entry_cache.put(dn, attrlist, \
+                        None if attrs is None else dict(attrs))
+    return prefetched
+
+
+def update_cached_attrs(ldap_session, prefetched, attrlist):
+    """ Put attributes given by prefetch_attrs() back in the entry cache
+
+    Meant for attributes kept up to date after writing them, so upcoming
+    reads of the same entries don't need to retrieve them again.
+    """
+    entry_cache = getattr(ldap_session, 'entry_cache', None)
+    if entry_cache is not None:
+        for dn, attrs in prefetched.items():
+            entry_cache.put(dn, attrlist, dict(attrs))
+
+
+def rdn_to_filter(rdn):
+    """ Build a search filter matching the given (already parsed) RDN """
+    avas = ['({}={})'.format(attr, escape_filter_chars(value)) \
+            for attr, value, flags in rdn]
+    if len(avas) == 1:
+        return avas[0]
+    return '(&{})'.format(''.join(avas))
+
+
 def ldap_delete_single_dn(ldap_session, delete_dn):
     """ Delete a single LDAP entry based on its DN """
     logging.info("\nWARNING: you are about to delete the " \
     "following LDAP entry:\n\n %s\n", delete_dn)
     if ask_user_confirmation():
-        ldap_session.delete_s(delete_dn)
-        logging.info("\nSuccessfully removed LDAP entry: %s\n", delete_dn)
+        try:
+            ldap_session.delete_s(delete_dn)
+            logging.info("\nSuccessfully removed LDAP entry: %s\n", delete_dn)
+        except ldap.NOT_ALLOWED_ON_NONLEAF:
+            logging.critical("\nERROR: %s has entries below it! Use the " \
+            "--recursive argument to delete them, too.\n", delete_dn)
+
+
+def describe_ldap_error(err):
+    """ Get a human readable description out of an LDAPError """
+    info = err.args[0] if err.args and isinstance(err.args[0], dict) else {}
+    desc = info.get('desc', str(err))
+    if info.get('info'):
+        desc = "{} ({})".format(desc, info['info'])
+    return desc
 
@@ -19,22 +19,36 @@
 
 from sys import exit
 from ast import literal_eval
+from base64 import b64decode
+from functools import partial
 import logging
 import csv
 
-def read_csv(csv_file):
-    """ Read entries from CSV file """
-    entries = []
+# Suffix of the header of CSV columns with multiple values (ie: objectClass[])
+MULTI_VALUE_MARKER = '[]'
+# Suffix of the header of CSV columns whose values are base64 encoded, as in
+# LDIF (ie: jpegPhoto:: or jpegPhoto::[]), which goes before the one above
+BASE64_MARKER = '::'
+# Default separator of the values of a multi-valued CSV column
+DEFAULT_MULTI_VALUE_SEPARATOR = '|'
+
+def read_csv(csv_file, announce=True):
+    """ Read entries from CSV file, one at a time
+
+    Yields a (line_num, entry) tuple for each CSV entry, where 'line_num' is
+    the line of the CSV file where the entry ends.
+    """
     try:
-        logging.info("\nOpening CSV file: %s\n\n", csv_file)
+        if announce:
+            logging.info("\nOpening CSV file: %s\n\n", csv_file)
         with open(csv_file, 'r') as f:
             # csv.DictReader() returns an OrederedDict object
             csv_reader = csv.DictReader(f, delimiter=';')
+            # Entries are handed over as soon as they are read, so that big
+            # CSV files don't have to be loaded in memory all at once.
             for entry in csv_reader:
                 # Convert it to a normal dict!
-                entry = dict(entry)
-                entries.append(entry)
-        return entries
+                yield csv_reader.line_num, dict(entry)
     except IOError:
         logging.critical("Can't read %s file. Make sure it exist!\n", csv_file)
         exit(0)
@@ -53,33 +67,162 @@ def check_csv_literals(element):
     return element
 
 
-def process_each_csv_entry(csv_entry):
+def split_multi_value(value, separator=DEFAULT_MULTI_VALUE_SEPARATOR):
+    """ Split the values of a multi-valued CSV column
+
+    A backslash escapes the separator (or a backslash) within a value.
+    """
+    if not value:
+        return []
+    # Fast path, for values without any escaped character
+    if '\\' not in value:
+        return value.split(separator)
+    values = []
+    current = []
+    chars = iter(value)
+    for char in chars:
+        if char == '\\':
+            current.append(next(chars, '\\'))
+        elif char == separator:
+            values.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    values.append(''.join(current))
+    return values
+
+
+def join_multi_value(values, separator=DEFAULT_MULTI_VALUE_SEPARATOR):
+    """ Join values for a multi-valued CSV column, escaping them as needed """
+    return separator.join(v.replace('\\', '\\\\').replace(separator, \
+            '\\' + separator) for v in values)
+
+
+def parse_column(column):
+    """ Split a CSV header column into its attribute and its markers
+
+    Returns an (attr, is_multi, is_base64) tuple.
+    """
+    is_multi = column.endswith(MULTI_VALUE_MARKER)
+    if is_multi:
+        column = column[:-len(MULTI_VALUE_MARKER)]
+    is_base64 = column.endswith(BASE64_MARKER)
+    if is_base64:
+        column = column[:-len(BASE64_MARKER)]
+    return column, is_multi, is_base64
+
+
+def build_column_plan(columns, separator=DEFAULT_MULTI_VALUE_SEPARATOR, \
+        literals=False):
+    """ Decide once, from the CSV header, how to convert each column
+
+    Returns a list of (column, attr, convert) tuples, where 'convert' turns a
+    CSV value into a list of byte strings, as expected by python-ldap.
+
+    Argument: literals (whether to recognize Python lists on every column,
+    as it used to be done)
+    """
+    column_plan = []
+    for column in columns:
+        if column == 'dn':
+            continue
+        attr, is_multi, is_base64 = parse_column(column)
+        if literals:
+            convert = convert_literal_value
+        elif is_multi:
+            convert = lambda value: [v.encode('utf-8') \
+                    for v in split_multi_value(value, separator)]
+        else:
+            # An empty CSV value means the attribute has no value at all
+            convert = lambda value: [value.encode('utf-8')] if value else []
+        if is_base64:
+            # Binary values (ie: a jpegPhoto), as written by 'ls --output csv'
+            convert = partial(decode_base64_values, convert=convert)
+        column_plan.append((column, attr, convert))
+    return column_plan
+
+
+def decode_base64_values(value, convert):
+    """ Convert a CSV value, decoding each of its values from base64 """
+    return [b64decode(v, validate=True) for v in convert(value)]
+
+
+def convert_literal_value(value):
+    """ Convert a CSV value which may be written as a Python list """
+    element = check_csv_literals(value)
+    # Since we can have a Python list inside a CSV entry, we want to keep
+    # it as it is. However, if it's not a list, we convert each element to
+    # be one! (this is later required for the 'add_s' method of python-ldap).
+    if isinstance(element, list):
+        # Encode each element to a byte str if a list object is found.
+        return [str(i).encode('utf-8') for i in element]
+    # Other literals (ie: numbers) are kept as they were written
+    return [value.encode('utf-8')]
+
+
+def process_each_csv_entry(csv_entry, column_plan):
     """ Process each CSV entry """
     # Each csv_entry is a dict, which contains the attributes of each LDAP
-    # entry to be added, PLUS, the DN!. The 'ldapdata' list, stores the dn and
-    # the attributes as separate elements inside a tuple.
-    ldapdata = []
-    entry_dn = csv_entry['dn']
-    # Since we don't want the dn as part of the attributes, let's remove it
-    if 'dn' in csv_entry:
-        del csv_entry['dn']
-
-    for key, value in csv_entry.items():
-        value = check_csv_literals(value)
-        # Since we can have a Python list inside a CSV entry, we want to keep
-        # it as it is. However, if it's not a list, we convert each element to
-        # be one! (this is later required for the 'add_s' method of python-ldap).
-        if isinstance(value, list):
-            # Encode each element to a byte str if a list object is found.
-            value = [i.encode('utf-8') for i in value]
-            csv_entry[key] = value
-        else:
-            # Convert the attribute's value to a byte string!
-            value = value.encode('utf-8')
-            csv_entry[key] = [value]
+    # entry to be added, PLUS, the DN!. A tuple is returned, which stores the
+    # dn and the attributes (already converted to lists of byte strings) as
+    # separate elements.
+    attributes = {attr: convert(csv_entry[column]) \
+            for column, attr, convert in column_plan}
+    return csv_entry['dn'], attributes
 
-    ldapdata.append((entry_dn, csv_entry))
-    return ldapdata
+
+def is_complete_csv_entry(csv_entry):
+    """ Check whether a CSV entry can be turned into an LDAP entry """
+    # Rows with a missing DN, or with less or more fields than the header
+    # row, can't be turned into an LDAP entry!.
+    return bool(csv_entry.get('dn')) and None not in csv_entry \
+            and None not in csv_entry.values()
+
+
+def read_csv_dns(csv_file, separator=DEFAULT_MULTI_VALUE_SEPARATOR, \
+        literals=False):
+    """ Read the DN of each CSV entry process_csv_entries() hands over
+
+    Function used by: bulk --add-entries
+    """
+    for dn, attributes in convert_csv_entries(csv_file, separator, literals, \
+            verbose=False):
+        yield dn
+
+
+def process_csv_entries(csv_file, separator=DEFAULT_MULTI_VALUE_SEPARATOR, \
+        literals=False):
+    """ Read and process CSV entries for being added, one at a time
+
+    Function used by: bulk --add-entries
+    """
+    return convert_csv_entries(csv_file, separator, literals)
+
+
+def convert_csv_entries(csv_file, separator=DEFAULT_MULTI_VALUE_SEPARATOR, \
+        literals=False, verbose=True):
+    """ Turn CSV entries into (dn, attributes) tuples, skipping wrong ones
+
+    Argument: verbose (whether to tell about the file and the wrong entries)
+    """
+    column_plan = None
+    for line_num, csv_entry in read_csv(csv_file, verbose):
+        if not is_complete_csv_entry(csv_entry):
+            if verbose:
+                logging.warning("ERROR: Wrong CSV formatted content found " \
+                "at line %s!", line_num)
+            continue
+        if column_plan is None:
+            column_plan = build_column_plan(list(csv_entry), separator, literals)
+        try:
+            entry = process_each_csv_entry(csv_entry, column_plan)
+        except ValueError:
+            # ie: a value of a base64 column which isn't base64
+            if verbose:
+                logging.warning("ERROR: Wrong CSV formatted content found " \
+                "at line %s!", line_num)
+            continue
+        yield entry
 
 
 def sanitize_csv_entry(csv_entry):
@@ -90,46 +233,37 @@ def sanitize_csv_entry(csv_entry):
     Function used by: bulk --modify-attributes
     """
     # A sanity check is performed on each CSV entry, each one being represented
-    # as a dict, where: 'k' (key) is the DN and 'v' (value) is the attribute.
-    # For each CSV entry, a True/False value is assigned as a result of having
-    # checked both the DN and the attribute. This is stored in a tuple with the
-    # result for both of them. Later, this is also used for establishing an
-    # overall True/False result. 
+    # as a dict, where: 'k' (key) is the column and 'v' (value) is its value.
+    # Dict containing DN and attribute, should have at least 2 pairs of
+    # key-value. Otherwise, it means an incomplete CSV entry!.
+    result = len(csv_entry) >= 2
+    # Every pair is checked, not just the last one!
     for k, v in csv_entry.items():
-        # Both dn and attribute shouldn't have a 'None' or an empty string as
-        # value. Otherwise, it means an incomplete CSV entry!.
-        check_k = False if k == None or k == '' else True
-        check_v = False if v == None or v == '' else True
-        # Store a True/False result for DN and attribute
-        result = (check_k, check_v)
-    # Dict containing DN and attribute, should have 2 pairs of key-value.
-    # This is an additional check to be sure there isn't an incomplete CSV
-    # entry.
-    if int(len(csv_entry)) < 2:
-        result = (False, False)
-    # If check's result for DN or attribute is False, we assume an overall
-    # False result. 
-    if False in result:
-        result = False
-    else:
-        result = True
-    return result
+        # Neither columns nor values should be missing (ie: rows with less or
+        # more fields than the header row), and the dn can't be empty.
+        # Otherwise, it means an incomplete CSV entry!.
+        if k == None or k == '' or v == None or (k == 'dn' and v == ''):
+            result = False
+            break
+    # Empty values leave their attribute untouched, but at least one
+    # attribute has to be changed!
+    return result and any(v for k, v in csv_entry.items() if k != 'dn')
 
 
 def csv_sanitizer(csv_file):
     """ Evaulate each CSV entry and adds a verification result of its content
 
+    Yields a (line_num, entry, result) tuple for each CSV entry.
+
     Function used by: bulk --modify-attributes
     """
-    sanitized_csv = []
-    csv_data = read_csv(csv_file)
+    is_empty = True
+    for line_num, each_entry in read_csv(csv_file):
+        is_empty = False
+        # Hand over both the CSV entry and the sanity check result.
+        result = sanitize_csv_entry(each_entry)
+        yield line_num, each_entry, result
     # Check it's not an empty file
-    if csv_data:
-        for each_entry in csv_data:
-            # Store both the CSV entry and the sanity check result on a list.
-            result = sanitize_csv_entry(each_entry)
-            sanitized_csv.append((each_entry, result))
-    else:
+    if is_empty:
         logging.info("Empty file or wrong format: nothing to process!\n")
         exit(0)
-    return sanitized_csv
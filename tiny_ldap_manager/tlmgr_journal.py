@@ -0,0 +1,162 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Checkpoint journal of bulk jobs, so they can be resumed """
+
+import os
+import time
+import logging
+import threading
+
+# First line of every journal, followed by the bulk job it belongs to
+JOURNAL_HEADER = '# tiny-ldap-manager journal: '
+# Suffix of the journal file, when no other one is given
+JOURNAL_SUFFIX = '.journal'
+# The journal is synced to disk after this many records, or seconds...
+JOURNAL_SYNC_RECORDS = 1000
+JOURNAL_SYNC_INTERVAL = 1.0
+# Outcomes of the records which were actually processed
+SUCCESS_OUTCOMES = frozenset(('ok', 'ALREADY_EXISTS'))
+# Outcomes of the records which would fail the same way if processed again
+# (ie: the CSV row or the entry itself is wrong). Any other outcome, such as
+# BUSY, UNAVAILABLE, SERVER_DOWN or OperationInterrupted, is transient (or
+# unknown), so those records are processed again when resuming.
+FAILED_OUTCOMES = frozenset(('INVALID_CSV', 'INVALID_DN', \
+        'INVALID_DN_SYNTAX', 'INVALID_SYNTAX', 'UNDEFINED_TYPE', \
+        'OBJECT_CLASS_VIOLATION', 'CONSTRAINT_VIOLATION', 'NAMING_VIOLATION', \
+        'NO_SUCH_OBJECT', 'NOT_ALLOWED_ON_NONLEAF', 'TYPE_OR_VALUE_EXISTS', \
+        'NO_SUCH_ATTRIBUTE'))
+
+
+class BulkJournal:
+    """ Append-only journal of the records already processed by a bulk job
+
+    Each line holds the number of a record (its position in the input file)
+    along with its outcome. When resuming, the numbers of the records which
+    don't need to be processed again are loaded into a bitmap, so that
+    checking whether a record is done costs O(1).
+    """
+
+    def __init__(self, journal_file, job, resume=False):
+        self.journal_file = journal_file
+        self.done = bytearray()
+        self.done_count = 0
+        # Records of a previous run which failed for good
+        self.failed = set()
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.lock = threading.Lock()
+        if resume:
+            self.load(job)
+            self.out = open(journal_file, 'a')
+        else:
+            self.out = open(journal_file, 'w')
+            self.out.write(JOURNAL_HEADER + job + '\n')
+            self.sync()
+
+    def load(self, job):
+        """ Load the records already processed, from an existing journal
+
+        Only records with a successful or a failed for good outcome (see
+        FAILED_OUTCOMES) are taken as done.
+        """
+        with open(self.journal_file, 'r') as f:
+            header = f.readline().rstrip('\n')
+            if header != JOURNAL_HEADER + job:
+                raise ValueError("{} isn't a journal of this bulk job ({})" \
+                        .format(self.journal_file, job))
+            for line in f:
+                fields = line.split()
+                # The last line might be incomplete, after a crash!
+                if len(fields) != 2 or not fields[0].isdigit() \
+                        or not line.endswith('\n'):
+                    continue
+                record_num, outcome = int(fields[0]), fields[1]
+                if outcome in FAILED_OUTCOMES:
+                    self.failed.add(record_num)
+                elif outcome not in SUCCESS_OUTCOMES:
+                    continue
+                self.mark_done(record_num)
+
+    def mark_done(self, record_num):
+        """ Set the bit of a record in the bitmap """
+        index, bit = divmod(record_num, 8)
+        if index >= len(self.done):
+            self.done.extend(bytes(index + 1 - len(self.done)))
+        if not self.done[index] & (1 << bit):
+            self.done[index] |= 1 << bit
+            self.done_count += 1
+
+    def is_done(self, record_num):
+        """ Check whether a record was already processed """
+        index, bit = divmod(record_num, 8)
+        return index < len(self.done) and bool(self.done[index] & (1 << bit))
+
+    def has_failed(self, record_num):
+        """ Check whether a record failed for good, in a previous run """
+        return record_num in self.failed
+
+    def pending(self, records):
+        """ Number the records, skipping the ones already processed
+
+        Yields a (record_num, record) tuple for each pending record.
+        """
+        for record_num, record in enumerate(records):
+            if not self.is_done(record_num):
+                yield record_num, record
+
+    def record(self, record_num, outcome='ok'):
+        """ Append the outcome of a record to the journal
+
+        Writes are buffered and only synced to disk every now and then, so
+        it costs almost nothing per record.
+        """
+        with self.lock:
+            self.out.write('{} {}\n'.format(record_num, outcome))
+            self.mark_done(record_num)
+            self.unsynced += 1
+            if self.unsynced >= JOURNAL_SYNC_RECORDS or \
+                    time.monotonic() - self.last_sync >= JOURNAL_SYNC_INTERVAL:
+                self.sync()
+
+    def sync(self):
+        """ Make sure every record written so far is on disk """
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        """ Sync and close the journal """
+        with self.lock:
+            self.sync()
+            self.out.close()
+
+
+def journal_outcome(error=None):
+    """ Get the outcome of a record, as written to the journal """
+    return 'ok' if error is None else type(error).__name__
+
+
+def open_bulk_journal(input_file, job, journal_file=None, resume_file=None):
+    """ Start the journal of a bulk job, or resume an existing one """
+    if resume_file:
+        journal = BulkJournal(resume_file, job, resume=True)
+        logging.info("\nResuming bulk job from journal %s: %s records were " \
+        "already processed, skipping them!\n", resume_file, journal.done_count)
+        return journal
+    return BulkJournal(journal_file or input_file + JOURNAL_SUFFIX, job)
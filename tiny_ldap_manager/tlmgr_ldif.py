@@ -0,0 +1,232 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" LDIF handling helper functions for tiny-ldap-manager """
+
+import logging
+import ldap
+import ldap.dn
+import ldap.modlist as modlist
+from ldap.controls import LDAPControl
+import ldif
+from tiny_ldap_manager.tlmgr_core import entry_log
+from tiny_ldap_manager.tlmgr_core import ask_user_confirmation
+from tiny_ldap_manager.tlmgr_core import describe_ldap_error
+from tiny_ldap_manager.tlmgr_pipeline import pipeline_operations
+from tiny_ldap_manager.tlmgr_pipeline import PIPELINE_BARRIER
+from tiny_ldap_manager.tlmgr_pipeline import DEFAULT_WINDOW
+from tiny_ldap_manager.tlmgr_journal import journal_outcome
+
+# Modify operations, as written in LDIF change records
+LDIF_MOD_OPS = {
+    'add': ldap.MOD_ADD,
+    'delete': ldap.MOD_DELETE,
+    'replace': ldap.MOD_REPLACE,
+    'increment': ldap.MOD_INCREMENT,
+}
+
+
+class LDIFChangeRecordParser(ldif.LDIFParser):
+    """ LDIF parser which hands over every kind of record, one at a time
+
+    Unlike LDIFParser.parse_change_records(), which only deals with 'modify'
+    records, 'add', 'delete' and 'modrdn' records are handed over, too.
+    Records without a 'changetype' are taken as 'add' records.
+    """
+
+    def next_key_and_value(self):
+        """ Read the next line of the current record, if any """
+        try:
+            return self._next_key_and_value()
+        except EOFError:
+            return None, None
+
+    def records(self):
+        """ Yields a (line_num, dn, changetype, lines, controls) tuple for
+        each record, where 'lines' is a list of its (attr, value) lines.
+        """
+        k, v = self._consume_empty_lines()
+        if k == 'version':
+            self.version = int(v)
+            k, v = self._consume_empty_lines()
+        while k is not None:
+            # The parser has already read the line after the 'dn' one!
+            line_num = self.line_counter - 1
+            if k != 'dn':
+                raise ValueError('Line {}: first line of record does not ' \
+                'start with "dn:"'.format(line_num))
+            dn = v.decode('utf-8')
+            k, v = self.next_key_and_value()
+            controls = []
+            while k == 'control':
+                control = v.decode('utf-8').split(' ', 2)
+                control_value = control[2].encode('utf-8') \
+                        if len(control) > 2 else None
+                controls.append(LDAPControl(control[0], \
+                        len(control) > 1 and control[1] == 'true', \
+                        control_value))
+                k, v = self.next_key_and_value()
+            changetype = 'add'
+            if k == 'changetype':
+                changetype = v.decode('utf-8').strip().lower()
+                k, v = self.next_key_and_value()
+            lines = []
+            while k is not None:
+                lines.append((k, v))
+                k, v = self.next_key_and_value()
+            yield line_num, dn, changetype, lines, controls
+            self.records_read = self.records_read + 1
+            k, v = self._consume_empty_lines()
+
+
+def parse_modify_lines(lines):
+    """ Build a modlist out of the lines of a 'modify' record """
+    modops = []
+    current = None
+    for k, v in lines:
+        if k == '-':
+            current = None
+        elif current is None:
+            if k.lower() not in LDIF_MOD_OPS:
+                raise ValueError('invalid modify operation: {}'.format(k))
+            current = (LDIF_MOD_OPS[k.lower()], v.decode('utf-8').strip(), [])
+            modops.append(current)
+        elif k.lower() == current[1].lower():
+            current[2].append(v)
+        else:
+            raise ValueError('unexpected attribute {} within modify ' \
+            'operation on {}'.format(k, current[1]))
+    return [(op, attr, values or None) for op, attr, values in modops]
+
+
+def record_to_operation(dn, changetype, lines, controls):
+    """ Build a callable that sends an LDIF record to an LDAP session
+
+    Returns a (send, modlist, target_dns) tuple, where 'modlist' is the one
+    of a modify record (or None), and 'target_dns' has the DNs the record
+    operates on.
+    """
+    controls = controls or None
+    if changetype == 'add':
+        entry = {}
+        for attr, value in lines:
+            entry.setdefault(attr, []).append(value)
+        ldif_entry = modlist.addModlist(entry)
+        return lambda ldap_session: ldap_session.add_ext(dn, ldif_entry, \
+                serverctrls=controls), None, [dn]
+    if changetype == 'delete':
+        return lambda ldap_session: ldap_session.delete_ext(dn, \
+                serverctrls=controls), None, [dn]
+    if changetype == 'modify':
+        modops = parse_modify_lines(lines)
+        return lambda ldap_session: ldap_session.modify_ext(dn, modops, \
+                serverctrls=controls), modops, [dn]
+    if changetype in ('modrdn', 'moddn'):
+        fields = {k.lower(): v.decode('utf-8').strip() for k, v in lines}
+        newrdn = fields['newrdn']
+        delold = int(fields.get('deleteoldrdn', '1') == '1')
+        newsuperior = fields.get('newsuperior')
+        parent = newsuperior if newsuperior is not None \
+                else ldap.dn.dn2str(ldap.dn.str2dn(dn)[1:])
+        new_dn = '{},{}'.format(newrdn, parent) if parent else newrdn
+        return lambda ldap_session: ldap_session.rename(dn, newrdn, \
+                newsuperior, delold, serverctrls=controls), None, \
+                [dn, new_dn]
+    raise ValueError('invalid changetype: {}'.format(changetype))
+
+
+def dn_lineage(dn):
+    """ Get the normalized forms of a DN, followed by those of its ancestors """
+    rdns = ldap.dn.str2dn(dn)
+    return [ldap.dn.dn2str(rdns[i:]).lower() for i in range(len(rdns))]
+
+
+def ldif_operations(records):
+    """ Turn (numbered) LDIF records into pipeline operations
+
+    A PIPELINE_BARRIER is placed before each record that depends on a record
+    still in flight: one on the same DN, on an ancestor or on a descendant.
+    """
+    touched = set()
+    touched_ancestors = set()
+    records = iter(records)
+    while True:
+        try:
+            record_num, record = next(records)
+        except StopIteration:
+            return
+        except ValueError as err:
+            # There's no way to find where the next record starts!
+            logging.critical("\nERROR: Wrong LDIF formatted content found: " \
+            "%s", err)
+            return
+        line_num, dn, changetype, lines, controls = record
+        if not ldap.dn.is_dn(dn):
+            logging.warning("ERROR: %s is not a valid DN ! (line %s)", \
+            dn, line_num)
+            continue
+        try:
+            send, modops, target_dns = record_to_operation(dn, changetype, \
+                    lines, controls)
+            lineages = [dn_lineage(target_dn) for target_dn in target_dns]
+        except (ValueError, KeyError, ldap.DECODING_ERROR) as err:
+            logging.warning("ERROR: Wrong LDIF record for %s at line %s: %s", \
+            dn, line_num, err)
+            continue
+        for lineage in lineages:
+            if lineage[0] in touched or lineage[0] in touched_ancestors \
+                    or touched.intersection(lineage[1:]):
+                yield PIPELINE_BARRIER
+                touched.clear()
+                touched_ancestors.clear()
+                break
+        for lineage in lineages:
+            touched.add(lineage[0])
+            touched_ancestors.update(lineage[1:])
+        yield (record_num, line_num, dn, changetype), send, changetype, modops
+
+
+def apply_ldif_records(ldap_session, records, journal, window=DEFAULT_WINDOW):
+    """ Apply LDIF records on LDAP, reporting the outcome of each of them """
+    # Records already applied (as told by the journal of a previous run) are
+    # skipped.
+    for tag, error in pipeline_operations(ldap_session, \
+            ldif_operations(journal.pending(records)), window):
+        record_num, line_num, dn, changetype = tag
+        if error is None:
+            entry_log.info("Applied LDIF %s record on LDAP entry: %s", \
+            changetype, dn)
+        else:
+            logging.warning("Failed to apply LDIF %s record on LDAP entry: " \
+            "%s (line %s). %s", changetype, dn, line_num, \
+            describe_ldap_error(error))
+        journal.record(record_num, journal_outcome(error))
+
+
+def ldap_ldif_bulk(ldap_pool, ldif_file, journal, window=DEFAULT_WINDOW):
+    """ Apply the change records of an LDIF file """
+    logging.info("\nATTENTION: LDAP entries will be changed given the " \
+    "specified LDIF file!\n")
+    if ask_user_confirmation():
+        # Records may depend on previous ones, so they are all sent through
+        # the same LDAP session, in order to keep them properly ordered.
+        try:
+            with open(ldif_file, 'rb') as f:
+                records = LDIFChangeRecordParser(f).records()
+                apply_ldif_records(ldap_pool[0], records, journal, window)
+        except IOError:
+            logging.critical("\nERROR: file %s not found!", ldif_file)
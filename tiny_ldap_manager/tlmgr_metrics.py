@@ -0,0 +1,175 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Latency and throughput instrumentation of LDAP operations """
+
+import sys
+import json
+import time
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+# Upper bounds (in seconds) of the latency histogram buckets: from 0.1 ms up
+# to ~100 s, each one being ~19% wider than the previous one.
+HISTOGRAM_BOUNDS = [0.0001 * 2 ** (i / 4) for i in range(81)]
+# Percentiles shown for each kind of operation
+PERCENTILES = (50, 95, 99)
+# Seconds between progress lines
+PROGRESS_INTERVAL = 10.0
+
+
+class LatencyHistogram:
+    """ Fixed-bucket histogram of operation latencies
+
+    Adding a latency costs a binary search over the bucket bounds, and
+    percentiles are as accurate as the bucket widths.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.total = 0
+
+    def add(self, latency):
+        """ Count a latency (in seconds) into its bucket """
+        self.counts[bisect_left(HISTOGRAM_BOUNDS, latency)] += 1
+        self.total += 1
+
+    def percentile(self, percent):
+        """ Get the upper bound (in seconds) of the bucket of a percentile """
+        target = self.total * percent / 100.0
+        accumulated = 0
+        for index, count in enumerate(self.counts):
+            accumulated += count
+            if count and accumulated >= target:
+                return HISTOGRAM_BOUNDS[min(index, len(HISTOGRAM_BOUNDS) - 1)]
+        return 0.0
+
+
+def payload_size(obj):
+    """ Estimate the size (in bytes) of an LDAP request or response
+
+    Just DNs, attribute names and values are counted, leaving the protocol
+    encoding out.
+    """
+    if isinstance(obj, (bytes, str)):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(len(key) + payload_size(value) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sum(payload_size(item) for item in obj)
+    return 0
+
+
+class OperationMetrics:
+    """ Latencies, errors and bytes of the LDAP operations of a job
+
+    It's shared by every session of a pool, which reports each operation
+    sent and completed (see ResilientLDAPObject).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Measuring starts with the first operation (ie: not while waiting
+        # for the user to confirm)
+        self.started = None
+        self.last_progress = None
+        self.histograms = {}
+        self.errors = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def sent(self, size):
+        """ Count the bytes of an operation being sent """
+        with self.lock:
+            if self.started is None:
+                self.started = self.last_progress = time.monotonic()
+            self.bytes_sent += size
+
+    def completed(self, operation, latency, received=0, error=None):
+        """ Count a completed operation, of the given kind (ie: 'add') """
+        with self.lock:
+            histogram = self.histograms.get(operation)
+            if histogram is None:
+                histogram = self.histograms[operation] = LatencyHistogram()
+            histogram.add(latency)
+            self.bytes_received += received
+            if error is not None:
+                self.errors[type(error).__name__] += 1
+            now = time.monotonic()
+            if now - self.last_progress < PROGRESS_INTERVAL:
+                return
+            self.last_progress = now
+            line = self.progress_line(now)
+        # Written straight to stderr, so it isn't held back with the log
+        # records of worker threads.
+        sys.stderr.write(line)
+        sys.stderr.flush()
+
+    def progress_line(self, now):
+        """ Build the periodic progress line """
+        total = sum(h.total for h in self.histograms.values())
+        latencies = ', '.join('{} p95: {:.1f} ms'.format(operation, \
+                histogram.percentile(95) * 1000) \
+                for operation, histogram in sorted(self.histograms.items()))
+        return "[progress] {} operations ({:.1f} ops/sec), {} errors, {}\n" \
+                .format(total, total / max(now - self.started, 1e-9), \
+                sum(self.errors.values()), latencies)
+
+    def summary(self, ldap_pool=()):
+        """ Build the final summary of the job, as a dict """
+        with self.lock:
+            elapsed = time.monotonic() - self.started if self.started else 0.0
+            total = sum(h.total for h in self.histograms.values())
+            summary = {
+                'elapsed_seconds': round(elapsed, 3),
+                'operations': total,
+                'ops_per_sec': round(total / max(elapsed, 1e-9), 1),
+                'latency_ms': {operation: dict(count=histogram.total, \
+                        **{'p{}'.format(p): round(histogram.percentile(p) \
+                        * 1000, 3) for p in PERCENTILES}) \
+                        for operation, histogram in self.histograms.items()},
+                'errors': dict(self.errors),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+            }
+        summary['reconnects'] = sum(ldap_session.retry_counts['reconnects'] \
+                for ldap_session in ldap_pool)
+        summary['retries'] = sum(ldap_session.retry_counts['retries'] \
+                for ldap_session in ldap_pool)
+        entry_cache = getattr(ldap_pool[0], 'entry_cache', None) \
+                if ldap_pool else None
+        if entry_cache is not None:
+            summary['entry_cache'] = dict(entry_cache.stats)
+        return summary
+
+
+def start_metrics(ldap_pool):
+    """ Start measuring the LDAP operations of every session of a pool """
+    metrics = OperationMetrics()
+    for ldap_session in ldap_pool:
+        ldap_session.metrics = metrics
+    return metrics
+
+
+def print_metrics_summary(ldap_pool):
+    """ Write the final summary of a job to stdout, as JSON """
+    metrics = getattr(ldap_pool[0], 'metrics', None)
+    if metrics is not None:
+        sys.stdout.write(json.dumps(metrics.summary(ldap_pool), indent=2))
+        sys.stdout.write('\n')
+        sys.stdout.flush()
@@ -0,0 +1,489 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Local mirror of LDAP entries, for answering 'ls --local' """
+
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import ldap
+import ldap.dn
+from ldap.cidict import cidict
+from ldap.filter import escape_filter_chars
+from ldap.syncrepl import SyncreplConsumer
+from tiny_ldap_manager.tlmgr_core import paged_search
+from tiny_ldap_manager.tlmgr_core import server_supports_control
+from tiny_ldap_manager.tlmgr_core import DEFAULT_PAGE_SIZE
+from tiny_ldap_manager.tlmgr_session import CONNECTION_ERRORS
+
+# OID of the Sync Request control (RFC 4533)
+SYNC_REQUEST_OID = '1.3.6.1.4.1.4203.1.9.1.1'
+# How the mirror is kept up to date: syncrepl, polling modifyTimestamp, or
+# syncrepl whenever the server supports it
+MIRROR_MODES = ('auto', 'syncrepl', 'poll')
+# Seconds between polls, when following changes by polling
+DEFAULT_POLL_INTERVAL = 60
+# Where mirrors are stored by default, one for each server
+MIRROR_DIR = os.path.join(os.path.expanduser('~'), '.tiny-ldap-manager')
+
+MIRROR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    uuid TEXT PRIMARY KEY,
+    tree_key TEXT NOT NULL UNIQUE,
+    parent_key TEXT NOT NULL,
+    dn TEXT NOT NULL,
+    attrs TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent_key);
+CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value);
+CREATE TEMP TABLE IF NOT EXISTS present (uuid TEXT PRIMARY KEY);
+"""
+
+
+def default_mirror_file(server):
+    """ Get the file where the mirror of a server is stored by default """
+    name = re.sub(r'[^A-Za-z0-9.-]+', '_', server).strip('_')
+    return os.path.join(MIRROR_DIR, name + '.mirror')
+
+
+def tree_key(dn):
+    """ Build a key of a DN whose RDNs go from the root to the entry
+
+    Keys of the entries below a DN all start with the key of the DN (and a
+    comma), so a subtree is a range of keys, which the index can look up.
+    """
+    return rdns_tree_key(ldap.dn.str2dn(dn))
+
+
+def rdns_tree_key(rdns):
+    """ Build the tree key of an already parsed DN (see tree_key) """
+    # Commas within RDN values are escaped by dn2str(), so the key can't be
+    # split back into RDNs at each comma: parents' keys are built from RDNs.
+    return ','.join(ldap.dn.dn2str([rdn]).lower() for rdn in reversed(rdns))
+
+
+def encode_attrs(attrs):
+    """ Turn the attributes of an LDAP entry into JSON
+
+    Latin-1 maps every byte to a character, so any value (even a binary one)
+    survives the round trip.
+    """
+    return json.dumps({attr: [value.decode('latin-1') for value in values] \
+            for attr, values in attrs.items()})
+
+
+def decode_attrs(data):
+    """ Turn JSON made by encode_attrs() back into LDAP attributes """
+    return {attr: [value.encode('latin-1') for value in values] \
+            for attr, values in json.loads(data).items()}
+
+
+class MirrorStore:
+    """ On-disk store of the LDAP entries below a DN (an SQLite database)
+
+    Entries are kept by a unique ID (their entryUUID, when it's known), and
+    indexed by their tree key (see tree_key) and the one of their parent, so
+    that every search scope is answered from an index.
+    """
+
+    def __init__(self, mirror_file, readonly=False):
+        self.mirror_file = mirror_file
+        if readonly:
+            self.db = sqlite3.connect('file:{}?mode=ro'.format(mirror_file), \
+                    uri=True)
+            return
+        directory = os.path.dirname(mirror_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(mirror_file)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(MIRROR_SCHEMA)
+
+    def get_state(self, name, default=None):
+        """ Get a value of the state of the mirror (ie: the sync cookie) """
+        row = self.db.execute('SELECT value FROM state WHERE name = ?', \
+                (name,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_state(self, name, value):
+        """ Set a value of the state of the mirror """
+        self.db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', \
+                (name, value))
+
+    def count(self):
+        """ Get the amount of entries in the mirror """
+        return self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def clear(self):
+        """ Forget every entry and the whole state of the mirror """
+        self.db.execute('DELETE FROM entries')
+        self.db.execute('DELETE FROM state')
+        self.db.execute('DELETE FROM present')
+
+    def put_entry(self, uuid, dn, attrs):
+        """ Add or update an entry, which might have been renamed
+
+        Returns False if the entry was already in the mirror, unchanged.
+        """
+        rdns = ldap.dn.str2dn(dn)
+        key = rdns_tree_key(rdns)
+        data = encode_attrs(attrs)
+        row = self.db.execute('SELECT tree_key, dn, attrs FROM entries ' \
+                'WHERE uuid = ?', (uuid,)).fetchone()
+        if row is not None and row[1:] == (dn, data):
+            return False
+        if row is not None and row[0] != key:
+            self.move_subtree(row[0], row[1], key, dn)
+        # It replaces any other entry with the same DN, too
+        self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', \
+                (uuid, key, rdns_tree_key(rdns[1:]), dn, data))
+        return True
+
+    def move_subtree(self, old_key, old_dn, new_key, new_dn):
+        """ Rename the entries below a renamed entry """
+        # Their DNs end with the DN of the renamed entry, as the server wrote
+        # it, which is replaced by the new one. Their keys (and their
+        # parents' keys) start with the key of the renamed entry, so just
+        # that part is replaced.
+        self.db.execute('UPDATE entries SET ' \
+                'tree_key = ? || substr(tree_key, ?), ' \
+                'parent_key = ? || substr(parent_key, ?), ' \
+                'dn = substr(dn, 1, length(dn) - ?) || ? ' \
+                'WHERE tree_key >= ? AND tree_key < ?', \
+                (new_key, len(old_key) + 1, new_key, len(old_key) + 1, \
+                len(old_dn), new_dn, old_key + ',', old_key + '-'))
+
+    def delete_entries(self, uuids):
+        """ Delete entries by their unique ID, returning how many were """
+        cursor = self.db.executemany('DELETE FROM entries WHERE uuid = ?', \
+                ((uuid,) for uuid in uuids))
+        return cursor.rowcount
+
+    def mark_present(self, uuids):
+        """ Record entries as still present in LDAP """
+        self.db.executemany('INSERT OR IGNORE INTO present VALUES (?)', \
+                ((uuid,) for uuid in uuids))
+
+    def delete_not_present(self):
+        """ Delete every entry not recorded as present, forgetting them all """
+        cursor = self.db.execute('DELETE FROM entries ' \
+                'WHERE uuid NOT IN (SELECT uuid FROM present)')
+        self.db.execute('DELETE FROM present')
+        return cursor.rowcount
+
+    def forget_present(self):
+        """ Forget which entries were recorded as present """
+        self.db.execute('DELETE FROM present')
+
+    def search(self, basedn, scope, filterstr='(objectClass=*)', attrlist=None):
+        """ Search mirrored entries, just like a search on the server would
+
+        Yields a (dn, attrs) tuple for each entry. Raises NO_SUCH_OBJECT if
+        the base DN isn't in the mirror, and ValueError if the filter isn't
+        supported (see compile_filter).
+        """
+        matches = compile_filter(filterstr)
+        key = tree_key(basedn)
+        if self.db.execute('SELECT 1 FROM entries WHERE tree_key = ?', \
+                (key,)).fetchone() is None:
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object', \
+                    'info': 'not found in the mirror {}'.format(self.mirror_file)})
+        if scope == ldap.SCOPE_BASE:
+            rows = self.db.execute('SELECT dn, attrs FROM entries ' \
+                    'WHERE tree_key = ?', (key,))
+        elif scope == ldap.SCOPE_ONELEVEL:
+            rows = self.db.execute('SELECT dn, attrs FROM entries ' \
+                    'WHERE parent_key = ? ORDER BY tree_key', (key,))
+        else:
+            rows = self.db.execute('SELECT dn, attrs FROM entries ' \
+                    'WHERE tree_key = ? OR (tree_key >= ? AND tree_key < ?) ' \
+                    'ORDER BY tree_key', (key, key + ',', key + '-'))
+        for dn, data in rows:
+            attrs = decode_attrs(data)
+            if matches(cidict(attrs)):
+                yield dn, select_attrs(attrs, attrlist)
+
+    def commit(self):
+        """ Store the changes made so far for good """
+        self.db.commit()
+
+    def rollback(self):
+        """ Forget the changes made since they were last committed """
+        self.db.rollback()
+
+    def close(self):
+        """ Close the database of the mirror """
+        self.db.close()
+
+
+def select_attrs(attrs, attrlist):
+    """ Keep just the requested attributes (every one of them by default) """
+    if not attrlist or '*' in attrlist:
+        return attrs
+    wanted = {attr.lower() for attr in attrlist}
+    return {attr: values for attr, values in attrs.items() \
+            if attr.lower() in wanted}
+
+
+def compile_filter(filterstr):
+    """ Turn an LDAP filter (RFC 4515) into a function matching attributes
+
+    Supports '&', '|', '!', presence, equality, substrings, '>=' and '<='.
+    Values are compared as case-insensitive strings, since matching rules
+    aren't known locally. Raises ValueError for anything else.
+    """
+    matches, end = compile_filter_at(filterstr.strip(), 0)
+    if end != len(filterstr.strip()):
+        raise ValueError("unexpected characters after the end of the filter")
+    return matches
+
+
+def compile_filter_at(filterstr, pos):
+    """ Compile the filter starting at 'pos', returning where it ends, too """
+    if filterstr[pos:pos + 1] != '(':
+        raise ValueError("expected '(' at position {}".format(pos))
+    operator = filterstr[pos + 1:pos + 2]
+    if operator in ('&', '|', '!'):
+        pos += 2
+        parts = []
+        while filterstr[pos:pos + 1] == '(':
+            part, pos = compile_filter_at(filterstr, pos)
+            parts.append(part)
+        if filterstr[pos:pos + 1] != ')':
+            raise ValueError("expected ')' at position {}".format(pos))
+        if operator == '&':
+            return (lambda attrs: all(part(attrs) for part in parts)), pos + 1
+        if operator == '|':
+            return (lambda attrs: any(part(attrs) for part in parts)), pos + 1
+        if len(parts) != 1:
+            raise ValueError("'!' expects a single filter")
+        return (lambda attrs: not parts[0](attrs)), pos + 1
+    end = filterstr.find(')', pos)
+    if end < 0:
+        raise ValueError("missing ')' at the end of the filter")
+    item = re.match(r'^([A-Za-z0-9;.-]+)(>=|<=|~=|=)(.*)$', \
+            filterstr[pos + 1:end], re.DOTALL)
+    if item is None:
+        raise ValueError("unsupported filter item: {}".format( \
+                filterstr[pos:end + 1]))
+    return compile_filter_item(*item.groups()), end + 1
+
+
+def compile_filter_item(attr, operator, value):
+    """ Compile a single (attr OPERATOR value) filter item """
+    def values_of(attrs):
+        return [v.decode('utf-8', 'replace').lower() \
+                for v in attrs.get(attr, [])]
+    if operator == '=' and value == '*':
+        return lambda attrs: attr in attrs
+    if operator == '=' and '*' in value:
+        pattern = re.compile('^{}$'.format('.*'.join(re.escape( \
+                unescape_filter_value(part).lower()) for part in value.split('*'))), \
+                re.DOTALL)
+        return lambda attrs: any(pattern.match(v) for v in values_of(attrs))
+    value = unescape_filter_value(value).lower()
+    if operator == '>=':
+        return lambda attrs: any(v >= value for v in values_of(attrs))
+    if operator == '<=':
+        return lambda attrs: any(v <= value for v in values_of(attrs))
+    # Approximate matches are taken as equality matches
+    return lambda attrs: value in values_of(attrs)
+
+
+def unescape_filter_value(value):
+    """ Undo the escaping of a filter value (ie: '\\2a' for '*') """
+    if '\\' not in value:
+        return value
+    raw = re.sub(r'\\([0-9A-Fa-f]{2})', lambda m: chr(int(m.group(1), 16)), \
+            value)
+    return raw.encode('latin-1', 'replace').decode('utf-8', 'replace')
+
+
+class MirrorConsumer(SyncreplConsumer):
+    """ Syncrepl consumer (RFC 4533) writing what it gets into a mirror
+
+    The sync cookie is committed along with the changes it stands for, so
+    that a new run only gets what changed afterwards.
+    """
+
+    def __init__(self, ldap_session, store):
+        self.ldap_session = ldap_session
+        self.store = store
+        self.changed = 0
+        self.deleted = 0
+
+    def search_ext(self, *args, **kwargs):
+        """ Send the sync search through the LDAP session """
+        return self.ldap_session.search_ext(*args, **kwargs)
+
+    def result4(self, *args, **kwargs):
+        """ Wait for sync messages on the LDAP session """
+        return self.ldap_session.result4(*args, **kwargs)
+
+    def syncrepl_get_cookie(self):
+        return self.store.get_state('cookie')
+
+    def syncrepl_set_cookie(self, cookie):
+        self.store.set_state('cookie', cookie)
+        self.store.commit()
+
+    def syncrepl_entry(self, dn, attrs, uuid):
+        if self.store.put_entry(uuid, dn, attrs):
+            self.changed += 1
+
+    def syncrepl_delete(self, uuids):
+        self.deleted += self.store.delete_entries(uuids)
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        if uuids is not None:
+            self.store.mark_present(uuids)
+        elif refreshDeletes:
+            # Deleted entries were (or will be) told one by one
+            self.store.forget_present()
+        else:
+            self.deleted += self.store.delete_not_present()
+
+    def syncrepl_refreshdone(self):
+        self.store.commit()
+        logging.info("\nMirror is up to date (%s entries). Waiting for " \
+        "changes...", self.store.count())
+
+
+def sync_with_syncrepl(ldap_session, store, basedn, filterstr, follow=False):
+    """ Bring a mirror up to date with the Content Synchronization Operation
+
+    With 'follow', it keeps receiving changes as they happen, connecting
+    again whenever the connection is lost. Returns the amount of entries
+    changed and deleted.
+    """
+    consumer = MirrorConsumer(ldap_session, store)
+    mode = 'refreshAndPersist' if follow else 'refreshOnly'
+    while True:
+        try:
+            msgid = consumer.syncrepl_search(basedn, ldap.SCOPE_SUBTREE, \
+                    mode=mode, filterstr=filterstr)
+            consumer.syncrepl_poll(msgid=msgid, all=1)
+            break
+        except CONNECTION_ERRORS:
+            if not follow:
+                raise
+            # Changes after the last cookie are sent again
+            store.rollback()
+            ldap_session.reconnect_with_backoff()
+    store.commit()
+    return consumer.changed, consumer.deleted
+
+
+def poll_changes(ldap_session, store, basedn, filterstr, \
+        page_size=DEFAULT_PAGE_SIZE):
+    """ Bring a mirror up to date by searching for modified entries
+
+    Entries modified since the latest modifyTimestamp seen are retrieved,
+    and the DNs of every entry (without their attributes) tell which ones
+    were deleted. Without any modifyTimestamp (ie: on the first run), every
+    entry is retrieved. Returns the amount of entries changed and deleted.
+    """
+    since = store.get_state('last_timestamp')
+    changes_filter = filterstr
+    if since is not None:
+        changes_filter = '(&{}(modifyTimestamp>={}))'.format(filterstr, \
+                escape_filter_chars(since))
+    latest = since
+    changed = 0
+    for dn, attrs in paged_search(ldap_session, basedn, ldap.SCOPE_SUBTREE, \
+            changes_filter, ['*', 'modifyTimestamp'], page_size):
+        timestamps = [value.decode('ascii') for attr, values in attrs.items() \
+                if attr.lower() == 'modifytimestamp' for value in values]
+        attrs = {attr: values for attr, values in attrs.items() \
+                if attr.lower() != 'modifytimestamp'}
+        # Entries are told apart by their DN, since renames can't be tracked
+        key = tree_key(dn)
+        # Entries modified within the latest second seen are retrieved again
+        if store.put_entry(key, dn, attrs):
+            changed += 1
+        if since is None:
+            store.mark_present([key])
+        for timestamp in timestamps:
+            if latest is None or timestamp > latest:
+                latest = timestamp
+    if since is not None:
+        for dn, attrs in paged_search(ldap_session, basedn, \
+                ldap.SCOPE_SUBTREE, filterstr, ['1.1'], page_size):
+            store.mark_present([tree_key(dn)])
+    deleted = store.delete_not_present()
+    if latest is not None:
+        store.set_state('last_timestamp', latest)
+    store.commit()
+    return changed, deleted
+
+
+def mirror_ldap_entries(ldap_session, mirror_file, basedn, \
+        filterstr='(objectClass=*)', mode='auto', follow=False, \
+        interval=DEFAULT_POLL_INTERVAL, page_size=DEFAULT_PAGE_SIZE):
+    """ Take a snapshot of the entries below a DN, or bring it up to date """
+    if mode == 'auto':
+        mode = 'syncrepl' if server_supports_control(ldap_session, \
+                SYNC_REQUEST_OID) else 'poll'
+    store = MirrorStore(mirror_file)
+    try:
+        # A mirror of other entries (or kept otherwise) is taken again
+        settings = json.dumps([tree_key(basedn), filterstr, mode])
+        if store.get_state('settings') != settings:
+            store.clear()
+            store.set_state('settings', settings)
+            logging.info("\nTaking a snapshot of %s into %s (%s mode)...", \
+            basedn, mirror_file, mode)
+        else:
+            logging.info("\nUpdating the mirror of %s in %s (%s mode)...", \
+            basedn, mirror_file, mode)
+        while True:
+            started = time.monotonic()
+            if mode == 'syncrepl':
+                changed, deleted = sync_with_syncrepl(ldap_session, store, \
+                        basedn, filterstr, follow)
+            else:
+                changed, deleted = poll_changes(ldap_session, store, basedn, \
+                        filterstr, page_size)
+            logging.info("\nMirror updated: %s entries added or changed, %s " \
+            "deleted (%s in total).", changed, deleted, store.count())
+            if not follow or mode == 'syncrepl':
+                break
+            time.sleep(max(0, interval - (time.monotonic() - started)))
+    finally:
+        store.close()
+
+
+def search_mirror(mirror_file, basedn, scope, filterstr='(objectClass=*)', \
+        attrlist=None):
+    """ Search the entries of a mirror, without connecting to the server
+
+    Yields a (dn, attrs) tuple for each entry, as paged_search() does.
+    """
+    try:
+        store = MirrorStore(mirror_file, readonly=True)
+    except sqlite3.OperationalError:
+        raise ldap.NO_SUCH_OBJECT({'desc': 'No such object', 'info': \
+                "there's no mirror at {} (see the mirror action)" \
+                .format(mirror_file)})
+    try:
+        for entry in store.search(basedn, scope, filterstr, attrlist):
+            yield entry
+    finally:
+        store.close()
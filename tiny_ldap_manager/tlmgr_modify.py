@@ -18,14 +18,25 @@
 """ Helper functions for the 'modify' LDAP related operations """
 
 from sys import exit
+from functools import partial
+from collections import OrderedDict
 import logging
 import ldap
+import ldap.dn
+from ldap.cidict import cidict
 import ldap.modlist as modlist
+from tiny_ldap_manager.tlmgr_core import entry_log
 from tiny_ldap_manager.tlmgr_core import ask_user_confirmation
-from tiny_ldap_manager.tlmgr_core import retrieve_attrs_from_dn
-from tiny_ldap_manager.tlmgr_csv import read_csv
-from tiny_ldap_manager.tlmgr_csv import sanitize_csv_entry
+from tiny_ldap_manager.tlmgr_core import normalize_dn
+from tiny_ldap_manager.tlmgr_core import prefetch_attrs
+from tiny_ldap_manager.tlmgr_core import update_cached_attrs
 from tiny_ldap_manager.tlmgr_csv import csv_sanitizer
+from tiny_ldap_manager.tlmgr_csv import build_column_plan
+from tiny_ldap_manager.tlmgr_csv import DEFAULT_MULTI_VALUE_SEPARATOR
+from tiny_ldap_manager.tlmgr_workers import run_in_workers
+from tiny_ldap_manager.tlmgr_workers import DEFAULT_CHUNK_SIZE
+from tiny_ldap_manager.tlmgr_journal import journal_outcome
+from tiny_ldap_manager.tlmgr_session import OperationInterrupted
 
 def ldap_replace_attr(ldap_session, attrs, attr, dn, new_value):
     """ Replace an existing LDAP attribute's value """
@@ -35,7 +46,7 @@ def ldap_replace_attr(ldap_session, attrs, attr, dn, new_value):
     new = {attr:new_value}
     ldif = modlist.modifyModlist(old, new)
     ldap_session.modify_s(dn, ldif)
-    logging.info("\nAttribute %s value has been changed:\n\n" \
+    entry_log.info("\nAttribute %s value has been changed:\n\n" \
     " Previous value: %s\n New value: %s\n" \
     , attr, current_attr[0].decode(), new_value[0].decode())
 
@@ -44,7 +55,7 @@ def ldap_add_attr(ldap_session, dn, attr, value):
     """ Add attribute in LDAP entry if NOT exists  """
     new_attr = [(ldap.MOD_ADD, attr, value)]
     ldap_session.modify_s(dn, new_attr)
-    logging.info("A new attribute has been added:\n\n %s: %s\n", \
+    entry_log.info("A new attribute has been added:\n\n %s: %s\n", \
                 attr, value[0].decode())
 
 
@@ -56,49 +67,169 @@ def ldap_delete_attr(ldap_session, dn, attr):
         logging.info("\nLDAP attribute %s has been removed!!\n", attr)
 
 
-def process_each_bulk_entry(ldap_session, attr, each_entry):
-    """ Auxiliary function to modify or add LDAP attributes in bulk  """
+def build_bulk_modlist(existing_attrs, new_attrs):
+    """ Build the modlist setting the given attributes of an existing entry
+
+    Attributes which don't exist yet are added, and the ones with different
+    values are replaced. The modlist is empty when there's nothing to change.
+    """
+    modops = []
+    for attr, values in new_attrs.items():
+        current_values = existing_attrs.get(attr)
+        if current_values is None:
+            modops.append((ldap.MOD_ADD, attr, values))
+        elif set(current_values) != set(values):
+            modops.append((ldap.MOD_REPLACE, attr, values))
+    return modops
+
+
+def modify_bulk_entry(ldap_session, dn, existing_attrs, new_attrs):
+    """ Auxiliary function to modify or add LDAP attributes in bulk
+
+    Every attribute of an LDAP entry is changed with a single modify
+    operation, however many CSV entries (or columns) they come from.
+
+    Argument: existing_attrs (the current attributes of the entry, as given
+    by prefetch_attrs(), or None if it doesn't exist)
+
+    Returns the outcome of the CSV entries, as written to the bulk job journal.
+    """
+    if existing_attrs is None:
+        logging.critical("ERROR: %s does not exist!", dn)
+        return 'NO_SUCH_OBJECT'
+    modops = build_bulk_modlist(existing_attrs, new_attrs)
+    if not modops:
+        entry_log.info("Nothing to change in %s", dn)
+        return journal_outcome()
     try:
-        for entry in each_entry:
-            dn = each_entry.get('dn')
-            attr_value = each_entry[attr]
-        logging.info("\nProcessing DN in CSV: %s", dn)
-        # Is DN valid?
-        if dn != None and ldap.dn.is_dn(dn):
-            # Check if given attribute already exists!
-            existing_attrs = retrieve_attrs_from_dn(ldap_session, dn)
-            does_attr_exist = existing_attrs[0].get(attr)
-            # Add or modify attribute
-            if does_attr_exist != None:
-                # We modify existing attribute
-                new_value = [attr_value.encode('utf-8')]
-                ldap_replace_attr(ldap_session, existing_attrs, attr, dn, new_value)
-            else:
-                # We create the attribute
-                value = [attr_value.encode('utf-8')]
-                ldap_add_attr(ldap_session, dn, attr, value)
+        ldap_session.modify_s(dn, modops)
+    except (ldap.NO_SUCH_OBJECT, ldap.INVALID_SYNTAX, ldap.UNDEFINED_TYPE, \
+            ldap.OBJECT_CLASS_VIOLATION, ldap.CONSTRAINT_VIOLATION, \
+            ldap.TYPE_OR_VALUE_EXISTS, ldap.NO_SUCH_ATTRIBUTE, \
+            OperationInterrupted) as err:
+        logging.critical(err)
+        return journal_outcome(err)
+    for op, attr, values in modops:
+        new_value = ', '.join(value.decode() for value in values)
+        if op == ldap.MOD_ADD:
+            entry_log.info("A new attribute has been added:\n\n %s: %s\n", \
+            attr, new_value)
         else:
+            entry_log.info("\nAttribute %s value has been changed:\n\n" \
+            " Previous value: %s\n New value: %s\n", attr, ', '.join(value.decode() \
+            for value in existing_attrs[attr]), new_value)
+    # Keep prefetched attributes up to date, for upcoming CSV entries on the
+    # same DN.
+    existing_attrs.update(new_attrs)
+    return journal_outcome()
+
+
+def process_sanitized_entries(ldap_session, sanitized_entries, journal, \
+        separator=DEFAULT_MULTI_VALUE_SEPARATOR):
+    """ Modify or add LDAP attributes from sanitized (numbered) CSV entries
+
+    CSV entries sharing a DN are combined, so that each LDAP entry is
+    modified just once.
+    """
+    outcomes = {}
+    column_plan = None
+    # {normalized DN: (DN, record numbers, attributes)}, in order of appearance
+    changes = OrderedDict()
+    for record_num, (line_num, csv_entry, result) in sanitized_entries:
+        # We only process those CSV entries where the overall result of
+        # its sanity check was 'True'.
+        if not result:
+            logging.warning("\nERROR: Wrong CSV formatted content found " \
+            "at line %s!", line_num)
+            outcomes[record_num] = 'INVALID_CSV'
+            continue
+        dn = csv_entry.get('dn')
+        entry_log.info("\nProcessing DN in CSV: %s", dn)
+        # Is DN valid?
+        if dn is None or not ldap.dn.is_dn(dn):
             logging.warning("ERROR - Invalid or inexisting LDAP key used for DN on CSV\n")
-    except (ldap.NO_SUCH_OBJECT, ldap.INVALID_SYNTAX, ldap.UNDEFINED_TYPE) as err:
-        logging.critical(err)
+            outcomes[record_num] = 'INVALID_DN'
+            continue
+        if column_plan is None:
+            column_plan = build_column_plan(list(csv_entry), separator)
+        # Empty values leave their attribute untouched
+        try:
+            new_attrs = [(attr, convert(csv_entry[column])) \
+                    for column, attr, convert in column_plan if csv_entry[column]]
+        except ValueError:
+            # ie: a value of a base64 column which isn't base64
+            logging.warning("\nERROR: Wrong CSV formatted content found " \
+            "at line %s!", line_num)
+            outcomes[record_num] = 'INVALID_CSV'
+            continue
+        change = changes.setdefault(normalize_dn(dn), (dn, [], cidict()))
+        change[1].append(record_num)
+        # Later CSV entries on the same DN win over the former ones
+        change[2].update(new_attrs)
+
+    if changes:
+        # Current attributes of every DN are retrieved beforehand, in
+        # batches, instead of reading each LDAP entry before modifying it.
+        attrlist = [attr for column, attr, convert in column_plan]
+        prefetched = prefetch_attrs(ldap_session, \
+                [dn for dn, record_nums, new_attrs in changes.values()], attrlist)
+        for key, (dn, record_nums, new_attrs) in changes.items():
+            outcome = modify_bulk_entry(ldap_session, dn, prefetched.get(key), \
+                    new_attrs)
+            for record_num in record_nums:
+                outcomes[record_num] = outcome
+        # Writes dropped them from the entry cache, but they're up to date
+        update_cached_attrs(ldap_session, prefetched, attrlist)
+
+    for record_num, sanitized in sanitized_entries:
+        journal.record(record_num, outcomes[record_num])
+
+
+def partitioned_by_dn(sanitized_entries, count, size=DEFAULT_CHUNK_SIZE):
+    """ Split (numbered) CSV entries into chunks of up to 'size' entries
+
+    Each chunk belongs to one of 'count' partitions, chosen by a hash of the
+    DN of its CSV entries. Every CSV entry on the same DN lands in the same
+    partition (and so, on the same worker), in order, wherever it is in the
+    file, so the LDAP entry is never modified by two workers at once.
+
+    Yields a (partition, chunk) tuple for each chunk.
+    """
+    chunks = [[] for _ in range(count)]
+    for record_num, (line_num, csv_entry, result) in sanitized_entries:
+        dn = csv_entry.get('dn')
+        # Wrong CSV entries aren't sent to LDAP, so any partition will do
+        partition = hash(normalize_dn(dn)) % count \
+                if result and dn and ldap.dn.is_dn(dn) else 0
+        chunks[partition].append((record_num, (line_num, csv_entry, result)))
+        if len(chunks[partition]) >= size:
+            yield partition, chunks[partition]
+            chunks[partition] = []
+    for partition, chunk in enumerate(chunks):
+        if chunk:
+            yield partition, chunk
+
+
+def process_partition(ldap_session, partition_chunk, journal, \
+        separator=DEFAULT_MULTI_VALUE_SEPARATOR):
+    """ Modify or add LDAP attributes from a chunk of a partition """
+    partition, chunk = partition_chunk
+    process_sanitized_entries(ldap_session, chunk, journal, separator)
 
 
-def ldap_modify_bulk(ldap_session, csv_file):
+def ldap_modify_bulk(ldap_pool, csv_file, journal, \
+        separator=DEFAULT_MULTI_VALUE_SEPARATOR):
     """ Modify LDAP attributes in bulk based on a CSV file """
     logging.info("\nATTENTION: Several LDAP attributes will be changed given " \
     "the specified CSV file!\n")
     if ask_user_confirmation():
         # Perform a sanity check of the CSV file
-        sanitized_csv = csv_sanitizer(csv_file)
-        # Check CSV sanity results and act accordingly! 
-        for csv_entry in sanitized_csv:
-            # We only process those CSV entries where the overall result of
-            # its sanity check was 'True'.
-            if True in csv_entry:
-                # Get CSV columns
-                csv_cols = [i for i in csv_entry[0]]
-                # We assume 2nd CSV col is attribute's name!
-                attr = csv_cols[1]
-                process_each_bulk_entry(ldap_session, attr, csv_entry[0])
-            else:
-                logging.warning("\nERROR: Wrong CSV formatted content found!")
+        sanitized_csv = journal.pending(csv_sanitizer(csv_file))
+        # Check CSV sanity results and act accordingly! CSV entries are split
+        # in chunks, which are routed to the sessions of the pool by DN.
+        for _ in run_in_workers(ldap_pool, \
+                partial(process_partition, journal=journal, \
+                separator=separator), \
+                partitioned_by_dn(sanitized_csv, len(ldap_pool)), \
+                partition=lambda partition_chunk: partition_chunk[0]):
+            pass
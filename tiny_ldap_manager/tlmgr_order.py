@@ -0,0 +1,166 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Dependency ordering of LDAP entries added in bulk """
+
+import logging
+import threading
+from array import array
+from collections import deque
+import ldap
+import ldap.dn
+from tiny_ldap_manager.tlmgr_core import dn_key
+from tiny_ldap_manager.tlmgr_journal import journal_outcome
+
+# Parent of the entries whose parent isn't among the ones being added
+NO_PARENT = -1
+# Outcome of the entries whose parent entry couldn't be added
+PARENT_FAILED = 'PARENT_FAILED'
+
+
+def build_parent_index(dns):
+    """ Find the parent of each entry among the entries being added
+
+    Each DN is parsed just once. Returns an array with the record number of
+    the parent of each entry, or NO_PARENT when its parent isn't being added
+    (ie: it should already exist in LDAP).
+    """
+    record_nums = {}
+    parent_keys = []
+    for record_num, dn in enumerate(dns):
+        try:
+            rdns = ldap.dn.str2dn(dn)
+        except ldap.DECODING_ERROR:
+            # It's sent anyway, so the server tells what's wrong with it
+            parent_keys.append(None)
+            continue
+        record_nums.setdefault(dn_key(rdns), record_num)
+        parent_keys.append(dn_key(rdns[1:]) if len(rdns) > 1 else None)
+    return array('l', (record_nums.get(key, NO_PARENT) \
+            for key in parent_keys))
+
+
+class AddOrder:
+    """ Hands over entries to be added once their parent entry is added
+
+    Entries whose parent is being added as well are held back until it's
+    added (or found to exist already), so that parents are always added
+    before their children, whatever their order in the file is. Every other
+    entry is handed over right away, so siblings are still added at once.
+
+    If a parent entry can't be added, its children (and their own children)
+    are reported as failed without being sent.
+    """
+
+    def __init__(self, parents, journal):
+        self.parents = parents
+        self.journal = journal
+        self.failed = set()
+        # Entries held back, indexed by the record number of their parent
+        self.waiting = {}
+        # Entries whose parent was just added
+        self.ready = deque()
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def chunks(self, csv_entries, chunk_size):
+        """ Split (numbered) entries in chunks, in the order they can be added
+
+        Once every entry has been read, it keeps handing over the ones held
+        back, as their parents get added, until none of them is left.
+        """
+        chunk = []
+        for record_num, entry in csv_entries:
+            with self.condition:
+                if self.admit(record_num, entry):
+                    chunk.append((record_num, entry))
+                chunk.extend(self.ready)
+                self.ready.clear()
+                if len(chunk) < chunk_size:
+                    continue
+                self.in_flight += len(chunk)
+            yield chunk
+            chunk = []
+        while True:
+            with self.condition:
+                chunk.extend(self.ready)
+                self.ready.clear()
+                if not chunk and self.in_flight and self.waiting:
+                    self.condition.wait()
+                    continue
+                if not chunk:
+                    break
+                self.in_flight += len(chunk)
+            yield chunk
+            chunk = []
+        # Whatever is left behind has a parent that was never added (ie: the
+        # job was interrupted), so it's not journaled, to be added on resume.
+        with self.condition:
+            for children in self.waiting.values():
+                for record_num, (dn, attributes) in children:
+                    logging.critical("LDAP entry %s wasn't added: its parent " \
+                    "entry never was!", dn)
+
+    def admit(self, record_num, entry):
+        """ Tell whether an entry can be added now, holding it back if not """
+        parent = self.parents[record_num] if record_num < len(self.parents) \
+                else NO_PARENT
+        if parent == NO_PARENT:
+            return True
+        if parent in self.failed or self.journal.has_failed(parent):
+            self.fail(record_num, entry[0])
+            return False
+        # Parents already added (even by a previous run) are done
+        if self.journal.is_done(parent):
+            return True
+        self.waiting.setdefault(parent, []).append((record_num, entry))
+        return False
+
+    def completed(self, record_num, error=None):
+        """ Record the outcome of an entry, handing over its children """
+        with self.condition:
+            self.journal.record(record_num, journal_outcome(error))
+            self.in_flight -= 1
+            if error is None or isinstance(error, ldap.ALREADY_EXISTS):
+                self.ready.extend(self.waiting.pop(record_num, ()))
+            else:
+                self.failed.add(record_num)
+                self.fail_children(record_num)
+            self.condition.notify_all()
+
+    def abandoned(self, count):
+        """ Forget about entries handed over which won't be completed
+
+        That's the case when the job is interrupted (ie: the connection to the
+        server is lost for good).
+        """
+        with self.condition:
+            self.in_flight -= count
+            self.condition.notify_all()
+
+    def fail(self, record_num, dn):
+        """ Report an entry whose parent couldn't be added as failed """
+        logging.critical("Failed to add LDAP entry: %s. Its parent entry " \
+        "couldn't be added!", dn)
+        self.journal.record(record_num, PARENT_FAILED)
+        self.failed.add(record_num)
+        self.fail_children(record_num)
+
+    def fail_children(self, record_num):
+        """ Report every entry held back by a failed one as failed, too """
+        for child_num, (dn, attributes) in self.waiting.pop(record_num, ()):
+            self.fail(child_num, dn)
@@ -0,0 +1,216 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Output formats for the LDAP entries shown by tiny-ldap-manager """
+
+import sys
+import csv
+import json
+import logging
+import tempfile
+from base64 import b64encode
+import ldif
+from tiny_ldap_manager.tlmgr_csv import MULTI_VALUE_MARKER
+from tiny_ldap_manager.tlmgr_csv import BASE64_MARKER
+from tiny_ldap_manager.tlmgr_csv import join_multi_value
+
+# Size of the buffer used when writing entries to a file
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+
+def decode_value(value):
+    """ Decode an attribute value to str, base64 encoding it if binary
+
+    Returns a (value, is_binary) tuple.
+    """
+    try:
+        return value.decode('utf-8'), False
+    except UnicodeDecodeError:
+        return b64encode(value).decode('ascii'), True
+
+
+def write_text(out, entries, attrlist=None):
+    """ Write LDAP entries as human readable text """
+    for dn, attrs in entries:
+        out.write("\n{:<40} :\t{}\n".format('dn', dn))
+        for key, value in attrs.items():
+            # Deal with attributes with multiple values!
+            for v in value:
+                out.write("{:<40} :\t{}\n".format(key, decode_value(v)[0]))
+
+
+def write_ldif(out, entries, attrlist=None):
+    """ Write LDAP entries as LDIF """
+    # Binary (or otherwise unsafe) values are base64 encoded by the writer
+    ldif_writer = ldif.LDIFWriter(out)
+    for dn, attrs in entries:
+        ldif_writer.unparse(dn, attrs)
+
+
+def write_jsonl(out, entries, attrlist=None):
+    """ Write LDAP entries as JSON Lines (one JSON object per entry)
+
+    Binary values are written as a {"base64": VALUE} object.
+    """
+    for dn, attrs in entries:
+        json_entry = {'dn': dn}
+        for key, value in attrs.items():
+            json_entry[key] = [json_value(v) for v in value]
+        out.write(json.dumps(json_entry))
+        out.write('\n')
+
+
+def json_value(value):
+    """ Get the JSON representation of an attribute value """
+    value, is_binary = decode_value(value)
+    return {'base64': value} if is_binary else value
+
+
+def write_csv(out, entries, attrlist=None):
+    """ Write LDAP entries as CSV, the same way 'bulk --add-entries' reads it
+
+    Unless the attributes to write are known beforehand, entries are spooled
+    to a temporary file, since the CSV header row needs every attribute name.
+    Columns with binary values are written base64 encoded, and their header
+    ends with '::' (ie: jpegPhoto::).
+    """
+    if attrlist:
+        # There's no way to know in advance which attributes are going to
+        # have multiple (or binary) values, so every column is taken as
+        # multi-valued, and binary values are left out.
+        columns = [(attr, True, False) for attr in attrlist]
+        write_csv_rows(out, columns, text_csv_rows(entries))
+        return
+
+    # Attribute names (case insensitive) along with whether any of them has
+    # multiple or binary values.
+    attr_names = {}
+    multi_valued = set()
+    binary = set()
+    with tempfile.TemporaryFile('w+') as spool:
+        for dn, attrs in entries:
+            row = csv_row(dn, attrs)
+            for key, value in row.items():
+                if key == 'dn':
+                    continue
+                attr_names.setdefault(key.lower(), key)
+                if len(value) > 1:
+                    multi_valued.add(key.lower())
+                if any(is_binary for v, is_binary in value):
+                    binary.add(key.lower())
+            spool.write(json.dumps(row))
+            spool.write('\n')
+        spool.seek(0)
+        columns = [(attr, key in multi_valued, key in binary) \
+                for key, attr in attr_names.items()]
+        write_csv_rows(out, columns, (json.loads(line) for line in spool))
+
+
+def text_csv_rows(entries):
+    """ Convert LDAP entries to CSV rows, leaving binary values out """
+    skipped = set()
+    for dn, attrs in entries:
+        row = csv_row(dn, attrs)
+        for key, value in row.items():
+            if key == 'dn' or all(not is_binary for v, is_binary in value):
+                continue
+            row[key] = [(v, is_binary) for v, is_binary in value \
+                    if not is_binary]
+            if key.lower() not in skipped:
+                skipped.add(key.lower())
+                logging.warning("WARNING: Binary values of %s are left out " \
+                "of the CSV output, unless no attributes are given!", key)
+        yield row
+
+
+def write_csv_rows(out, columns, rows):
+    """ Write already converted CSV rows, with 'dn' as first column
+
+    Argument: columns (a list of (attr, is_multi_valued, is_base64) tuples)
+    """
+    csv_writer = csv.writer(out, delimiter=';', lineterminator='\n')
+    csv_writer.writerow(['dn'] + [csv_column(attr, is_multi, is_base64) \
+            for attr, is_multi, is_base64 in columns])
+    for row in rows:
+        # Attribute names are case insensitive!
+        row = {key.lower(): value for key, value in row.items()}
+        csv_writer.writerow([row['dn']] + [csv_value(row.get(attr.lower(), \
+                []), is_multi, is_base64) \
+                for attr, is_multi, is_base64 in columns])
+
+
+def csv_column(attr, is_multi, is_base64):
+    """ Get the CSV header of a column (ie: jpegPhoto::[]) """
+    if is_base64:
+        attr += BASE64_MARKER
+    if is_multi:
+        attr += MULTI_VALUE_MARKER
+    return attr
+
+
+def csv_value(value, is_multi, is_base64=False):
+    """ Get the CSV representation of the values of an attribute
+
+    Argument: value (a list of (value, is_binary) pairs, as given by
+    decode_value())
+    """
+    if is_base64:
+        # Text values of binary columns are encoded as well
+        value = [v if is_binary else b64encode(v.encode('utf-8')) \
+                .decode('ascii') for v, is_binary in value]
+    else:
+        value = [v for v, is_binary in value]
+    if is_multi:
+        return join_multi_value(value)
+    return value[0] if value else ''
+
+
+def csv_row(dn, attrs):
+    """ Convert an LDAP entry to a CSV row
+
+    Returns a dict of lists of (value, is_binary) pairs, besides the DN.
+    """
+    row = {key: [decode_value(v) for v in value] \
+            for key, value in attrs.items()}
+    # DN goes last, so that an attribute can't overwrite it
+    row['dn'] = dn
+    return row
+
+
+# Available output formats
+OUTPUT_WRITERS = {
+    'text': write_text,
+    'ldif': write_ldif,
+    'jsonl': write_jsonl,
+    'csv': write_csv,
+}
+
+
+def write_entries(entries, output_format='text', output_file=None, \
+        attrlist=None):
+    """ Write LDAP entries to stdout or to a file, in the given format """
+    if output_file:
+        out = open(output_file, 'w', buffering=OUTPUT_BUFFER_SIZE, newline='')
+    else:
+        out = sys.stdout
+    try:
+        OUTPUT_WRITERS[output_format](out, entries, attrlist)
+    finally:
+        if out is sys.stdout:
+            out.flush()
+        else:
+            out.close()
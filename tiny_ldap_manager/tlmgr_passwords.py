@@ -0,0 +1,185 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Hashing of userPassword values, before entries are added """
+
+import os
+import re
+import base64
+import hashlib
+import logging
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from tiny_ldap_manager.tlmgr_workers import chunked
+
+# The crypt module is much faster, where it's available (not on Windows, nor
+# on Python 3.13 or later)
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        import crypt
+except ImportError:
+    crypt = None
+
+# Attribute whose values are hashed
+PASSWORD_ATTR = 'userpassword'
+# Default cost of each scheme: rounds of CRYPT-SHA512, iterations of PBKDF2.
+# The salted SHA schemes have no cost at all.
+PASSWORD_SCHEMES = {
+    'SSHA': None,
+    'SSHA512': None,
+    'CRYPT-SHA512': 5000,
+    'PBKDF2-SHA512': 60000,
+}
+# Amount of entries handed over to a process at a time
+HASH_CHUNK_SIZE = 200
+# Values already hashed, which are left alone (ie: {SSHA}..., {CRYPT}...)
+HASHED_VALUE = re.compile(br'^\{[A-Za-z0-9.-]+\}')
+SALT_SIZE = 8
+# Alphabet of crypt(3), and of the "adapted base64" used by PBKDF2 hashes
+CRYPT_ALPHABET = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+# Order of the bytes of a SHA-512 digest in a SHA-512 crypt hash
+CRYPT_SHA512_ORDER = [((i, i + 21, i + 42) * 2)[i % 3:i % 3 + 3] \
+        for i in range(21)]
+
+
+def salted_sha(password, digest):
+    """ Hash a password as {SSHA} (SHA-1) or {SSHA512}, with a random salt """
+    salt = os.urandom(SALT_SIZE)
+    return base64.b64encode(hashlib.new(digest, password + salt).digest() \
+            + salt)
+
+
+def crypt_sha512(password, rounds, salt=None):
+    """ Hash a password with SHA-512 crypt ($6$), as glibc's crypt(3) does """
+    if salt is None:
+        salt = ''.join(CRYPT_ALPHABET[b % 64] for b in os.urandom(16))
+    rounds = min(max(rounds, 1000), 999999999)
+    if crypt is not None:
+        try:
+            hashed = crypt.crypt(password.decode('utf-8'), \
+                    '$6$rounds={}${}'.format(rounds, salt))
+        except UnicodeDecodeError:
+            hashed = None
+        if hashed and hashed.startswith('$6$'):
+            return hashed.encode('ascii')
+    salt_bytes = salt.encode('ascii')
+    size = len(password)
+    alternate = hashlib.sha512(password + salt_bytes + password).digest()
+    digest = hashlib.sha512(password + salt_bytes)
+    digest.update(repeat_bytes(alternate, size))
+    i = size
+    while i:
+        digest.update(alternate if i & 1 else password)
+        i >>= 1
+    digest = digest.digest()
+    p_bytes = repeat_bytes(hashlib.sha512(password * size).digest(), size)
+    s_bytes = repeat_bytes(hashlib.sha512(salt_bytes * (16 + digest[0])) \
+            .digest(), len(salt_bytes))
+    for i in range(rounds):
+        round_digest = hashlib.sha512(p_bytes if i & 1 else digest)
+        if i % 3:
+            round_digest.update(s_bytes)
+        if i % 7:
+            round_digest.update(p_bytes)
+        round_digest.update(digest if i & 1 else p_bytes)
+        digest = round_digest.digest()
+    encoded = ''.join(crypt_b64(digest[a] << 16 | digest[b] << 8 | digest[c], 4) \
+            for a, b, c in CRYPT_SHA512_ORDER) + crypt_b64(digest[63], 2)
+    return '$6$rounds={}${}${}'.format(rounds, salt, encoded).encode('ascii')
+
+
+def repeat_bytes(data, size):
+    """ Repeat some bytes until they're 'size' long """
+    return (data * (size // len(data) + 1))[:size]
+
+
+def crypt_b64(value, count):
+    """ Encode the lowest bits of a number with the alphabet of crypt(3) """
+    chars = []
+    for _ in range(count):
+        chars.append(CRYPT_ALPHABET[value & 0x3f])
+        value >>= 6
+    return ''.join(chars)
+
+
+def pbkdf2_sha512(password, iterations):
+    """ Hash a password with PBKDF2-SHA512, as OpenLDAP's pw-pbkdf2 does """
+    salt = os.urandom(16)
+    key = hashlib.pbkdf2_hmac('sha512', password, salt, iterations)
+    return b'$'.join((str(iterations).encode('ascii'), adapted_b64(salt), \
+            adapted_b64(key)))
+
+
+def adapted_b64(data):
+    """ Base64 without padding and with '.' instead of '+' """
+    return base64.b64encode(data).rstrip(b'=').replace(b'+', b'.')
+
+
+def hash_password(password, scheme, cost=None):
+    """ Hash a password, as a userPassword value (ie: b'{SSHA}...') """
+    if cost is None:
+        cost = PASSWORD_SCHEMES[scheme]
+    if scheme == 'SSHA':
+        return b'{SSHA}' + salted_sha(password, 'sha1')
+    if scheme == 'SSHA512':
+        return b'{SSHA512}' + salted_sha(password, 'sha512')
+    if scheme == 'CRYPT-SHA512':
+        return b'{CRYPT}' + crypt_sha512(password, cost)
+    if scheme == 'PBKDF2-SHA512':
+        return b'{PBKDF2-SHA512}' + pbkdf2_sha512(password, cost)
+    raise ValueError("unknown password scheme: {}".format(scheme))
+
+
+def hash_entry_passwords(entry, scheme, cost=None):
+    """ Hash the (cleartext) passwords of an LDAP entry, as a (dn, attrs) """
+    dn, attributes = entry
+    for attr, values in attributes.items():
+        if attr.lower() == PASSWORD_ATTR:
+            attributes[attr] = [value if HASHED_VALUE.match(value) \
+                    else hash_password(value, scheme, cost) for value in values]
+    return dn, attributes
+
+
+def hash_chunk(chunk, scheme, cost=None):
+    """ Hash the passwords of a chunk of (numbered) entries, in a process """
+    return [(record_num, hash_entry_passwords(entry, scheme, cost)) \
+            for record_num, entry in chunk]
+
+
+def hash_passwords(csv_entries, scheme, cost=None, processes=None, \
+        chunk_size=HASH_CHUNK_SIZE):
+    """ Hash the passwords of (numbered) entries, using every CPU core
+
+    Entries are handed over to a pool of processes in chunks, and yielded
+    back in the same order, as (record_num, entry) tuples. Since hashing is
+    CPU-bound, it's done on processes, while entries hashed already are
+    added to LDAP. Just a few chunks are kept in flight, so entries are still
+    read lazily.
+    """
+    processes = processes or os.cpu_count() or 1
+    logging.info("\nHashing passwords with %s, on %s processes...", scheme, \
+    processes)
+    with ProcessPoolExecutor(processes) as executor:
+        in_flight = deque()
+        for chunk in chunked(csv_entries, chunk_size):
+            in_flight.append(executor.submit(hash_chunk, chunk, scheme, cost))
+            if len(in_flight) > 2 * processes:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
@@ -0,0 +1,226 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Pipelined (asynchronous) LDAP operations for tiny-ldap-manager """
+
+import time
+import ldap
+import ldap.modlist as modlist
+from tiny_ldap_manager.tlmgr_session import ResilientLDAPObject
+from tiny_ldap_manager.tlmgr_session import CONNECTION_ERRORS
+from tiny_ldap_manager.tlmgr_session import TRANSIENT_ERRORS
+from tiny_ldap_manager.tlmgr_session import INTERRUPTED_INFO
+from tiny_ldap_manager.tlmgr_session import OperationInterrupted
+from tiny_ldap_manager.tlmgr_session import is_idempotent_modlist
+
+# Default amount of LDAP operations allowed to be in flight at once
+DEFAULT_WINDOW = 64
+
+# Operation which makes the pipeline wait for every outstanding operation to
+# complete, before sending the next one. Used for operations that depend on
+# the outcome of previous ones (ie: adding an entry below a new one).
+PIPELINE_BARRIER = object()
+# Kinds of operations which can be safely sent again, if the connection is
+# lost while they're in flight (modify operations depend on their modlist)
+IDEMPOTENT_KINDS = ('add', 'delete')
+
+
+def pipeline_operations(ldap_session, operations, window=DEFAULT_WINDOW):
+    """ Keep up to 'window' asynchronous LDAP operations in flight
+
+    Argument: operations (an iterable of (tag, send, kind, modlist) tuples,
+    as built by add_operation() and the like, where 'send' is a callable that
+    submits the operation on the given LDAP session and returns its message
+    id, 'kind' is the LDAP operation (ie: 'modify') and 'modlist' is the one
+    of a modify operation. PIPELINE_BARRIER can be found among them, too)
+
+    Yields a (tag, error) tuple for each completed operation, where 'error' is
+    None on success, or the LDAPError raised for that operation otherwise.
+
+    When the session is a ResilientLDAPObject, operations the server is too
+    busy to handle are sent again, after backing off. If the connection is
+    lost, the session reconnects and every operation in flight is sent again,
+    unless it can't be safely repeated: those are reported as failed with
+    OperationInterrupted, since there's no way to know whether they were
+    performed.
+    """
+    # Outstanding operations, indexed by the message id the server answers
+    # with. That's how results are matched back to their tags (ie: the DN).
+    # Each of them is kept as a (tag, send, kind, modlist, attempt, sent_at)
+    # tuple.
+    in_flight = {}
+    # Limits shared by every session of the pool, if any (see tlmgr_throttle)
+    throttle = getattr(ldap_session, 'throttle', None)
+    operations = iter(operations)
+    exhausted = False
+    draining = False
+    try:
+        while True:
+            # Fill up the window before waiting for any result
+            while not exhausted and not draining and len(in_flight) < window:
+                # Only wait for the throttle when there's nothing to wait for
+                if throttle is not None \
+                        and not throttle.acquire(blocking=not in_flight):
+                    break
+                try:
+                    operation = next(operations)
+                except StopIteration:
+                    exhausted = True
+                if exhausted or operation is PIPELINE_BARRIER:
+                    if throttle is not None:
+                        throttle.release()
+                    draining = not exhausted
+                    break
+                tag, send, kind, modlist = operation
+                try:
+                    yield from send_operation(ldap_session, in_flight, tag, \
+                            send, kind, modlist)
+                except ldap.SERVER_DOWN:
+                    raise
+                except ldap.LDAPError as err:
+                    if throttle is not None:
+                        throttle.release()
+                    yield tag, err
+            if in_flight:
+                # Nothing to hand over when the operation was sent again
+                yield from wait_for_any_result(ldap_session, in_flight)
+            elif draining:
+                draining = False
+            else:
+                break
+    finally:
+        # Operations left behind (ie: the pipeline was interrupted)
+        if throttle is not None:
+            for _ in in_flight:
+                throttle.release()
+
+
+def can_retry(ldap_session, attempt):
+    """ Check whether an operation can be sent once more on a session """
+    return isinstance(ldap_session, ResilientLDAPObject) \
+            and ldap_session.can_retry(attempt)
+
+
+def is_idempotent_operation(kind, modlist=None):
+    """ Check whether sending an operation twice has the same outcome as once
+
+    Repeated adds and deletes end up with the same outcome (even if they're
+    reported as already done), unlike renames.
+    """
+    if kind == 'modify':
+        return is_idempotent_modlist(modlist)
+    return kind in IDEMPOTENT_KINDS
+
+
+def send_operation(ldap_session, in_flight, tag, send, kind, modlist=None, \
+        attempt=0):
+    """ Send an operation, keeping track of it while it's in flight
+
+    Returns a list with the (tag, error) tuples of the operations in flight
+    which couldn't be sent again, if the connection was lost.
+    """
+    try:
+        in_flight[send(ldap_session)] = (tag, send, kind, modlist, attempt, \
+                time.monotonic())
+        return []
+    except CONNECTION_ERRORS:
+        if not can_retry(ldap_session, attempt):
+            raise
+        # The operation failed to be sent, so it's safe to send it again
+        interrupted = resend_lost_operations(ldap_session, in_flight)
+        return interrupted + send_operation(ldap_session, in_flight, tag, \
+                send, kind, modlist, attempt + 1)
+
+
+def resend_lost_operations(ldap_session, in_flight):
+    """ Reconnect, and send again every operation that was in flight
+
+    Operations that can't be safely repeated aren't sent again. Returns a
+    list with a (tag, OperationInterrupted) tuple for each of them.
+    """
+    ldap_session.reconnect_with_backoff()
+    lost = list(in_flight.values())
+    in_flight.clear()
+    throttle = getattr(ldap_session, 'throttle', None)
+    interrupted = []
+    for tag, send, kind, modlist, attempt, sent_at in lost:
+        if not is_idempotent_operation(kind, modlist):
+            if throttle is not None:
+                throttle.release(sent_at)
+            interrupted.append((tag, OperationInterrupted(\
+                    dict(INTERRUPTED_INFO))))
+            continue
+        ldap_session.retry_counts['retries'] += 1
+        interrupted.extend(send_operation(ldap_session, in_flight, tag, send, \
+                kind, modlist, attempt + 1))
+    return interrupted
+
+
+def wait_for_any_result(ldap_session, in_flight):
+    """ Wait for the next completed operation and match it to its tag
+
+    Returns a list of (tag, error) tuples: empty if the operation had to be
+    sent again, or with the operations that couldn't be, if the connection
+    was lost.
+    """
+    try:
+        msgid = ldap_session.result3(ldap.RES_ANY, all=1)[2]
+        error = None
+    except CONNECTION_ERRORS:
+        if not can_retry(ldap_session, max(operation[4] \
+                for operation in in_flight.values())):
+            raise
+        return resend_lost_operations(ldap_session, in_flight)
+    except ldap.LDAPError as err:
+        # python-ldap adds the message id of the failed operation to the
+        # exception's info dict.
+        msgid = err.args[0].get('msgid') if err.args else None
+        if msgid not in in_flight:
+            raise
+        error = err
+    tag, send, kind, modlist, attempt, sent_at = in_flight.pop(msgid)
+    if isinstance(error, TRANSIENT_ERRORS) and can_retry(ldap_session, attempt):
+        ldap_session.wait_before_retry(attempt)
+        return send_operation(ldap_session, in_flight, tag, send, kind, \
+                modlist, attempt + 1)
+    throttle = getattr(ldap_session, 'throttle', None)
+    if throttle is not None:
+        throttle.release(sent_at)
+    return [(tag, error)]
+
+
+def add_operation(dn, attributes, tag=None):
+    """ Build a pipeline operation that adds an LDAP entry
+
+    Argument: tag (what the outcome of the operation is reported with, which
+    is the DN unless given)
+    """
+    ldif = modlist.addModlist(attributes)
+    return dn if tag is None else tag, lambda ldap_session: ldap_session.add_ext(dn, ldif), \
+            'add', None
+
+
+def delete_operation(dn, tag=None):
+    """ Build a pipeline operation that deletes an LDAP entry """
+    return dn if tag is None else tag, lambda ldap_session: ldap_session.delete_ext(dn), \
+            'delete', None
+
+
+def modify_operation(dn, modlist, tag=None):
+    """ Build a pipeline operation that modifies an LDAP entry """
+    return dn if tag is None else tag, lambda ldap_session: ldap_session.modify_ext(dn, \
+            modlist), 'modify', modlist
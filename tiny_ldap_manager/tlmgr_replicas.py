@@ -0,0 +1,208 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Reads spread across read replicas, while writes go to the primary """
+
+import time
+import logging
+import ldap
+from ldap.cidict import cidict
+from tiny_ldap_manager.tlmgr_session import CONNECTION_ERRORS
+from tiny_ldap_manager.tlmgr_session import TRANSIENT_ERRORS
+
+# Errors telling that a replica can't be read from right now
+REPLICA_ERRORS = CONNECTION_ERRORS + TRANSIENT_ERRORS
+# Seconds a failed replica is left alone, before reading from it again
+REPLICA_RETRY_DELAY = 30.0
+# Seconds a replica is given to catch up with the primary (read-your-writes)
+DEFAULT_REPLICA_WAIT = 5
+# Seconds between checks of whether a replica caught up
+REPLICA_POLL_DELAY = 0.1
+
+
+def fetch_context_csn(ldap_session, suffixes=('',)):
+    """ Read the contextCSN of the databases of a server
+
+    Returns a dict with the latest CSN of each server ID, since there's one
+    for each provider in multi-provider setups.
+    """
+    csns = {}
+    for suffix in suffixes:
+        try:
+            ldap_data = ldap_session.search_s(suffix, ldap.SCOPE_BASE, \
+                    '(objectClass=*)', ['contextCSN'])
+        except ldap.NO_SUCH_OBJECT:
+            continue
+        for dn, attrs in ldap_data:
+            if dn is None:
+                continue
+            for value in cidict(attrs).get('contextCSN', []):
+                # ie: 20201231235959.123456Z#000000#001#000000
+                csn = value.decode('ascii')
+                fields = csn.split('#')
+                sid = fields[2] if len(fields) > 2 else ''
+                csns[sid] = max(csns.get(sid, csn), csn)
+    return csns
+
+
+def csn_reached(csns, target_csns):
+    """ Check whether a server has every change told by some contextCSN """
+    # CSNs start with a timestamp of fixed length, so they sort as strings
+    return all(csns.get(sid, '') >= csn for sid, csn in target_csns.items())
+
+
+class ReplicaSet:
+    """ Read replicas of the primary server an LDAP session writes to
+
+    Reads are spread across the replicas, in turns, skipping the ones which
+    recently failed. With read-your-writes, a replica is only read from once
+    its contextCSN shows the latest writes of the session.
+    """
+
+    def __init__(self, primary, uris, replicas, read_your_writes=False, \
+            max_wait=DEFAULT_REPLICA_WAIT):
+        self.primary = primary
+        # Every replica given, even those which couldn't be bound
+        self.uris = uris
+        self.replicas = replicas
+        self.read_your_writes = read_your_writes
+        self.max_wait = max_wait
+        self.next_replica = 0
+        self.down_until = [0.0] * len(replicas)
+        # Writes of the primary session each replica is known to have
+        self.synced_writes = [0] * len(replicas)
+        self.target_writes = 0
+        self.target_csns = {}
+        self.suffixes = None
+        self.stats = {'replica_reads': 0, 'primary_reads': 0, 'failovers': 0, \
+                'lagging': 0}
+
+    def available(self):
+        """ Yield the replicas to read from, in the order they're tried """
+        count = len(self.replicas)
+        if not count:
+            return
+        start = self.next_replica
+        self.next_replica = (start + 1) % count
+        for index in [(start + i) % count for i in range(count)]:
+            if self.down_until[index] > time.monotonic():
+                continue
+            if self.read_your_writes and not self.caught_up(index):
+                continue
+            yield self.replicas[index]
+
+    def mark_down(self, replica, err):
+        """ Leave a replica alone for a while, since it failed """
+        index = self.replicas.index(replica)
+        self.down_until[index] = time.monotonic() + REPLICA_RETRY_DELAY
+        self.stats['failovers'] += 1
+        info = err.args[0] if err.args and isinstance(err.args[0], dict) else {}
+        logging.warning("Replica %s failed (%s): reading from other servers " \
+        "for %s seconds.", replica_uri(replica), info.get('desc', err), \
+        int(REPLICA_RETRY_DELAY))
+
+    def caught_up(self, index):
+        """ Wait for a replica to have the latest writes of the session
+
+        Returns False if it's still behind after 'max_wait' seconds.
+        """
+        writes = self.primary.writes
+        if self.synced_writes[index] == writes:
+            return True
+        replica = self.replicas[index]
+        try:
+            if self.suffixes is None:
+                self.suffixes = [''] + fetch_naming_contexts(self.primary)
+            if self.target_writes != writes:
+                self.target_csns = fetch_context_csn(self.primary, \
+                        self.suffixes)
+                self.target_writes = writes
+            deadline = time.monotonic() + self.max_wait
+            while not csn_reached(fetch_context_csn(replica, self.suffixes), \
+                    self.target_csns):
+                if time.monotonic() >= deadline:
+                    self.stats['lagging'] += 1
+                    return False
+                time.sleep(REPLICA_POLL_DELAY)
+        except REPLICA_ERRORS as err:
+            self.mark_down(replica, err)
+            return False
+        self.synced_writes[index] = writes
+        return True
+
+    def unbind(self):
+        """ Close the connections to every replica """
+        for replica in self.replicas:
+            # Replicas that failed to reconnect have no connection left
+            if not hasattr(replica, '_l'):
+                continue
+            try:
+                replica.unbind()
+            except ldap.LDAPError:
+                pass
+
+
+def replica_uri(replica):
+    """ Get the URI of the server of a replica session """
+    return getattr(replica, '_uri', '?')
+
+
+def fetch_naming_contexts(ldap_session):
+    """ Read the base DNs of the databases of a server, from the root DSE """
+    try:
+        ldap_data = ldap_session.search_s('', ldap.SCOPE_BASE, \
+                '(objectClass=*)', ['namingContexts'])
+    except ldap.LDAPError:
+        return []
+    return [value.decode('utf-8') for dn, attrs in ldap_data \
+            for value in cidict(attrs or {}).get('namingContexts', [])]
+
+
+def read_with_failover(ldap_session, read):
+    """ Read from a replica of an LDAP session, or from its own server
+
+    Argument: read (called with the session to read from)
+
+    Replicas are tried in turns, and the primary server is read from if none
+    of them can be.
+    """
+    replicas = getattr(ldap_session, 'replicas', None)
+    if replicas is None:
+        return read(ldap_session)
+    for replica in replicas.available():
+        try:
+            result = read(replica)
+        except REPLICA_ERRORS as err:
+            replicas.mark_down(replica, err)
+            continue
+        replicas.stats['replica_reads'] += 1
+        return result
+    replicas.stats['primary_reads'] += 1
+    return read(ldap_session)
+
+
+def log_replica_reads(ldap_pool):
+    """ Show how reads were spread across the replicas and the primary """
+    replica_sets = [ldap_session.replicas for ldap_session in ldap_pool \
+            if getattr(ldap_session, 'replicas', None) is not None]
+    if not replica_sets:
+        return
+    stats = {name: sum(replicas.stats[name] for replicas in replica_sets) \
+            for name in replica_sets[0].stats}
+    logging.info("\nReads: %s from replicas, %s from the primary (%s " \
+    "failovers, %s while replicas were behind)", stats['replica_reads'], \
+    stats['primary_reads'], stats['failovers'], stats['lagging'])
@@ -0,0 +1,280 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" LDAP sessions which survive transient failures, for tiny-ldap-manager """
+
+import time
+import random
+import logging
+import ldap
+import ldap.dn
+from ldap.ldapobject import SimpleLDAPObject
+from ldap.ldapobject import ReconnectLDAPObject
+from tiny_ldap_manager.tlmgr_metrics import payload_size
+
+# Errors telling that the connection to the server has been lost
+CONNECTION_ERRORS = (ldap.SERVER_DOWN, ldap.TIMEOUT)
+# Results telling that the server can't handle an operation right now
+TRANSIENT_ERRORS = (ldap.BUSY, ldap.UNAVAILABLE)
+# Amount of times an operation is retried, before giving up
+DEFAULT_MAX_RETRIES = 5
+# Delays (in seconds) of the exponential backoff between retries
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+# Synchronous methods which write to LDAP (see tlmgr_throttle)
+WRITE_METHODS = (
+    SimpleLDAPObject.add_ext_s,
+    SimpleLDAPObject.delete_ext_s,
+    SimpleLDAPObject.modify_ext_s,
+    SimpleLDAPObject.rename_s,
+)
+# Synchronous methods which can't be safely sent twice
+NON_IDEMPOTENT_METHODS = (
+    SimpleLDAPObject.rename_s,
+    SimpleLDAPObject.passwd_s,
+    SimpleLDAPObject.extop_s,
+)
+# Info of the OperationInterrupted errors
+INTERRUPTED_INFO = {'desc': "Connection lost while the operation was in " \
+        "progress", 'info': "it's unknown whether it was performed"}
+
+
+def backoff_delay(attempt):
+    """ Get the time to wait before retrying, with "full jitter"
+
+    The delay grows exponentially with each attempt, but a random part of it
+    is taken, so that many sessions don't retry all at once.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def is_idempotent_modlist(modlist):
+    """ Check whether applying a modlist twice has the same outcome as once
+
+    That's the case when each value added or removed belongs to an attribute
+    whose values were previously replaced or removed altogether.
+    """
+    cleared = set()
+    for op, attr, values in modlist:
+        if op == ldap.MOD_REPLACE or (op == ldap.MOD_DELETE and values is None):
+            cleared.add(attr.lower())
+        elif attr.lower() not in cleared:
+            return False
+    return True
+
+
+def is_idempotent_call(func, args, kwargs):
+    """ Check whether a synchronous method call can be safely repeated """
+    if func in NON_IDEMPOTENT_METHODS:
+        return False
+    if func is SimpleLDAPObject.modify_ext_s:
+        modlist = args[1] if len(args) > 1 else kwargs.get('modlist')
+        return is_idempotent_modlist(modlist)
+    # Repeated adds and deletes end up with the same outcome (even if they're
+    # reported as already done).
+    return True
+
+
+def renamed_dn(dn, newrdn, newsuperior=None, *args, **kwargs):
+    """ Get the DN an entry ends up with, once renamed by a modrdn """
+    if newsuperior is None:
+        try:
+            newsuperior = ldap.dn.dn2str(ldap.dn.str2dn(dn)[1:])
+        except ldap.DECODING_ERROR:
+            return None
+    return '{},{}'.format(newrdn, newsuperior) if newsuperior else newrdn
+
+
+class OperationInterrupted(ldap.LDAPError):
+    """ The connection was lost while a non-idempotent operation was sent
+
+    The session is connected again, but there's no way to know whether the
+    operation was performed, so it isn't sent again.
+    """
+
+
+class ResilientLDAPObject(ReconnectLDAPObject):
+    """ LDAP session that reconnects (and re-binds) when connection is lost
+
+    Synchronous operations are retried, with jittered exponential backoff,
+    when the connection is lost (as long as they're idempotent) or when the
+    server is busy or unavailable. Asynchronous ones are retried by the
+    pipeline (see tlmgr_pipeline), with the help of this session.
+
+    Every operation is measured as well, once a job starts measuring them
+    (see tlmgr_metrics), and every entry written is dropped from the entry
+    cache of the session, if any (see tlmgr_core). Writes are counted, so
+    that replicas can tell whether they have them (see tlmgr_replicas).
+    """
+
+    def __init__(self, uri, max_retries=DEFAULT_MAX_RETRIES, **kwargs):
+        ReconnectLDAPObject.__init__(self, uri, retry_max=1, retry_delay=0, \
+                **kwargs)
+        self.max_retries = max_retries
+        self.retry_counts = {'reconnects': 0, 'retries': 0}
+        self.writes = 0
+        # Operations in flight, when measured: {msgid: (operation, sent_at)}
+        self._measured = {}
+
+    def can_retry(self, attempt):
+        """ Check whether an operation can be retried once more """
+        # Don't insist on a session that was never bound (ie: wrong URI)!
+        return self._last_bind is not None and attempt < self.max_retries
+
+    def wait_before_retry(self, attempt):
+        """ Back off before retrying an operation the server refused """
+        self.retry_counts['retries'] += 1
+        time.sleep(backoff_delay(attempt))
+
+    def reconnect_with_backoff(self):
+        """ Connect and bind to the server again, backing off between tries """
+        for attempt in range(self.max_retries + 1):
+            time.sleep(backoff_delay(attempt))
+            try:
+                self.reconnect(self._uri, retry_max=1, retry_delay=0, \
+                        force=True)
+            except CONNECTION_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+                continue
+            self.retry_counts['reconnects'] += 1
+            # Operations sent through the lost connection won't complete
+            self._measured.clear()
+            logging.warning("Connection to %s lost: reconnected!", self._uri)
+            return
+
+    def _apply_method_s(self, func, *args, **kwargs):
+        """ Call a synchronous method, retrying it when possible """
+        # Connect again first, if the session lost its connection for good
+        # (ie: it failed to reconnect), as ReconnectLDAPObject does
+        if not hasattr(self, '_l'):
+            self.reconnect(self._uri, retry_max=self._retry_max, \
+                    retry_delay=self._retry_delay, force=False)
+        # Writes are subject to the limits of the bulk job, if any
+        throttle = getattr(self, 'throttle', None)
+        if throttle is not None and func in WRITE_METHODS:
+            with throttle.slot():
+                return self._retry_method_s(func, *args, **kwargs)
+        return self._retry_method_s(func, *args, **kwargs)
+
+    def _retry_method_s(self, func, *args, **kwargs):
+        """ Call a synchronous method, retrying it as many times as needed """
+        attempt = 0
+        while True:
+            try:
+                return func(self, *args, **kwargs)
+            except TRANSIENT_ERRORS:
+                if not self.can_retry(attempt):
+                    raise
+                self.wait_before_retry(attempt)
+            except CONNECTION_ERRORS:
+                if not self.can_retry(attempt):
+                    raise
+                self.reconnect_with_backoff()
+                if not is_idempotent_call(func, args, kwargs):
+                    raise OperationInterrupted(dict(INTERRUPTED_INFO))
+                self.retry_counts['retries'] += 1
+            attempt += 1
+
+    def _measure(self, operation, method, *args, **kwargs):
+        """ Send an asynchronous operation, keeping track of it if measured
+
+        Synchronous methods end up here as well, since python-ldap builds
+        them on top of the asynchronous ones.
+        """
+        metrics = getattr(self, 'metrics', None)
+        if metrics is None:
+            return method(self, *args, **kwargs)
+        sent_at = time.monotonic()
+        msgid = method(self, *args, **kwargs)
+        self._measured[msgid] = (operation, sent_at)
+        metrics.sent(payload_size(args) + payload_size(kwargs))
+        return msgid
+
+    def _track_write(self, dn, subtree=False):
+        """ Count a write, dropping the entry from the entry cache """
+        self.writes += 1
+        entry_cache = getattr(self, 'entry_cache', None)
+        if entry_cache is not None and dn:
+            entry_cache.invalidate(dn, subtree)
+
+    def add_ext(self, *args, **kwargs):
+        """ Send an add operation, measuring it if needed """
+        self._track_write(args[0] if args else kwargs.get('dn'))
+        return self._measure('add', ReconnectLDAPObject.add_ext, \
+                *args, **kwargs)
+
+    def delete_ext(self, *args, **kwargs):
+        """ Send a delete operation, measuring it if needed """
+        # Controls (ie: Tree Delete) may remove the entries below it as well
+        serverctrls = args[1] if len(args) > 1 else kwargs.get('serverctrls')
+        self._track_write(args[0] if args else kwargs.get('dn'), \
+                bool(serverctrls))
+        return self._measure('delete', ReconnectLDAPObject.delete_ext, \
+                *args, **kwargs)
+
+    def modify_ext(self, *args, **kwargs):
+        """ Send a modify operation, measuring it if needed """
+        self._track_write(args[0] if args else kwargs.get('dn'))
+        return self._measure('modify', ReconnectLDAPObject.modify_ext, \
+                *args, **kwargs)
+
+    def rename(self, *args, **kwargs):
+        """ Send a modrdn operation, measuring it if needed """
+        # Entries below it are renamed as well
+        self._track_write(args[0] if args else kwargs.get('dn'), True)
+        self._track_write(renamed_dn(*args, **kwargs))
+        return self._measure('modrdn', ReconnectLDAPObject.rename, \
+                *args, **kwargs)
+
+    def search_ext(self, *args, **kwargs):
+        """ Send a search operation, measuring it if needed """
+        return self._measure('search', ReconnectLDAPObject.search_ext, \
+                *args, **kwargs)
+
+    def result4(self, *args, **kwargs):
+        """ Wait for a result, measuring the operation it belongs to """
+        metrics = getattr(self, 'metrics', None)
+        if metrics is None:
+            return ReconnectLDAPObject.result4(self, *args, **kwargs)
+        try:
+            result = ReconnectLDAPObject.result4(self, *args, **kwargs)
+        except ldap.LDAPError as err:
+            info = err.args[0] if err.args else None
+            measured = self._measured.pop(info.get('msgid'), None) \
+                    if isinstance(info, dict) else None
+            if measured is not None:
+                operation, sent_at = measured
+                metrics.completed(operation, time.monotonic() - sent_at, \
+                        error=err)
+            raise
+        measured = self._measured.pop(result[2], None)
+        if measured is not None:
+            operation, sent_at = measured
+            metrics.completed(operation, time.monotonic() - sent_at, \
+                    payload_size(result[1]))
+        return result
+
+
+def log_retry_counts(ldap_pool):
+    """ Show how many times the connection was lost and operations retried """
+    reconnects = sum(ldap_session.retry_counts['reconnects'] \
+            for ldap_session in ldap_pool)
+    retries = sum(ldap_session.retry_counts['retries'] \
+            for ldap_session in ldap_pool)
+    logging.info("\nConnection retries: %s reconnections, %s retried " \
+    "operations", reconnects, retries)
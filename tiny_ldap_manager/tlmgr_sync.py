@@ -0,0 +1,246 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Sync LDAP entries with a desired state, for tiny-ldap-manager """
+
+import os
+import logging
+import ldap
+import ldap.dn
+import ldap.modlist as modlist
+from tiny_ldap_manager.tlmgr_core import entry_log
+from tiny_ldap_manager.tlmgr_core import ask_user_confirmation
+from tiny_ldap_manager.tlmgr_core import describe_ldap_error
+from tiny_ldap_manager.tlmgr_core import normalize_dn
+from tiny_ldap_manager.tlmgr_core import paged_search
+from tiny_ldap_manager.tlmgr_core import DEFAULT_PAGE_SIZE
+from tiny_ldap_manager.tlmgr_csv import process_csv_entries
+from tiny_ldap_manager.tlmgr_csv import DEFAULT_MULTI_VALUE_SEPARATOR
+from tiny_ldap_manager.tlmgr_ldif import LDIFChangeRecordParser
+from tiny_ldap_manager.tlmgr_pipeline import pipeline_operations
+from tiny_ldap_manager.tlmgr_pipeline import add_operation
+from tiny_ldap_manager.tlmgr_pipeline import modify_operation
+from tiny_ldap_manager.tlmgr_pipeline import delete_operation
+from tiny_ldap_manager.tlmgr_pipeline import PIPELINE_BARRIER
+from tiny_ldap_manager.tlmgr_pipeline import DEFAULT_WINDOW
+
+# Attributes whose values are compared regardless of their case
+SYNC_CASE_IGNORE_ATTRS = ['objectClass']
+
+
+def read_ldif_entries(ldif_file):
+    """ Read LDAP entries from an LDIF file, one at a time
+
+    Yields a (dn, attributes) tuple for each entry. Change records other than
+    'add' make no sense for a desired state, so they are skipped.
+    """
+    with open(ldif_file, 'rb') as f:
+        for line_num, dn, changetype, lines, controls in \
+                LDIFChangeRecordParser(f).records():
+            if changetype != 'add':
+                logging.warning("ERROR: Unexpected LDIF %s record for %s at " \
+                "line %s: only entries are allowed!", changetype, dn, line_num)
+                continue
+            attributes = {}
+            for attr, value in lines:
+                attributes.setdefault(attr, []).append(value)
+            yield dn, attributes
+
+
+def index_desired_entries(entries):
+    """ Build a hash index of the desired entries, keyed by normalized DN """
+    desired = {}
+    for dn, attributes in entries:
+        if not ldap.dn.is_dn(dn):
+            logging.warning("ERROR: %s is not a valid DN !", dn)
+            continue
+        key = normalize_dn(dn)
+        if key in desired:
+            logging.warning("ERROR: Duplicated entry for %s: only the last " \
+            "one is taken into account!", dn)
+        desired[key] = (dn, attributes)
+    return desired
+
+
+def common_base_dn(dns):
+    """ Get the deepest DN which every given (normalized) DN is below of """
+    base = None
+    for dn in dns:
+        rdns = ldap.dn.str2dn(dn)
+        if base is None:
+            base = rdns
+            continue
+        common = 0
+        while common < min(len(base), len(rdns)) \
+                and base[-1 - common] == rdns[-1 - common]:
+            common += 1
+        base = base[len(base) - common:]
+    return ldap.dn.dn2str(base) if base else ''
+
+
+def compute_sync_changes(ldap_session, desired, basedn, filterstr, \
+        delete_extra=False, page_size=DEFAULT_PAGE_SIZE):
+    """ Compare the desired entries with the live ones below 'basedn'
+
+    Live entries are retrieved with a paged search, restricted to the
+    attributes found in the desired state, and matched to the desired entries
+    through their DNs. Only the attributes given for each desired entry are
+    compared.
+
+    Returns an (adds, modifies, deletes, unchanged) tuple.
+    """
+    attrlist = {}
+    for dn, attributes in desired.values():
+        for attr in attributes:
+            attrlist.setdefault(attr.lower(), attr)
+    # Extra entries that must be kept, since desired ones are below them
+    ancestors = {normalize_dn(basedn)}
+    for key in desired:
+        rdns = ldap.dn.str2dn(key)
+        ancestors.update(ldap.dn.dn2str(rdns[i:]) for i in range(1, len(rdns)))
+
+    pending = set(desired)
+    modifies = []
+    deletes = []
+    unchanged = 0
+    # Changes are computed from the primary server, since a replica might
+    # not have its latest writes yet.
+    live_entries = paged_search(ldap_session, basedn, ldap.SCOPE_SUBTREE, \
+            filterstr, list(attrlist.values()) or ['1.1'], page_size, \
+            primary=True)
+    try:
+        for dn, attrs in live_entries:
+            key = normalize_dn(dn)
+            if key in pending:
+                pending.discard(key)
+                modops = modlist.modifyModlist(attrs, desired[key][1], \
+                        ignore_oldexistent=1, \
+                        case_ignore_attr_types=SYNC_CASE_IGNORE_ATTRS)
+                if modops:
+                    modifies.append((dn, modops))
+                else:
+                    unchanged += 1
+            elif delete_extra and key not in ancestors:
+                deletes.append(dn)
+    except ldap.NO_SUCH_OBJECT:
+        # The base DN doesn't exist yet, so every entry has to be added
+        pass
+    adds = [desired[key] for key in desired if key in pending]
+    return adds, modifies, deletes, unchanged
+
+
+def group_by_depth(items, dn_of, deepest_first=False):
+    """ Group items by the depth of their DN """
+    levels = {}
+    for item in items:
+        levels.setdefault(len(ldap.dn.str2dn(dn_of(item))), []).append(item)
+    return [levels[depth] for depth in sorted(levels, reverse=deepest_first)]
+
+
+def sync_operations(adds, modifies, deletes):
+    """ Turn the computed changes into pipeline operations
+
+    Parents are added before their children, and children are deleted before
+    their parents, so a PIPELINE_BARRIER is placed between every level.
+    """
+    for level in group_by_depth(adds, lambda add: add[0]):
+        yield PIPELINE_BARRIER
+        for dn, attributes in level:
+            yield add_operation(dn, attributes, tag=('add', dn))
+    for dn, modops in modifies:
+        yield modify_operation(dn, modops, tag=('modify', dn))
+    for level in group_by_depth(deletes, lambda dn: dn, deepest_first=True):
+        yield PIPELINE_BARRIER
+        for dn in level:
+            yield delete_operation(dn, tag=('delete', dn))
+
+
+def apply_sync_changes(ldap_session, adds, modifies, deletes, \
+        window=DEFAULT_WINDOW):
+    """ Send the computed changes to LDAP, reporting the outcome of each one
+
+    Returns the amount of failed changes.
+    """
+    failed = 0
+    for tag, error in pipeline_operations(ldap_session, \
+            sync_operations(adds, modifies, deletes), window):
+        operation, dn = tag
+        if error is not None:
+            failed += 1
+            logging.warning("ERROR: Failed to %s LDAP entry: %s. %s", \
+            operation, dn, describe_ldap_error(error))
+        elif operation == 'add':
+            entry_log.info("Adding LDAP entry: %s", dn)
+        elif operation == 'modify':
+            entry_log.info("Modified LDAP entry: %s", dn)
+        else:
+            entry_log.info("Successfully removed LDAP entry: %s", dn)
+    return failed
+
+
+def ldap_sync(ldap_session, sync_file, basedn=None, \
+        filterstr='(objectClass=*)', delete_extra=False, \
+        window=DEFAULT_WINDOW, page_size=DEFAULT_PAGE_SIZE, \
+        separator=DEFAULT_MULTI_VALUE_SEPARATOR, literals=False):
+    """ Make LDAP entries match the desired state given by a CSV/LDIF file
+
+    Returns 1 if the file couldn't be read or some change failed, or 0.
+    """
+    # Checked beforehand, since reading a missing CSV file ends the program
+    if not os.path.isfile(sync_file):
+        logging.critical("\nERROR: file %s not found!", sync_file)
+        return 1
+    try:
+        if sync_file.lower().endswith('.ldif'):
+            entries = read_ldif_entries(sync_file)
+        else:
+            entries = process_csv_entries(sync_file, separator, literals)
+        desired = index_desired_entries(entries)
+    except IOError:
+        logging.critical("\nERROR: file %s not found!", sync_file)
+        return 1
+    except ValueError as err:
+        # Going on with a partial desired state could delete entries!
+        logging.critical("\nERROR: Wrong LDIF formatted content found: %s", err)
+        return 1
+    if not desired:
+        logging.info("Empty file or wrong format: nothing to process!\n")
+        return 0
+    if basedn is None:
+        basedn = common_base_dn(desired)
+        if not basedn:
+            logging.critical("\nERROR: Entries don't share a common base DN. " \
+            "Please, specify one!\n")
+            return 1
+
+    logging.info("\nComparing %s entries with the LDAP entries below %s...\n", \
+    len(desired), basedn)
+    adds, modifies, deletes, unchanged = compute_sync_changes(ldap_session, \
+            desired, basedn, filterstr, delete_extra, page_size)
+    if not adds and not modifies and not deletes:
+        logging.info("Nothing to do: every LDAP entry is already up to date!\n")
+        return 0
+    logging.info("\nATTENTION: %s LDAP entries will be added, %s modified and " \
+    "%s deleted (%s already up to date)!\n", len(adds), len(modifies), \
+    len(deletes), unchanged)
+    if ask_user_confirmation():
+        failed = apply_sync_changes(ldap_session, adds, modifies, deletes, \
+                window)
+        logging.info("\nSync finished: %s changes applied, %s failed.", \
+        len(adds) + len(modifies) + len(deletes) - failed, failed)
+        return 1 if failed else 0
+    return 0
@@ -0,0 +1,120 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Rate limiting and adaptive concurrency of LDAP writes in bulk """
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+# Default latency (in milliseconds) the adaptive mode aims not to go over
+DEFAULT_TARGET_LATENCY = 100
+# Amount of operations in flight the adaptive mode starts with
+ADAPTIVE_INITIAL_WINDOW = 4
+
+
+class WriteThrottle:
+    """ Limits how fast (and how many at once) LDAP writes are sent
+
+    It's shared by every session of a pool (see tlmgr_pipeline and
+    tlmgr_session), so limits apply to the whole bulk job.
+
+    In adaptive mode, the amount of writes in flight follows AIMD: it grows
+    by one for every window's worth of writes faster than the target latency,
+    and it's halved whenever a write is slower than that.
+    """
+
+    def __init__(self, max_window, max_ops_per_sec=None, target_latency=None):
+        self.max_window = max_window
+        self.interval = 1.0 / max_ops_per_sec if max_ops_per_sec else None
+        # Target latency, in seconds (None when not in adaptive mode)
+        self.target_latency = target_latency
+        self.window = None
+        if target_latency is not None:
+            self.window = float(min(max_window, ADAPTIVE_INITIAL_WINDOW))
+        self.in_flight = 0
+        self.next_slot = time.monotonic()
+        self.last_decrease = time.monotonic()
+        self.decreases = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, blocking=True):
+        """ Wait until another write can be sent
+
+        Returns False if it can't be sent right away and 'blocking' is False.
+        """
+        with self.condition:
+            while self.window is not None and self.in_flight >= int(self.window):
+                if not blocking:
+                    return False
+                self.condition.wait()
+            self.in_flight += 1
+            if self.interval is None:
+                return True
+            # Writes are evenly spaced out, so the rate is never exceeded
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+        return True
+
+    def release(self, sent_at=None):
+        """ Tell that a write sent at 'sent_at' (if known) has completed """
+        with self.condition:
+            self.in_flight -= 1
+            if sent_at is not None and self.target_latency is not None:
+                self.adapt(time.monotonic() - sent_at, sent_at)
+            self.condition.notify_all()
+
+    def adapt(self, latency, sent_at):
+        """ Resize the window given the latency of a write (AIMD) """
+        if latency > self.target_latency:
+            # Writes sent before the last decrease already had their say
+            if sent_at > self.last_decrease and self.window > 1:
+                self.window = max(1.0, self.window / 2)
+                self.last_decrease = time.monotonic()
+                self.decreases += 1
+        else:
+            self.window = min(float(self.max_window), \
+                    self.window + 1 / self.window)
+
+    @contextmanager
+    def slot(self):
+        """ Context manager around a synchronous write """
+        self.acquire()
+        sent_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(sent_at)
+
+    def log_summary(self):
+        """ Show how the adaptive window ended up """
+        if self.window is not None:
+            logging.info("\nAdaptive window: %s writes in flight at the end " \
+            "(halved %s times)", int(self.window), self.decreases)
+
+
+def build_write_throttle(window, max_ops_per_sec=None, adaptive=False, \
+        target_latency=DEFAULT_TARGET_LATENCY):
+    """ Build the throttle of a bulk job, if any limit was asked for """
+    if not max_ops_per_sec and not adaptive:
+        return None
+    return WriteThrottle(window, max_ops_per_sec, \
+            target_latency / 1000.0 if adaptive else None)
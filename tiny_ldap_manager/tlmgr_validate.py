@@ -0,0 +1,389 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Pre-flight validation of the input files of bulk jobs """
+
+import os
+import csv
+import logging
+from base64 import b64decode
+from functools import partial
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import ldap
+import ldap.dn
+from ldap.schema import SubSchema
+from ldap.schema import AttributeType
+from tiny_ldap_manager.tlmgr_core import dn_key
+from tiny_ldap_manager.tlmgr_csv import sanitize_csv_entry
+from tiny_ldap_manager.tlmgr_csv import split_multi_value
+from tiny_ldap_manager.tlmgr_csv import check_csv_literals
+from tiny_ldap_manager.tlmgr_csv import parse_column
+from tiny_ldap_manager.tlmgr_csv import DEFAULT_MULTI_VALUE_SEPARATOR
+from tiny_ldap_manager.tlmgr_ldif import LDIFChangeRecordParser
+from tiny_ldap_manager.tlmgr_ldif import parse_modify_lines
+from tiny_ldap_manager.tlmgr_workers import chunked
+
+# Amount of records checked by a worker process at once
+VALIDATION_CHUNK_SIZE = 5000
+# Columns every CSV file of each bulk job must have
+REQUIRED_COLUMNS = {
+    'add-entries': ('dn', 'objectClass'),
+    'modify-attributes': ('dn',),
+}
+# Kinds of LDIF change records
+LDIF_CHANGETYPES = ('add', 'delete', 'modify', 'modrdn', 'moddn')
+
+
+def fetch_attribute_types(ldap_session):
+    """ Retrieve the attribute types of the server schema
+
+    The schema is read once, from the subschemaSubentry of the root DSE.
+    Returns a dict which tells whether each attribute type (indexed by each
+    of its lowercased names, and by its OID) is single-valued, or None if the
+    schema can't be read.
+    """
+    try:
+        subschema_dn = ldap_session.search_subschemasubentry_s()
+        if subschema_dn is None:
+            return None
+        subschema_entry = ldap_session.read_subschemasubentry_s(subschema_dn, \
+                ['attributeTypes'])
+    except ldap.LDAPError:
+        return None
+    if not subschema_entry:
+        return None
+    subschema = SubSchema(subschema_entry, check_uniqueness=0)
+    attribute_types = {}
+    for oid in subschema.listall(AttributeType):
+        attribute_type = subschema.get_obj(AttributeType, oid)
+        for name in (oid,) + tuple(attribute_type.names):
+            attribute_types[name.lower()] = bool(attribute_type.single_value)
+    return attribute_types
+
+
+def check_dn(dn, attribute_types=None):
+    """ Check the syntax of a DN, and the attributes of its RDNs
+
+    Returns a (DN key, problems) tuple, where the key (see dn_key) is None if
+    the DN can't be parsed at all.
+    """
+    if not dn:
+        return None, ["missing DN"]
+    try:
+        rdns = ldap.dn.str2dn(dn)
+    except ldap.DECODING_ERROR:
+        return None, ["{} is not a valid DN".format(dn)]
+    if not rdns:
+        return None, ["empty DN"]
+    problems = []
+    if attribute_types is not None:
+        problems.extend("unknown attribute {} in DN {}".format(attr, dn) \
+                for rdn in rdns for attr, value, flags in rdn \
+                if attr.lower() not in attribute_types)
+    return dn_key(rdns), problems
+
+
+def check_attribute_values(attr, count, attribute_types):
+    """ Check an attribute, with the given amount of values, against schema """
+    if attribute_types is None:
+        return []
+    single_valued = attribute_types.get(attr.lower())
+    if single_valued is None:
+        return ["unknown attribute {}".format(attr)]
+    if single_valued and count > 1:
+        return ["{} values for single-valued attribute {}".format(count, attr)]
+    return []
+
+
+def check_csv_header(action, header, attribute_types):
+    """ Check the header row of a CSV file, once
+
+    Returns the problems found, which apply to the whole file.
+    """
+    problems = []
+    attrs = [parse_column(column)[0] for column in header]
+    lowered = [attr.lower() for attr in attrs]
+    for column in REQUIRED_COLUMNS[action]:
+        # The DN column must be named exactly so (see tlmgr_csv)
+        if column not in attrs \
+                and (column == 'dn' or column.lower() not in lowered):
+            problems.append("missing required column {}".format(column))
+    problems.extend("duplicated column {}".format(attr) \
+            for index, attr in enumerate(attrs) \
+            if attr.lower() in lowered[:index])
+    if action == 'modify-attributes' and len(header) < 2:
+        problems.append("expected at least 2 columns (dn and an attribute), " \
+                "found {}".format(len(header)))
+    if attribute_types is not None:
+        problems.extend("unknown attribute {}".format(attr) \
+                for attr in attrs \
+                if attr != 'dn' and attr.lower() not in attribute_types)
+    return problems
+
+
+def check_add_rows(header, rows, attribute_types=None, \
+        separator=DEFAULT_MULTI_VALUE_SEPARATOR, literals=False):
+    """ Check a chunk of CSV rows of LDAP entries to be added
+
+    Returns a (line_num, DN key, problems) tuple for each row.
+    """
+    dn_index = header.index('dn')
+    # Only the attribute types the header refers to are looked up
+    columns = []
+    for index, column in enumerate(header):
+        if column == 'dn':
+            continue
+        attr, is_multi, is_base64 = parse_column(column)
+        single_valued = attribute_types.get(attr.lower()) \
+                if attribute_types is not None else None
+        columns.append((index, attr, is_multi, is_base64, single_valued))
+    results = []
+    for line_num, row in rows:
+        if len(row) != len(header):
+            results.append((line_num, None, ["expected {} fields, found {}" \
+                    .format(len(header), len(row))]))
+            continue
+        key, problems = check_dn(row[dn_index], attribute_types)
+        for index, attr, is_multi, is_base64, single_valued in columns:
+            value = row[index]
+            if attr.lower() == 'objectclass' and not value:
+                problems.append("missing value for objectClass")
+            if is_base64 and value and not is_base64_value(value, is_multi, \
+                    separator, literals):
+                problems.append("invalid base64 value for {}".format(attr))
+            if not single_valued or not value:
+                continue
+            if literals:
+                element = check_csv_literals(value)
+                count = len(element) if isinstance(element, list) else 1
+            elif is_multi:
+                count = len(split_multi_value(value, separator))
+            else:
+                continue
+            if count > 1:
+                problems.append("{} values for single-valued attribute {}" \
+                        .format(count, attr))
+        results.append((line_num, key, problems))
+    return results
+
+
+def is_base64_value(value, is_multi, separator, literals):
+    """ Check whether every value of a base64 column can be decoded """
+    if literals:
+        element = check_csv_literals(value)
+        values = element if isinstance(element, list) else [element]
+    elif is_multi:
+        values = split_multi_value(value, separator)
+    else:
+        values = [value]
+    try:
+        for element in values:
+            b64decode(element, validate=True)
+    except (ValueError, TypeError):
+        return False
+    return True
+
+
+def check_modify_rows(header, rows, attribute_types=None):
+    """ Check a chunk of CSV rows of LDAP attributes to be modified
+
+    Returns a (line_num, DN key, problems) tuple for each row, where the DN
+    is never given (since many rows may change the same entry).
+    """
+    results = []
+    for line_num, row in rows:
+        if len(row) != len(header) \
+                or not sanitize_csv_entry(dict(zip(header, row))):
+            results.append((line_num, None, ["incomplete CSV entry"]))
+            continue
+        key, problems = check_dn(row[header.index('dn')], attribute_types)
+        results.append((line_num, None, problems))
+    return results
+
+
+def check_dn_lines(lines, attribute_types=None):
+    """ Check a chunk of DNs (ie: of entries to be deleted)
+
+    Returns a (line_num, DN key, problems) tuple for each DN.
+    """
+    return [(line_num,) + check_dn(dn, attribute_types) \
+            for line_num, dn in lines]
+
+
+def check_ldif_records(records, attribute_types=None):
+    """ Check a chunk of LDIF change records
+
+    Returns a (line_num, DN key, problems) tuple for each record,
+    where the DN is only given for 'add' records (since other kinds of
+    records may refer to the same entry many times).
+    """
+    results = []
+    for line_num, dn, changetype, lines in records:
+        key, problems = check_dn(dn, attribute_types)
+        if changetype not in LDIF_CHANGETYPES:
+            problems.append("unknown changetype {}".format(changetype))
+        elif changetype == 'add':
+            counts = {}
+            for attr, value in lines:
+                counts[attr] = counts.get(attr, 0) + 1
+            for attr, count in counts.items():
+                problems.extend(check_attribute_values(attr, count, \
+                        attribute_types))
+        elif changetype == 'modify':
+            try:
+                modops = parse_modify_lines(lines)
+            except ValueError as err:
+                problems.append(str(err))
+                modops = []
+            for op, attr, values in modops:
+                # Deleted values don't count, as far as the schema goes
+                count = len(values or ()) if op != ldap.MOD_DELETE else 0
+                problems.extend(check_attribute_values(attr, count, \
+                        attribute_types))
+        results.append((line_num, key if changetype == 'add' else None, \
+                problems))
+    return results
+
+
+def read_csv_rows(csv_file):
+    """ Read the header and the (line_num, row) tuples of a CSV file """
+    f = open(csv_file, 'r', newline='')
+    csv_reader = csv.reader(f, delimiter=';')
+    header = next(csv_reader, None)
+
+    def rows():
+        with f:
+            for row in csv_reader:
+                # Blank lines are skipped, just like csv.DictReader() does
+                if row:
+                    yield csv_reader.line_num, row
+    return header, rows()
+
+
+def read_dn_lines(txtfile):
+    """ Read the (line_num, dn) tuples of a text file """
+    with open(txtfile, 'r') as f:
+        for line_num, line in enumerate(f, 1):
+            yield line_num, line.strip('\n')
+
+
+def read_ldif_records(ldif_file):
+    """ Read the (line_num, dn, changetype, lines) tuples of an LDIF file """
+    with open(ldif_file, 'rb') as f:
+        for line_num, dn, changetype, lines, controls in \
+                LDIFChangeRecordParser(f).records():
+            yield line_num, dn, changetype, lines
+
+
+def check_in_processes(check_chunk, records):
+    """ Check records in chunks, across a pool of worker processes
+
+    Yields the result of each record, in the same order as 'records'.
+    """
+    workers = os.cpu_count() or 1
+    # No need for processes when there's a single CPU!
+    if workers == 1:
+        for chunk in chunked(records, VALIDATION_CHUNK_SIZE):
+            for result in check_chunk(chunk):
+                yield result
+        return
+    # Chunks are submitted lazily, so only a few of them are held in memory
+    max_pending = 2 * workers
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk in chunked(records, VALIDATION_CHUNK_SIZE):
+            pending.append(executor.submit(check_chunk, chunk))
+            if len(pending) >= max_pending:
+                for result in pending.popleft().result():
+                    yield result
+        while pending:
+            for result in pending.popleft().result():
+                yield result
+
+
+def report_problems(results):
+    """ Show every problem found, as well as duplicated DNs
+
+    Returns a (records, records with problems) tuple.
+    """
+    # Line where each DN (by its key) was first found
+    seen = {}
+    records = 0
+    failed = 0
+    for line_num, key, problems in results:
+        records += 1
+        if key is not None:
+            first_line = seen.setdefault(key, line_num)
+            if first_line != line_num:
+                problems.append("duplicated DN (first found at line {})" \
+                        .format(first_line))
+        if problems:
+            failed += 1
+        for problem in problems:
+            logging.warning("ERROR: Line %s: %s", line_num, problem)
+    return records, failed
+
+
+def validate_bulk_file(ldap_session, action, input_file, \
+        separator=DEFAULT_MULTI_VALUE_SEPARATOR, literals=False):
+    """ Check every record of the input file of a bulk job, without writing
+
+    Returns the amount of problems found (records with problems, along with
+    problems of the whole file).
+    """
+    logging.info("\nValidating %s (%s)...\n", input_file, action)
+    attribute_types = fetch_attribute_types(ldap_session)
+    if attribute_types is None:
+        logging.warning("WARNING: Can't read the schema of the server: " \
+        "attributes won't be checked!")
+    file_problems = []
+    try:
+        if action in REQUIRED_COLUMNS:
+            header, rows = read_csv_rows(input_file)
+            if header is None:
+                logging.critical("\nERROR: %s is empty!", input_file)
+                return 1
+            file_problems = check_csv_header(action, header, attribute_types)
+            if 'dn' not in header:
+                records = []
+            elif action == 'add-entries':
+                records = check_in_processes(partial(check_add_rows, header, \
+                        attribute_types=attribute_types, separator=separator, \
+                        literals=literals), rows)
+            else:
+                records = check_in_processes(partial(check_modify_rows, \
+                        header, attribute_types=attribute_types), rows)
+        elif action == 'delete-entries':
+            records = check_in_processes(partial(check_dn_lines, \
+                    attribute_types=attribute_types), read_dn_lines(input_file))
+        else:
+            records = check_in_processes(partial(check_ldif_records, \
+                    attribute_types=attribute_types), \
+                    read_ldif_records(input_file))
+        for problem in file_problems:
+            logging.warning("ERROR: Line 1: %s", problem)
+        checked, failed = report_problems(records)
+    except IOError:
+        logging.critical("\nERROR: file %s not found!", input_file)
+        return 1
+    except ValueError as err:
+        logging.critical("\nERROR: Wrong LDIF formatted content found: %s", err)
+        return 1
+    logging.info("\nValidation finished: %s records checked, %s of them " \
+    "with problems.", checked, failed)
+    return failed + len(file_problems)
@@ -0,0 +1,144 @@
+# Copyright 2020 by Tuxedoar <tuxedoar@gmail.com>
+
+# LICENSE
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Multi-threaded worker helpers for LDAP operations in bulk """
+
+import logging
+import threading
+from collections import deque
+from itertools import islice
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+
+# Amount of entries handed over to a worker at once
+DEFAULT_CHUNK_SIZE = 256
+
+# Log records emitted by a worker thread are kept aside (see LogCapture),
+# so they can be shown afterwards, in the same order as the entries.
+_capture = threading.local()
+
+
+class LogCapture(logging.Filter):
+    """ Logging filter that keeps aside the records of worker threads """
+    def filter(self, record):
+        records = getattr(_capture, 'records', None)
+        if records is None:
+            return True
+        # The same record goes through every handler's filter!
+        if not records or records[-1] is not record:
+            records.append(record)
+        return False
+
+
+def chunked(iterable, size=DEFAULT_CHUNK_SIZE):
+    """ Split an iterable into lists of up to 'size' elements, lazily """
+    iterable = iter(iterable)
+    chunk = list(islice(iterable, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterable, size))
+
+
+def run_in_workers(ldap_pool, func, items, partition=None):
+    """ Call func(ldap_session, item) for each item, across a pool of sessions
+
+    Argument: ldap_pool (a list of bound LDAP sessions, one for each worker)
+    Argument: partition (if given, called with each item to get the index of
+    the session it must run on. Items of the same partition are run one after
+    another, in order, instead of on any free session)
+
+    Yields the result of each call, in the same order as 'items'. Log messages
+    of each call are also shown in that order.
+    """
+    # No need for threads when there's a single LDAP session!
+    if len(ldap_pool) == 1:
+        for item in items:
+            yield func(ldap_pool[0], item)
+        return
+
+    sessions = Queue()
+    for ldap_session in ldap_pool:
+        sessions.put(ldap_session)
+
+    def work(item):
+        """ Run 'func' on a free LDAP session """
+        ldap_session = sessions.get()
+        try:
+            return capture_call(func, ldap_session, item)
+        finally:
+            sessions.put(ldap_session)
+
+    if partition is None:
+        executors = [ThreadPoolExecutor(max_workers=len(ldap_pool))]
+    else:
+        # A single thread for each session runs the items of its partition
+        executors = [ThreadPoolExecutor(max_workers=1) for _ in ldap_pool]
+
+    def submit(item):
+        """ Hand over an item to a worker thread """
+        if partition is None:
+            return executors[0].submit(work, item)
+        index = partition(item)
+        return executors[index].submit(capture_call, func, ldap_pool[index], \
+                item)
+
+    log_capture = LogCapture()
+    handlers = list(logging.getLogger().handlers)
+    for handler in handlers:
+        handler.addFilter(log_capture)
+    # Items are submitted lazily, so that only a few of them are held in
+    # memory at once, regardless of how many of them there are.
+    max_pending = 2 * len(ldap_pool)
+    pending = deque()
+    try:
+        try:
+            for item in items:
+                pending.append(submit(item))
+                if len(pending) >= max_pending:
+                    yield merge_worker_result(pending.popleft().result())
+            while pending:
+                yield merge_worker_result(pending.popleft().result())
+        finally:
+            # Don't wait for the queued items when something went wrong!
+            for future in pending:
+                future.cancel()
+            for executor in executors:
+                executor.shutdown()
+    finally:
+        for handler in handlers:
+            handler.removeFilter(log_capture)
+
+
+def capture_call(func, ldap_session, item):
+    """ Call func(ldap_session, item), capturing its log records """
+    _capture.records = []
+    try:
+        return _capture.records, func(ldap_session, item), None
+    except Exception as err:
+        return _capture.records, None, err
+    finally:
+        _capture.records = None
+
+
+def merge_worker_result(worker_result):
+    """ Show the log records of a worker call and hand over its result """
+    records, result, error = worker_result
+    for record in records:
+        logging.getLogger(record.name).handle(record)
+    if error is not None:
+        raise error
+    return result